@@ -0,0 +1,120 @@
+"""Сборка pydantic-моделей из строк БД: поштучная валидация против пакетной.
+
+    python -m benchmarks.model_build
+    python -m benchmarks.model_build --sizes 1,50,500 --repeat 7 --json model_build.json
+
+Для корзин с N строками сравниваются прежний путь (CartResponseItem на
+каждую строку, затем CartResponse) и cart_response_from_rows, для списков
+товаров - Item на строку против items_from_rows. Перед замером проверяется,
+что оба пути дают одинаковый JSON.
+"""
+import argparse
+import json
+import sys
+import timeit
+
+from shop_api.models import CartResponse, CartResponseItem, Item, cart_response_from_rows, items_from_rows
+
+
+SIZES = (1, 50, 500)
+
+
+def validated_cart_response(cart_id: int, lines: list[dict], price: float) -> CartResponse:
+    """Прежний путь: модель на каждую строку и повторная проверка списка в CartResponse"""
+    return CartResponse(id=cart_id, items=[CartResponseItem(**line) for line in lines], price=price)
+
+
+def validated_items(rows: list[dict], versions: list[int]) -> list[Item]:
+    items = []
+    for row, version in zip(rows, versions):
+        item = Item(**row)
+        item._version = version
+        items.append(item)
+    return items
+
+
+def cart_lines(size: int) -> tuple[list[dict], float]:
+    lines = [
+        {'id': line, 'name': f"Item {line}", 'quantity': line % 5 + 1, 'available': line % 7 != 0}
+        for line in range(1, size + 1)
+    ]
+    return lines, float(sum(line['quantity'] * 9.99 for line in lines))
+
+
+def item_rows(size: int) -> tuple[list[dict], list[int]]:
+    rows = [{'id': item_id, 'name': f"Item {item_id}", 'price': item_id * 1.5, 'deleted': item_id % 7 == 0}
+            for item_id in range(1, size + 1)]
+    return rows, [1] * size
+
+
+def cases(sizes) -> dict:
+    """Имя -> (прежний вызов, быстрый вызов)"""
+    result = {}
+    for size in sizes:
+        lines, price = cart_lines(size)
+        result[f'cart_response[{size}]'] = (
+            lambda lines=lines, price=price: validated_cart_response(1, lines, price),
+            lambda lines=lines, price=price: cart_response_from_rows(1, lines, price),
+        )
+        rows, versions = item_rows(size)
+        result[f'item_list[{size}]'] = (
+            lambda rows=rows, versions=versions: validated_items(rows, versions),
+            lambda rows=rows, versions=versions: items_from_rows(rows, versions),
+        )
+    return result
+
+
+def dump(value) -> str:
+    if isinstance(value, list):
+        return json.dumps([(item.model_dump(), item._version) for item in value])
+    return value.model_dump_json()
+
+
+def best_of(call, repeat: int, number: int = None) -> float:
+    """Лучшее время одного вызова в микросекундах; без number число вызовов подбирается под ~0.05 с на замер"""
+    timer = timeit.Timer(call)
+    if number is None:
+        number = max(1, timer.autorange()[0] // 4)
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def run(sizes=SIZES, repeat: int = 5, number: int = None) -> dict:
+    results = {}
+    for name, (validated, trusted) in cases(sizes).items():
+        if dump(validated()) != dump(trusted()):
+            raise AssertionError(f"{name}: trusted construction differs from validated construction")
+        validated_us = best_of(validated, repeat, number)
+        trusted_us = best_of(trusted, repeat, number)
+        results[name] = {
+            'validated_us': validated_us,
+            'trusted_us': trusted_us,
+            'speedup': validated_us / trusted_us if trusted_us else 0.0,
+        }
+    return results
+
+
+def format_report(results: dict) -> str:
+    header = f"{'case':<24}{'validated':>14}{'trusted':>14}{'speedup':>10}"
+    lines = [header, '-' * len(header)]
+    for name, row in results.items():
+        lines.append(f"{name:<24}{row['validated_us']:>12.2f}us{row['trusted_us']:>12.2f}us{row['speedup']:>9.2f}x")
+    return '\n'.join(lines)
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Micro-benchmark for building response models from DB rows')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', dest='json_path', help='write results to this file')
+    args = parser.parse_args(argv)
+
+    results = run([int(size) for size in args.sizes.split(',')], args.repeat)
+    print(format_report(results))
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
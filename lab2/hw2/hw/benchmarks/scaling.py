@@ -0,0 +1,227 @@
+"""Как методы Shop масштабируются с размером каталога и корзин.
+
+    python -m benchmarks.scaling --sizes 1000,100000,1000000
+    python -m benchmarks.scaling --sizes 1000 --save-baseline benchmarks/baselines/sqlite.json
+    python -m benchmarks.scaling --sizes 1000 --baseline benchmarks/baselines/sqlite.json --max-slowdown 2
+
+Для каждого размера N создается детерминированный набор: N товаров, N
+корзин по ITEMS_PER_CART строк и отдельные корзины на CART_SIZES строк.
+Каждый метод вызывается --repeat раз; в отчет идут медиана, p95 и число
+SQL-запросов на вызов. Без DATABASE_URL база - SQLite-файл во временном
+каталоге. С --baseline команда завершается с кодом 1, если метод стал
+медленнее в --max-slowdown раз или начал делать больше запросов.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from sqlalchemy import insert, text
+
+from shop_api.database import Shop
+from shop_api.db_models import CartDB, CartItemDB, ItemDB
+from shop_api.models import GetCartsRequest, GetItemsRequest, UpdateItemRequest
+from shop_api.query_metrics import track_queries
+
+
+ITEMS_PER_CART = 3
+CART_SIZES = (1, 10, 100, 1000)
+CHUNK = 10_000
+
+# Разница меньше стольких миллисекунд считается шумом, даже если она в разы
+NOISE_FLOOR_MS = 1.0
+
+
+class Dataset:
+    """Что лежит в базе после seed(): нужно сценариям, чтобы выбирать id"""
+
+    def __init__(self, size: int, cart_ids_by_size: dict[int, int]):
+        self.size = size
+        self.cart_ids_by_size = cart_ids_by_size
+
+
+def _insert_chunks(connection, table, rows):
+    for start in range(0, len(rows), CHUNK):
+        connection.execute(insert(table), rows[start:start + CHUNK])
+
+
+def seed(shop: Shop, size: int, seed_value: int = 0) -> Dataset:
+    """Пишет набор данных пачками в обход Shop: через методы 1M строк заливались бы часами"""
+    rng = random.Random(seed_value)
+    with shop.db.engine.begin() as connection:
+        for table in ('cart_items', 'carts', 'items'):
+            connection.execute(text(f"DELETE FROM {table}"))
+
+        items = [
+            {'id': item_id, 'name': f"Item {item_id}", 'price': round(rng.uniform(1, 1000), 2),
+             'deleted': rng.random() < 0.05, 'version': 1}
+            for item_id in range(1, size + 1)
+        ]
+        _insert_chunks(connection, ItemDB.__table__, items)
+        del items
+
+        sized = [cart_size for cart_size in CART_SIZES if cart_size <= size]
+        carts = [{'id': cart_id, 'version': 1} for cart_id in range(1, size + len(sized) + 1)]
+        _insert_chunks(connection, CartDB.__table__, carts)
+
+        lines = []
+        for cart_id in range(1, size + 1):
+            for item_id in rng.sample(range(1, size + 1), min(ITEMS_PER_CART, size)):
+                lines.append({'cart_id': cart_id, 'item_id': item_id, 'quantity': rng.randint(1, 5)})
+        cart_ids_by_size = {}
+        for offset, cart_size in enumerate(sized, start=1):
+            cart_id = size + offset
+            cart_ids_by_size[cart_size] = cart_id
+            for item_id in rng.sample(range(1, size + 1), cart_size):
+                lines.append({'cart_id': cart_id, 'item_id': item_id, 'quantity': 1})
+        _insert_chunks(connection, CartItemDB.__table__, lines)
+    return Dataset(size, cart_ids_by_size)
+
+
+def operations(dataset: Dataset, rng: random.Random) -> dict:
+    """Имя -> вызов метода Shop со случайными, но воспроизводимыми аргументами"""
+    size = dataset.size
+
+    def item_id():
+        return rng.randint(1, size)
+
+    def cart_id():
+        return rng.randint(1, size)
+
+    ops = {
+        'get_item': lambda shop: shop.get_item(item_id()),
+        'get_all_items': lambda shop: shop.get_all_items(GetItemsRequest()),
+        'get_all_items_price_range': lambda shop: shop.get_all_items(GetItemsRequest(min_price=400, max_price=410)),
+        'get_all_items_deep_offset': lambda shop: shop.get_all_items(GetItemsRequest(offset=size // 2)),
+        'get_cart': lambda shop: shop.get_cart(cart_id()),
+        'get_cart_responses': lambda shop: shop.get_cart_responses(GetCartsRequest()),
+        'get_cart_responses_filtered': lambda shop: shop.get_cart_responses(GetCartsRequest(min_price=2000)),
+        'get_cart_version': lambda shop: shop.get_cart_version(cart_id()),
+        'get_catalog_version': lambda shop: shop.get_catalog_version(),
+        'get_business_metrics': lambda shop: shop.get_business_metrics(),
+        'add_item_to_cart': lambda shop: shop.add_item_to_cart(cart_id(), item_id()),
+        'update_item': lambda shop: shop.update_item(item_id(), UpdateItemRequest(price=round(rng.uniform(1, 1000), 2))),
+    }
+    for cart_size, sized_cart_id in dataset.cart_ids_by_size.items():
+        ops[f'get_cart_response[{cart_size}]'] = lambda shop, sized_cart_id=sized_cart_id: shop.get_cart_response(sized_cart_id)
+    return ops
+
+
+def measure(shop: Shop, call, repeat: int) -> dict:
+    call(shop)
+    durations = []
+    with track_queries('benchmark') as stats:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            call(shop)
+            durations.append(time.perf_counter() - started)
+    durations.sort()
+    return {
+        'median_ms': statistics.median(durations) * 1000,
+        'p95_ms': durations[max(0, math.ceil(0.95 * repeat) - 1)] * 1000,
+        'queries': stats.count / repeat,
+    }
+
+
+def run(shop: Shop, sizes: list[int], repeat: int = 20, seed_value: int = 0, only: set = None) -> dict:
+    results = {}
+    for size in sizes:
+        dataset = seed(shop, size, seed_value)
+        rng = random.Random(seed_value)
+        results[str(size)] = {
+            name: measure(shop, call, repeat)
+            for name, call in operations(dataset, rng).items()
+            if only is None or name.split('[')[0] in only
+        }
+    return results
+
+
+def scaling_exponent(small: dict, large: dict, small_size: int, large_size: int) -> float:
+    """k в t ~ N^k между двумя размерами: 0 - константа, 1 - линейный рост"""
+    if small['median_ms'] <= 0 or large['median_ms'] <= 0:
+        return 0.0
+    return math.log(large['median_ms'] / small['median_ms']) / math.log(large_size / small_size)
+
+
+def format_report(results: dict) -> str:
+    sizes = sorted(results, key=int)
+    names = sorted({name for per_size in results.values() for name in per_size})
+    header = f"{'method':<32}" + ''.join(f"{'N=' + size:>14}" for size in sizes) + f"{'queries':>10}{'growth':>10}"
+    lines = [header, '-' * len(header)]
+    for name in names:
+        cells = ''.join(
+            f"{results[size][name]['median_ms']:>12.3f}ms" if name in results[size] else f"{'-':>14}"
+            for size in sizes
+        )
+        measured = [size for size in sizes if name in results[size]]
+        queries = results[measured[-1]][name]['queries']
+        growth = ''
+        if len(measured) > 1:
+            first, last = measured[0], measured[-1]
+            growth = f"N^{scaling_exponent(results[first][name], results[last][name], int(first), int(last)):.2f}"
+        lines.append(f"{name:<32}{cells}{queries:>10.1f}{growth:>10}")
+    return '\n'.join(lines)
+
+
+def compare(results: dict, baseline: dict, max_slowdown: float, noise_floor_ms: float = NOISE_FLOOR_MS) -> list[str]:
+    """Регрессии относительно baseline: время выросло в max_slowdown раз или стало больше запросов"""
+    regressions = []
+    for size, per_size in results.items():
+        for name, current in per_size.items():
+            previous = baseline.get(size, {}).get(name)
+            if previous is None:
+                continue
+            if current['queries'] > previous['queries']:
+                regressions.append(f"{name} at N={size}: {current['queries']:g} queries per call, baseline {previous['queries']:g}")
+            slower = current['median_ms'] > previous['median_ms'] * max_slowdown
+            if slower and current['median_ms'] - previous['median_ms'] > noise_floor_ms:
+                regressions.append(
+                    f"{name} at N={size}: {current['median_ms']:.3f} ms, baseline {previous['median_ms']:.3f} ms"
+                )
+    return regressions
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Data-size scaling benchmarks for Shop')
+    parser.add_argument('--sizes', default='1000,100000,1000000')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', help='comma-separated method names')
+    parser.add_argument('--json', dest='json_path', help='write results to this file')
+    parser.add_argument('--save-baseline', help='write results as a baseline file')
+    parser.add_argument('--baseline', help='fail on regressions against this baseline file')
+    parser.add_argument('--max-slowdown', type=float, default=float(os.getenv('BENCH_MAX_SLOWDOWN', '2.0')))
+    parser.add_argument('--noise-floor-ms', type=float, default=NOISE_FLOOR_MS)
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    only = set(args.only.split(',')) if args.only else None
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+        shop = Shop()
+        try:
+            results = run(shop, sizes, args.repeat, args.seed, only)
+        finally:
+            shop.close()
+
+    print(format_report(results))
+    for path in filter(None, [args.json_path, args.save_baseline]):
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_slowdown, args.noise_floor_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
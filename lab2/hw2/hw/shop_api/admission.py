@@ -0,0 +1,219 @@
+import asyncio
+import collections
+import math
+import os
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+READ = 'read'
+WRITE = 'write'
+
+ADMISSION_LIMIT = Gauge(
+    'app_admission_limit',
+    'Current adaptive concurrency limit per endpoint class',
+    ['endpoint_class'],
+    multiprocess_mode='livesum'
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    'app_admission_in_flight',
+    'Admitted requests currently running per endpoint class',
+    ['endpoint_class'],
+    multiprocess_mode='livesum'
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    'app_admission_queue_depth',
+    'Requests waiting for admission per endpoint class',
+    ['endpoint_class'],
+    multiprocess_mode='livesum'
+)
+ADMISSION_REJECTIONS = Counter(
+    'app_admission_rejections_total',
+    'Requests shed with 503 before reaching the database',
+    ['endpoint_class', 'reason']
+)
+ADMISSION_WAIT = Histogram(
+    'app_admission_wait_seconds',
+    'Time admitted requests spent in the admission queue',
+    ['endpoint_class'],
+    buckets=[0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+)
+
+EXCLUDED_PATHS = ('/healthz', '/readyz', '/metrics')
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdaptiveLimiter:
+    """Лимит одновременных запросов одного класса с очередью и AIMD-подстройкой.
+
+    Минимальная наблюдаемая задержка (базовая) ведется отдельно для каждого
+    маршрута: у GET /item/{id} и GET /cart она разная, и с общей базой
+    дорогие маршруты всегда выглядели бы медленными. Пока задержка запроса
+    не больше tolerance * базовой его маршрута, лимит растет на 1/limit за
+    запрос (примерно +1 за «окно» из limit запросов). Медленный ответ или
+    перегрузка базы (503) уменьшают лимит в backoff раз; уменьшают его только
+    запросы, начатые после предыдущего уменьшения, чтобы одна пачка медленных
+    ответов не обвалила лимит до минимума. Базовые задержки понемногу
+    «забываются», чтобы лимит не застревал после деградации.
+    """
+
+    def __init__(self, name: str, initial_limit: int = 32, min_limit: int = 2, max_limit: int = 256,
+                 max_queue: int = 64, queue_timeout: float = 1.0, tolerance: float = 2.0, backoff: float = 0.9):
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.in_flight = 0
+        self.waiters: collections.deque[asyncio.Future] = collections.deque()
+        self.baselines: dict[str, float] = {}
+        self.last_decrease = 0.0
+        self._publish()
+
+    @classmethod
+    def from_env(cls, name: str, initial_limit: int) -> 'AdaptiveLimiter':
+        prefix = f'ADMISSION_{name.upper()}'
+        return cls(
+            name,
+            initial_limit=int(os.getenv(f'{prefix}_LIMIT', str(initial_limit))),
+            min_limit=int(os.getenv('ADMISSION_MIN_LIMIT', '2')),
+            max_limit=int(os.getenv(f'{prefix}_MAX_LIMIT', str(initial_limit * 8))),
+            max_queue=int(os.getenv(f'{prefix}_QUEUE', str(initial_limit * 2))),
+            queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT_MS', '1000')) / 1000,
+            tolerance=float(os.getenv('ADMISSION_LATENCY_TOLERANCE', '2.0')),
+        )
+
+    def _publish(self):
+        ADMISSION_LIMIT.labels(self.name).set(int(self.limit))
+        ADMISSION_IN_FLIGHT.labels(self.name).set(self.in_flight)
+        ADMISSION_QUEUE_DEPTH.labels(self.name).set(len(self.waiters))
+
+    def retry_after(self) -> int:
+        """Через сколько секунд имеет смысл повторить: очередь успеет разойтись"""
+        latency = min(self.baselines.values(), default=self.queue_timeout)
+        return max(1, math.ceil(latency * (len(self.waiters) + 1) / max(1, int(self.limit))))
+
+    def _reject(self, reason: str):
+        ADMISSION_REJECTIONS.labels(self.name, reason).inc()
+        raise Rejected(reason, self.retry_after())
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+            self._publish()
+            return
+        if len(self.waiters) >= self.max_queue:
+            self._reject('queue_full')
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self._publish()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+            if waiter.done() and not waiter.cancelled():
+                # Место выдали в последний момент: возвращаем его следующему
+                self.release()
+            else:
+                waiter.cancel()
+            if isinstance(error, asyncio.CancelledError):
+                raise
+            self._reject('deadline')
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            self._publish()
+        ADMISSION_WAIT.labels(self.name).observe(time.perf_counter() - started)
+
+    def release(self):
+        self.in_flight -= 1
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+        self._publish()
+
+    def record(self, latency: float, overloaded: bool = False, route: str = None):
+        """Подстройка лимита по задержке завершенного запроса к маршруту route"""
+        now = time.perf_counter()
+        baseline = self.baselines.get(route)
+        if baseline is None or latency < baseline:
+            baseline = latency
+        else:
+            baseline *= 1.001
+        self.baselines[route] = baseline
+        if overloaded or latency > baseline * self.tolerance:
+            if now - latency >= self.last_decrease:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_decrease = now
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._publish()
+
+
+def endpoint_class(method: str) -> str:
+    return READ if method in ('GET', 'HEAD', 'OPTIONS') else WRITE
+
+
+class AdmissionMiddleware:
+    """ASGI-middleware: отдельные лимиты для чтений и записей, лишнее - сразу 503 с Retry-After.
+
+    Запрос ждет места не дольше queue_timeout; очередь ограничена max_queue.
+    Ответ 503 от приложения (например, при таймауте пула соединений) считается
+    признаком перегрузки базы и уменьшает лимит.
+    """
+
+    def __init__(self, app, limiters: dict[str, AdaptiveLimiter] = None):
+        self.app = app
+        self.limiters = limiters or {
+            READ: AdaptiveLimiter.from_env(READ, initial_limit=32),
+            WRITE: AdaptiveLimiter.from_env(WRITE, initial_limit=16),
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'].startswith(EXCLUDED_PATHS):
+            await self.app(scope, receive, send)
+            return
+        limiter = self.limiters[endpoint_class(scope['method'])]
+        try:
+            await limiter.acquire()
+        except Rejected as rejected:
+            await send_unavailable(send, rejected.retry_after)
+            return
+
+        status = None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Роутер кладет найденный маршрут в scope: базовая задержка по шаблону пути, а не по /item/42
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            limiter.record(time.perf_counter() - started, overloaded=status == 503, route=route)
+            limiter.release()
+
+
+async def send_unavailable(send, retry_after: int):
+    await send({
+        'type': 'http.response.start',
+        'status': 503,
+        'headers': [(b'content-type', b'application/json'), (b'retry-after', str(retry_after).encode('latin-1'))],
+    })
+    await send({'type': 'http.response.body', 'body': b'{"detail":"Service Unavailable"}'})
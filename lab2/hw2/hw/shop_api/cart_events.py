@@ -0,0 +1,574 @@
+"""Корзины как журнал событий: хранилище CART_STORAGE=events и задача снапшотов.
+
+    python -m shop_api.cart_events --max-replay 50 --batch-size 500
+
+Записи в корзину - только INSERT в cart_events (add, set, remove, clear),
+без UPDATE строк cart_items и их блокировок на горячих корзинах. Чтение
+корзины сворачивает ее снапшот и события после него, а итоги, метрики и
+фильтры по цене считаются одним SQL-запросом по тем же строкам. Задача снапшотов пишет
+новый снапшот для корзин, у которых после последнего снапшота накопилось
+больше max_replay событий, и тем ограничивает длину свертки; журнал при
+этом остается историей изменений, если не включить --prune.
+"""
+import argparse
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+
+from prometheus_client import Counter, Histogram
+from sqlalchemy import Integer, and_, case, delete, func, insert, literal, or_, select, text, union, union_all
+
+from .database import Shop
+from .db_models import CartDB, CartEventDB, CartSnapshotDB, CartSnapshotItemDB, ItemDB
+from .models import Cart, CartResponse, GetCartsRequest, cart_response_from_rows
+from .storage import BusinessMetrics
+from .transactions import CART_WRITE, READ, transactional
+
+
+ADD = 'add'
+SET = 'set'
+REMOVE = 'remove'
+CLEAR = 'clear'
+
+CART_EVENTS_APPENDED = Counter(
+    'app_cart_events_appended_total',
+    'Cart events appended to the log',
+    ['kind']
+)
+CART_EVENTS_REPLAYED = Histogram(
+    'app_cart_events_replayed',
+    'Events folded on top of the snapshot to read one cart',
+    buckets=[0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+)
+CART_SNAPSHOTS_WRITTEN = Counter(
+    'app_cart_snapshots_written_total',
+    'Cart snapshots written by the snapshot job'
+)
+
+
+class CartState:
+    """Свертка корзины: строки в порядке добавления и последнее учтенное событие"""
+    __slots__ = ('lines', 'last_event_id', 'replayed')
+
+    def __init__(self, last_event_id: int = 0):
+        self.lines: dict[int, int] = {}
+        self.last_event_id = last_event_id
+        self.replayed = 0
+
+    def apply(self, kind: str, item_id: int, quantity: int):
+        # Повторяет семантику строк cart_items: set и remove отсутствующей строки ничего не меняют
+        if kind == ADD:
+            self.lines[item_id] = self.lines.get(item_id, 0) + quantity
+        elif kind == SET:
+            if item_id in self.lines:
+                self.lines[item_id] = quantity
+        elif kind == REMOVE:
+            self.lines.pop(item_id, None)
+        elif kind == CLEAR:
+            self.lines.clear()
+
+    def to_cart(self, cart_id: int) -> Cart:
+        return Cart(id=cart_id, items=dict(self.lines))
+
+
+def cart_response(cart_id: int, state: CartState, items: dict[int, ItemDB]) -> tuple[CartResponse, int]:
+    """То же, что CartDB.create_cart_response, но по свертке; версия корзины - id последнего события"""
+    price = 0.0
+    total_quantity = 0
+    items_version = 0
+    lines = []
+    for item_id, quantity in state.lines.items():
+        item = items.get(item_id)
+        if item:
+            items_version += item.version
+            total_quantity += quantity
+            price += item.price * quantity
+            lines.append({'id': item.id, 'name': item.name, 'quantity': quantity, 'available': not item.deleted})
+    response = cart_response_from_rows(cart_id, lines, price)
+    response._version = f"{state.last_event_id}.{items_version}"
+    return response, total_quantity
+
+
+class EventSourcedShop(Shop):
+    """Shop, в котором корзины хранятся журналом cart_events со снапшотами вместо строк cart_items.
+
+    Таблица carts по-прежнему выдает id и отвечает на вопрос, есть ли корзина.
+    Порядок событий корзины - порядок их id.
+    """
+
+    def _load_states(self, session, cart_ids: list[int] = None, settled_before: datetime = None) -> dict[int, CartState]:
+        """Свертки существующих корзин (всех, если cart_ids не задан) тремя запросами.
+
+        С settled_before свертка останавливается на первом событии не старше
+        этого момента: в Postgres id выдаются до коммита, и более раннее
+        событие еще может появиться.
+        """
+        carts = select(CartDB.id, CartSnapshotDB.last_event_id).outerjoin(
+            CartSnapshotDB, CartSnapshotDB.cart_id == CartDB.id
+        ).order_by(CartDB.id)
+        if cart_ids is not None:
+            carts = carts.where(CartDB.id.in_(cart_ids))
+        states = {row.id: CartState(row.last_event_id or 0) for row in session.execute(carts)}
+        if not states:
+            return states
+
+        snapshotted = [cart_id for cart_id, state in states.items() if state.last_event_id]
+        if snapshotted:
+            lines = select(CartSnapshotItemDB.cart_id, CartSnapshotItemDB.item_id, CartSnapshotItemDB.quantity) \
+                .order_by(CartSnapshotItemDB.cart_id, CartSnapshotItemDB.position)
+            if cart_ids is not None:
+                lines = lines.where(CartSnapshotItemDB.cart_id.in_(snapshotted))
+            for row in session.execute(lines):
+                states[row.cart_id].lines[row.item_id] = row.quantity
+
+        columns = [CartEventDB.cart_id, CartEventDB.id, CartEventDB.kind, CartEventDB.item_id, CartEventDB.quantity]
+        if settled_before is not None:
+            columns.append((CartEventDB.created_at < settled_before).label('settled'))
+        events = (
+            select(*columns)
+            .outerjoin(CartSnapshotDB, CartSnapshotDB.cart_id == CartEventDB.cart_id)
+            .where(or_(CartSnapshotDB.last_event_id.is_(None), CartEventDB.id > CartSnapshotDB.last_event_id))
+            .order_by(CartEventDB.cart_id, CartEventDB.id)
+        )
+        if cart_ids is not None:
+            events = events.where(CartEventDB.cart_id.in_(cart_ids))
+        unsettled = set()
+        for row in session.execute(events):
+            state = states.get(row.cart_id)
+            if state is None or row.cart_id in unsettled:
+                continue
+            if settled_before is not None and not row.settled:
+                unsettled.add(row.cart_id)
+                continue
+            state.apply(row.kind, row.item_id, row.quantity)
+            state.last_event_id = row.id
+            state.replayed += 1
+        return states
+
+    def _lines(self, cart_ids: list[int] = None):
+        """Подзапрос текущих строк корзин (cart_id, item_id, quantity) без свертки журнала в Python.
+
+        Строка снапшота - это add на last_event_id в пустую корзину, clear -
+        remove каждого товара корзины. Как в CartState.apply, строка есть,
+        если после последнего remove был add, а set учитывается, только если
+        строка перед ним уже была. Количество - последний такой set плюс add
+        после него либо сумма add после последнего remove.
+        """
+        events = (
+            select(CartEventDB.cart_id, CartEventDB.item_id, CartEventDB.id, CartEventDB.kind, CartEventDB.quantity)
+            .outerjoin(CartSnapshotDB, CartSnapshotDB.cart_id == CartEventDB.cart_id)
+            .where(or_(CartSnapshotDB.last_event_id.is_(None), CartEventDB.id > CartSnapshotDB.last_event_id))
+        )
+        snapshot = (
+            select(CartSnapshotItemDB.cart_id, CartSnapshotItemDB.item_id, CartSnapshotDB.last_event_id.label('id'),
+                   literal(ADD).label('kind'), CartSnapshotItemDB.quantity)
+            .join(CartSnapshotDB, CartSnapshotDB.cart_id == CartSnapshotItemDB.cart_id)
+        )
+        if cart_ids is not None:
+            events = events.where(CartEventDB.cart_id.in_(cart_ids))
+            snapshot = snapshot.where(CartSnapshotItemDB.cart_id.in_(cart_ids))
+        events = events.subquery()
+        item_events = select(events).where(events.c.kind != CLEAR)
+        touched = union(
+            select(snapshot.subquery().c[:2]), select(item_events.subquery().c[:2])
+        ).subquery()
+        clears = (
+            select(touched.c.cart_id, touched.c.item_id, events.c.id, literal(REMOVE).label('kind'),
+                   literal(None, Integer).label('quantity'))
+            .join(events, and_(events.c.cart_id == touched.c.cart_id, events.c.kind == CLEAR))
+        )
+        rows = union_all(snapshot, item_events, clears).subquery()
+        same_line = lambda other: and_(other.c.cart_id == rows.c.cart_id, other.c.item_id == rows.c.item_id)
+        removals = (
+            select(rows.c.cart_id, rows.c.item_id,
+                   func.max(case((rows.c.kind == REMOVE, rows.c.id))).label('removed_id'))
+            .group_by(rows.c.cart_id, rows.c.item_id)
+            .subquery()
+        )
+        # Первый add после последнего remove: с него строка снова есть в корзине
+        starts = (
+            select(rows.c.cart_id, rows.c.item_id, removals.c.removed_id,
+                   func.min(case((and_(rows.c.kind == ADD, rows.c.id > func.coalesce(removals.c.removed_id, 0)),
+                                  rows.c.id))).label('started_id'))
+            .join(removals, same_line(removals))
+            .group_by(rows.c.cart_id, rows.c.item_id, removals.c.removed_id)
+            .subquery()
+        )
+        resets = (
+            select(rows.c.cart_id, rows.c.item_id, starts.c.removed_id,
+                   func.max(case((and_(rows.c.kind == SET, rows.c.id > starts.c.started_id), rows.c.id)))
+                   .label('reset_id'))
+            .join(starts, same_line(starts))
+            .group_by(rows.c.cart_id, rows.c.item_id, starts.c.removed_id)
+            .subquery()
+        )
+        counted = or_(
+            and_(rows.c.kind == SET, rows.c.id == resets.c.reset_id),
+            and_(rows.c.kind == ADD, rows.c.id > func.coalesce(resets.c.reset_id, resets.c.removed_id, 0)),
+        )
+        return (
+            select(rows.c.cart_id, rows.c.item_id, func.sum(rows.c.quantity).label('quantity'))
+            .join(resets, same_line(resets))
+            .where(counted)
+            .group_by(rows.c.cart_id, rows.c.item_id)
+            .subquery()
+        )
+
+    def _cart_aggregates(self, cart_ids: list[int] = None, item_id: int = None, with_deleted: bool = False):
+        """Цена и количество каждой корзины по _lines; без with_deleted цена не учитывает удаленные товары"""
+        lines = self._lines(cart_ids)
+        price = ItemDB.price * lines.c.quantity
+        if not with_deleted:
+            price = case((ItemDB.deleted == False, price), else_=0)
+        totals = (
+            select(lines.c.cart_id, func.sum(price).label('price'), func.sum(lines.c.quantity).label('quantity'))
+            .outerjoin(ItemDB, ItemDB.id == lines.c.item_id)
+            .group_by(lines.c.cart_id)
+            .subquery()
+        )
+        query = (
+            select(CartDB.id, func.coalesce(totals.c.price, 0.0).label('price'),
+                   func.coalesce(totals.c.quantity, 0).label('quantity'))
+            .outerjoin(totals, totals.c.cart_id == CartDB.id)
+            .order_by(CartDB.id)
+        )
+        if cart_ids is not None:
+            query = query.where(CartDB.id.in_(cart_ids))
+        if item_id is not None:
+            query = query.where(CartDB.id.in_(select(lines.c.cart_id).where(lines.c.item_id == item_id)))
+        return query
+
+    def _load_state(self, session, cart_id: int) -> CartState:
+        state = self._load_states(session, [cart_id]).get(cart_id)
+        if state is not None:
+            CART_EVENTS_REPLAYED.observe(state.replayed)
+        return state
+
+    def _items(self, session, states) -> dict[int, ItemDB]:
+        item_ids = {item_id for state in states for item_id in state.lines}
+        if not item_ids:
+            return {}
+        return {item.id: item for item in session.query(ItemDB).filter(ItemDB.id.in_(item_ids))}
+
+    def _append(self, session, cart_id: int, kind: str, item_id: int = None, quantity: int = None):
+        session.add(CartEventDB(cart_id=cart_id, kind=kind, item_id=item_id, quantity=quantity,
+                                created_at=datetime.now(timezone.utc)))
+
+    def _write(self, cart_id: int, kind: str, item_id: int = None, quantity: int = None, requires_line: bool = False,
+               requires_item: bool = False) -> Cart:
+        """Проверка по свертке и одно событие; возвращает корзину с этим событием"""
+        session = self.db.get_session()
+        try:
+            if requires_item:
+                item_db = session.query(ItemDB).filter(ItemDB.id == item_id).first()
+                if not item_db or item_db.deleted:
+                    return None
+            # Вставки событий не конфликтуют между собой: без блокировки строки carts параллельные
+            # remove и set проверили бы одну и ту же свертку, и set записался бы после remove
+            if session.query(CartDB.id).filter(CartDB.id == cart_id).with_for_update().first() is None:
+                return None
+            state = self._load_state(session, cart_id)
+            if state is None or requires_line and item_id not in state.lines:
+                return None
+            self._append(session, cart_id, kind, item_id, quantity)
+            session.commit()
+            CART_EVENTS_APPENDED.labels(kind).inc()
+            state.apply(kind, item_id, quantity)
+            return state.to_cart(cart_id)
+        finally:
+            session.close()
+
+    @transactional(CART_WRITE)
+    def add_item_to_cart(self, cart_id: int, item_id: int, quantity: int = 1) -> Cart:
+        return self._write(cart_id, ADD, item_id, quantity, requires_item=True)
+
+    @transactional(CART_WRITE)
+    def remove_item_from_cart(self, cart_id: int, item_id: int) -> Cart:
+        return self._write(cart_id, REMOVE, item_id, requires_line=True)
+
+    @transactional(CART_WRITE)
+    def update_cart_item_quantity(self, cart_id: int, item_id: int, quantity: int) -> Cart:
+        if quantity <= 0:
+            return self._write(cart_id, REMOVE, item_id, requires_line=True)
+        return self._write(cart_id, SET, item_id, quantity, requires_line=True)
+
+    @transactional(CART_WRITE)
+    def clear_cart(self, cart_id: int) -> Cart:
+        return self._write(cart_id, CLEAR)
+
+    @transactional(CART_WRITE)
+    def delete_cart(self, cart_id: int) -> bool:
+        session = self.db.get_session()
+        try:
+            cart_db = session.query(CartDB).filter(CartDB.id == cart_id).first()
+            if not cart_db:
+                return False
+
+            for table in (CartEventDB, CartSnapshotItemDB, CartSnapshotDB):
+                session.execute(delete(table).where(table.cart_id == cart_id))
+            session.delete(cart_db)
+            session.commit()
+            return True
+        finally:
+            session.close()
+
+    @transactional(CART_WRITE)
+    def apply_cart_deltas(self, deltas: dict[tuple[int, int], int], synchronous_commit: bool = True) -> int:
+        """Накопленные приращения - пачка событий add одним INSERT"""
+        if not deltas:
+            return 0
+        session = self.db.get_session()
+        try:
+            if not synchronous_commit and session.get_bind().dialect.name == 'postgresql':
+                session.execute(text("SET LOCAL synchronous_commit TO OFF"))
+
+            cart_ids = {cart_id for cart_id, _ in deltas}
+            existing_carts = {row.id for row in session.query(CartDB.id).filter(CartDB.id.in_(cart_ids))}
+            now = datetime.now(timezone.utc)
+            events = [
+                {'cart_id': cart_id, 'kind': ADD, 'item_id': item_id, 'quantity': quantity, 'created_at': now}
+                for (cart_id, item_id), quantity in deltas.items() if cart_id in existing_carts
+            ]
+            if events:
+                session.execute(insert(CartEventDB), events)
+            session.commit()
+            CART_EVENTS_APPENDED.labels(ADD).inc(len(events))
+            return len(events)
+        finally:
+            session.close()
+
+    @transactional(CART_WRITE)
+    def import_carts(self, carts: list[Cart]) -> int:
+        """Перенесенные корзины начинают журнал с событий add в порядке строк"""
+        if not carts:
+            return 0
+        session = self.db.get_session()
+        try:
+            existing = set(session.scalars(select(CartDB.id).where(CartDB.id.in_([cart.id for cart in carts]))))
+            imported = [cart for cart in carts if cart.id not in existing]
+            for cart in imported:
+                session.add(CartDB(id=cart.id))
+            session.flush()
+            now = datetime.now(timezone.utc)
+            events = [
+                {'cart_id': cart.id, 'kind': ADD, 'item_id': item_id, 'quantity': quantity, 'created_at': now}
+                for cart in imported for item_id, quantity in cart.items.items()
+            ]
+            if events:
+                session.execute(insert(CartEventDB), events)
+            session.commit()
+            return len(imported)
+        finally:
+            session.close()
+
+    @transactional(READ)
+    def get_cart(self, cart_id: int) -> Cart:
+        session = self.db.get_session(read_only=True)
+        try:
+            state = self._load_state(session, cart_id)
+            return state.to_cart(cart_id) if state is not None else None
+        finally:
+            session.close()
+
+    @transactional(READ)
+    def get_all_carts(self, filters: GetCartsRequest = None) -> list[Cart]:
+        session = self.db.get_session(read_only=True)
+        try:
+            cart_ids = [row.id for row in session.query(CartDB.id).order_by(CartDB.id)
+                        .offset(filters.offset if filters else 0).limit(filters.limit if filters else 10)]
+            if not cart_ids:
+                return []
+            return [state.to_cart(cart_id) for cart_id, state in self._load_states(session, cart_ids).items()]
+        finally:
+            session.close()
+
+    @transactional(READ)
+    def get_cart_response(self, cart_id: int) -> tuple:
+        session = self.db.get_session(read_only=True)
+        try:
+            state = self._load_state(session, cart_id)
+            if state is None:
+                return None, 0
+            return cart_response(cart_id, state, self._items(session, [state]))
+        finally:
+            session.close()
+
+    @transactional(READ)
+    def get_cart_responses(self, filters: GetCartsRequest = None) -> list[CartResponse]:
+        """Страница сворачивается по журналу; фильтры по цене и количеству считаются в SQL по всем корзинам"""
+        filters = filters or GetCartsRequest()
+        session = self.db.get_session(read_only=True)
+        try:
+            if any(bound is not None for bound in (
+                filters.min_price, filters.max_price, filters.min_quantity, filters.max_quantity
+            )):
+                # Как в агрегате Shop.get_cart_responses: цена по всем товарам, количество по всем строкам
+                totals = self._cart_aggregates(with_deleted=True).subquery()
+                page = select(totals.c.id)
+                if filters.min_price is not None:
+                    page = page.where(totals.c.price >= filters.min_price)
+                if filters.max_price is not None:
+                    page = page.where(totals.c.price <= filters.max_price)
+                if filters.min_quantity is not None:
+                    page = page.where(totals.c.quantity >= filters.min_quantity)
+                if filters.max_quantity is not None:
+                    page = page.where(totals.c.quantity <= filters.max_quantity)
+                cart_ids = list(session.scalars(page.order_by(totals.c.id).offset(filters.offset).limit(filters.limit)))
+            else:
+                cart_ids = [row.id for row in session.query(CartDB.id).order_by(CartDB.id)
+                            .offset(filters.offset).limit(filters.limit)]
+            states = self._load_states(session, cart_ids) if cart_ids else {}
+            items = self._items(session, states.values())
+            return [cart_response(cart_id, state, items)[0] for cart_id, state in states.items()]
+        finally:
+            session.close()
+
+    @transactional(READ)
+    def get_cart_totals(self, cart_ids: list[int] = None, item_id: int = None) -> dict[int, tuple[float, int]]:
+        session = self.db.get_session(read_only=True)
+        try:
+            return {row.id: (float(row.price), int(row.quantity))
+                    for row in session.execute(self._cart_aggregates(cart_ids, item_id))}
+        finally:
+            session.close()
+
+    @transactional(READ)
+    def get_business_metrics(self) -> BusinessMetrics:
+        session = self.db.get_session(read_only=True)
+        try:
+            totals = self._cart_aggregates().subquery()
+            carts, cart_price_sum = session.execute(
+                select(func.count(totals.c.id), func.coalesce(func.sum(totals.c.price), 0.0))
+            ).one()
+            items_count = session.query(func.count(ItemDB.id)).filter(ItemDB.deleted == False).scalar()
+            return BusinessMetrics(carts=carts, items=items_count, cart_price_sum=float(cart_price_sum))
+        finally:
+            session.close()
+
+    @transactional(READ)
+    def get_cart_version(self, cart_id: int) -> str:
+        session = self.db.get_session(read_only=True)
+        try:
+            state = self._load_state(session, cart_id)
+            if state is None:
+                return None
+            items_version = sum(item.version for item in self._items(session, [state]).values())
+            return f"{state.last_event_id}.{items_version}"
+        finally:
+            session.close()
+
+    def _in_carts(self, item_id):
+        # Учитываются и убранные из корзин товары: журнал остается читаемой историей
+        return or_(
+            select(CartEventDB.id).where(CartEventDB.item_id == item_id).exists(),
+            select(CartSnapshotItemDB.cart_id).where(CartSnapshotItemDB.item_id == item_id).exists(),
+        )
+
+    @transactional(READ)
+    def get_cart_events(self, cart_id: int) -> list[dict]:
+        """История корзины из журнала (после --prune - только события позже снапшота)"""
+        session = self.db.get_session(read_only=True)
+        try:
+            rows = session.execute(
+                select(CartEventDB.id, CartEventDB.kind, CartEventDB.item_id, CartEventDB.quantity,
+                       CartEventDB.created_at)
+                .where(CartEventDB.cart_id == cart_id)
+                .order_by(CartEventDB.id)
+            )
+            return [row._asdict() for row in rows]
+        finally:
+            session.close()
+
+    @transactional(CART_WRITE)
+    def snapshot_carts(self, max_replay: int, settled_before: datetime, batch_size: int = 500,
+                       prune: bool = False) -> int:
+        """Снапшоты для одной пачки корзин, у которых после снапшота больше max_replay событий"""
+        session = self.db.get_session()
+        try:
+            cart_ids = session.scalars(
+                select(CartEventDB.cart_id)
+                .outerjoin(CartSnapshotDB, CartSnapshotDB.cart_id == CartEventDB.cart_id)
+                .where(or_(CartSnapshotDB.last_event_id.is_(None), CartEventDB.id > CartSnapshotDB.last_event_id),
+                       CartEventDB.created_at < settled_before)
+                .group_by(CartEventDB.cart_id)
+                .having(func.count(CartEventDB.id) > max_replay)
+                .order_by(CartEventDB.cart_id)
+                .limit(batch_size)
+            ).all()
+            if not cart_ids:
+                return 0
+
+            states = self._load_states(session, cart_ids, settled_before)
+            now = datetime.now(timezone.utc)
+            session.execute(delete(CartSnapshotItemDB).where(CartSnapshotItemDB.cart_id.in_(list(states))))
+            session.execute(delete(CartSnapshotDB).where(CartSnapshotDB.cart_id.in_(list(states))))
+            session.execute(insert(CartSnapshotDB), [
+                {'cart_id': cart_id, 'last_event_id': state.last_event_id, 'created_at': now}
+                for cart_id, state in states.items()
+            ])
+            lines = [
+                {'cart_id': cart_id, 'position': position, 'item_id': item_id, 'quantity': quantity}
+                for cart_id, state in states.items()
+                for position, (item_id, quantity) in enumerate(state.lines.items())
+            ]
+            if lines:
+                session.execute(insert(CartSnapshotItemDB), lines)
+            if prune:
+                for cart_id, state in states.items():
+                    session.execute(delete(CartEventDB).where(
+                        CartEventDB.cart_id == cart_id, CartEventDB.id <= state.last_event_id
+                    ))
+            session.commit()
+            CART_SNAPSHOTS_WRITTEN.inc(len(states))
+            return len(states)
+        finally:
+            session.close()
+
+
+class SnapshotResult(NamedTuple):
+    carts: int
+    batches: int
+    seconds: float
+
+
+def snapshot_carts(shop: EventSourcedShop, max_replay: int = 50, batch_size: int = 500, settle: float = 5.0,
+                   prune: bool = False, pause: float = 0.0) -> SnapshotResult:
+    """Пачками, пока есть корзины с длинной сверткой; события моложе settle секунд не сворачиваются"""
+    settled_before = datetime.now(timezone.utc) - timedelta(seconds=settle)
+    started = time.perf_counter()
+    carts = batches = 0
+    while True:
+        count = shop.snapshot_carts(max_replay, settled_before, batch_size, prune)
+        if count == 0:
+            break
+        carts += count
+        batches += 1
+        if count < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return SnapshotResult(carts=carts, batches=batches, seconds=time.perf_counter() - started)
+
+
+def main(argv: list[str] = None) -> SnapshotResult:
+    parser = argparse.ArgumentParser(description='Write cart snapshots to bound event replay length')
+    parser.add_argument('--max-replay', type=int, default=int(os.getenv('CART_EVENTS_MAX_REPLAY', '50')))
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--settle-seconds', type=float, default=5.0,
+                        help='leave events younger than this for the next run')
+    parser.add_argument('--prune', action='store_true', help='delete events folded into a snapshot')
+    parser.add_argument('--pause', type=float, default=0.05, help='seconds to sleep between batches')
+    args = parser.parse_args(argv)
+
+    shop = EventSourcedShop()
+    try:
+        result = snapshot_carts(shop, args.max_replay, args.batch_size, args.settle_seconds, args.prune, args.pause)
+    finally:
+        shop.close()
+    print(f"snapshotted {result.carts} carts in {result.batches} batches, {result.seconds:.2f}s")
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+import logging
+import math
+import os
+import threading
+
+from prometheus_client import Counter
+
+from .models import Cart, CreateItemRequest, Item, UpdateItemRequest
+from .storage import BusinessMetrics, DelegatingShop, ShopStorage
+
+
+# Правые границы корзин гистограммы общего количества товаров в корзине
+QUANTITY_BINS = (0, 1, 2, 5, 10, 20, 50)
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+CART_STATS_REBUILD_ERRORS = Counter(
+    'app_cart_stats_rebuild_errors_total',
+    'Background rebuilds of the cart distribution sketches that failed'
+)
+
+logger = logging.getLogger(__name__)
+
+
+class DDSketch:
+    """Квантильный скетч с относительной погрешностью relative_accuracy (в духе DDSketch).
+
+    Значение x попадает в корзину ceil(log_gamma(x)); квантиль восстанавливается
+    с относительной ошибкой не больше relative_accuracy. Скетчи с одинаковой
+    точностью складываются (merge), а значения можно вычитать (remove):
+    этим пользуется пересчет корзины при изменении.
+    """
+    __slots__ = ('relative_accuracy', 'gamma', 'log_gamma', 'bins', 'zero_count', 'count', 'sum')
+
+    MIN_VALUE = 1e-9
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins: dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def _key(self, value: float) -> int:
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def _value(self, key: int) -> float:
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value: float, count: int = 1):
+        if value <= self.MIN_VALUE:
+            self.zero_count += count
+        else:
+            key = self._key(value)
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.count += count
+        self.sum += value * count
+
+    def remove(self, value: float, count: int = 1):
+        if value <= self.MIN_VALUE:
+            self.zero_count -= count
+        else:
+            key = self._key(value)
+            remaining = self.bins.get(key, 0) - count
+            if remaining > 0:
+                self.bins[key] = remaining
+            else:
+                self.bins.pop(key, None)
+        self.count -= count
+        self.sum -= value * count
+
+    def merge(self, other: 'DDSketch'):
+        if other.gamma != self.gamma:
+            raise ValueError("Sketches with different relative accuracy cannot be merged")
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q: float) -> float:
+        if self.count <= 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.bins))
+
+    def summary(self, quantiles=DEFAULT_QUANTILES) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.quantile(0.0),
+            'max': self.quantile(1.0),
+            'quantiles': {f"p{q * 100:g}": self.quantile(q) for q in quantiles},
+        }
+
+
+def quantity_bin(quantity: int) -> int:
+    for position, edge in enumerate(QUANTITY_BINS):
+        if quantity <= edge:
+            return position
+    return len(QUANTITY_BINS)
+
+
+def quantity_bin_labels() -> list[str]:
+    labels = []
+    previous = None
+    for edge in QUANTITY_BINS:
+        low = 0 if previous is None else previous + 1
+        labels.append(str(edge) if low == edge else f"{low}-{edge}")
+        previous = edge
+    labels.append(f"{previous + 1}+")
+    return labels
+
+
+class CartStats:
+    """Распределения цены и количества товаров по всем корзинам.
+
+    Хранит последние (price, quantity) каждой корзины, чтобы при изменении
+    вычесть старое значение из скетчей и добавить новое.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self.price = DDSketch(relative_accuracy)
+        self.quantity = DDSketch(relative_accuracy)
+        self.histogram = [0] * (len(QUANTITY_BINS) + 1)
+        self.carts: dict[int, tuple[float, int]] = {}
+        self.items = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_totals(cls, totals: dict[int, tuple[float, int]], items: int = 0,
+                    relative_accuracy: float = 0.01) -> 'CartStats':
+        stats = cls(relative_accuracy)
+        for cart_id, (price, quantity) in totals.items():
+            stats._add(cart_id, price, quantity)
+        stats.items = items
+        return stats
+
+    def _add(self, cart_id: int, price: float, quantity: int):
+        self.carts[cart_id] = (price, quantity)
+        self.price.add(price)
+        self.quantity.add(quantity)
+        self.histogram[quantity_bin(quantity)] += 1
+
+    def _discard(self, cart_id: int):
+        previous = self.carts.pop(cart_id, None)
+        if previous is not None:
+            price, quantity = previous
+            self.price.remove(price)
+            self.quantity.remove(quantity)
+            self.histogram[quantity_bin(quantity)] -= 1
+
+    def set_cart(self, cart_id: int, price: float, quantity: int):
+        with self.lock:
+            self._discard(cart_id)
+            self._add(cart_id, price, quantity)
+
+    def shift_cart(self, cart_id: int, price: float, quantity: int) -> bool:
+        """Сдвинуть итог известной корзины на приращение; False, если корзины в статистике нет"""
+        with self.lock:
+            previous = self.carts.get(cart_id)
+            if previous is None:
+                return False
+            self._discard(cart_id)
+            self._add(cart_id, previous[0] + price, previous[1] + quantity)
+            return True
+
+    def remove_cart(self, cart_id: int):
+        with self.lock:
+            self._discard(cart_id)
+
+    def business_metrics(self) -> BusinessMetrics:
+        with self.lock:
+            return BusinessMetrics(carts=len(self.carts), items=self.items, cart_price_sum=self.price.sum)
+
+    def summary(self, quantiles=DEFAULT_QUANTILES) -> dict:
+        with self.lock:
+            return {
+                'count': len(self.carts),
+                'relative_accuracy': self.relative_accuracy,
+                'price': self.price.summary(quantiles),
+                'quantity': self.quantity.summary(quantiles),
+                'quantity_histogram': dict(zip(quantity_bin_labels(), self.histogram)),
+            }
+
+
+class CartStatsShop(DelegatingShop):
+    """Хранилище, поддерживающее CartStats на каждой записи в корзину.
+
+    Изменение корзины пересчитывает ее итог из самой записи: добавление
+    сдвигает итог на цену товара, а удаление строки и смена количества
+    складывают итог из возвращенной корзины и цен ее товаров. Итоги из
+    хранилища перечитываются только для корзин, которых еще нет в
+    статистике. Смена цены или удаление товара меняют итоги всех корзин с ним, а записи
+    других воркеров сюда не доходят: это догоняет фоновая пересборка раз
+    в rebuild_interval одним агрегирующим запросом.
+    """
+
+    def __init__(self, shop: ShopStorage, rebuild_interval: float = 60.0, relative_accuracy: float = 0.01):
+        super().__init__(shop)
+        self.rebuild_interval = rebuild_interval
+        self.relative_accuracy = relative_accuracy
+        self.stats = CartStats(relative_accuracy)
+        self.touched: set[int] = None
+        self.touched_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, shop: ShopStorage) -> 'CartStatsShop':
+        return cls(
+            shop,
+            rebuild_interval=float(os.getenv('CART_STATS_REBUILD_SECONDS', '60')),
+            relative_accuracy=float(os.getenv('CART_STATS_ACCURACY', '0.01')),
+        )
+
+    def warm_up(self, connections: int = 5):
+        self.shop.warm_up(connections)
+        self.rebuild()
+        if self.rebuild_interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='cart-stats-rebuild', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.shop.close()
+
+    def _run(self):
+        while not self._stopped.wait(self.rebuild_interval):
+            try:
+                self.rebuild()
+            except Exception:
+                CART_STATS_REBUILD_ERRORS.inc()
+                logger.exception("Cart stats rebuild failed")
+
+    def rebuild(self):
+        """Пересборка из одного агрегата; корзины, измененные во время прохода, перечитываются после"""
+        with self.touched_lock:
+            self.touched = set()
+        try:
+            totals = self.shop.get_cart_totals()
+            items = self.shop.get_business_metrics().items
+            stats = CartStats.from_totals(totals, items, self.relative_accuracy)
+        finally:
+            with self.touched_lock:
+                touched, self.touched = self.touched, None
+        self.stats = stats
+        for cart_id in touched:
+            self._refresh(cart_id)
+
+    def _apply(self, totals: dict[int, tuple[float, int]], cart_ids):
+        with self.touched_lock:
+            if self.touched is not None:
+                self.touched.update(cart_ids)
+        for cart_id in cart_ids:
+            if cart_id in totals:
+                self.stats.set_cart(cart_id, *totals[cart_id])
+            else:
+                self.stats.remove_cart(cart_id)
+
+    def _refresh(self, cart_id: int):
+        self._apply(self.shop.get_cart_totals([cart_id]), [cart_id])
+
+    def _touch(self, cart_id: int):
+        with self.touched_lock:
+            if self.touched is not None:
+                self.touched.add(cart_id)
+
+    def _shift(self, cart_id: int, price: float, quantity: int):
+        self._touch(cart_id)
+        if not self.stats.shift_cart(cart_id, price, quantity):
+            self._refresh(cart_id)
+
+    def _set_from_cart(self, cart: Cart):
+        """Итог по строкам возвращенной корзины, с теми же правилами, что у get_cart_totals"""
+        price, quantity = 0.0, 0
+        for item_id, line_quantity in cart.items.items():
+            item = self.shop.get_item(item_id)
+            if item is None:
+                continue
+            quantity += line_quantity
+            if not item.deleted:
+                price += item.price * line_quantity
+        self._touch(cart.id)
+        self.stats.set_cart(cart.id, price, quantity)
+
+    def _refresh_item(self, item_id: int):
+        """Пересчет корзин с товаром после смены его цены или удаления"""
+        totals = self.shop.get_cart_totals(item_id=item_id)
+        self._apply(totals, list(totals))
+
+    def get_cart_stats(self) -> CartStats:
+        return self.stats
+
+    def get_business_metrics(self) -> BusinessMetrics:
+        return self.stats.business_metrics()
+
+    def create_item(self, item_data: CreateItemRequest) -> Item:
+        item = self.shop.create_item(item_data)
+        self.stats.items += 1
+        return item
+
+    def update_item(self, item_id: int, update_data: UpdateItemRequest, expected_version: int = None) -> Item:
+        item = self.shop.update_item(item_id, update_data, expected_version)
+        if item is not None and update_data.price is not None:
+            self._refresh_item(item_id)
+        return item
+
+    def delete_item(self, item_id: int) -> bool:
+        item = self.shop.get_item(item_id)
+        deleted = self.shop.delete_item(item_id)
+        if deleted and item is not None and not item.deleted:
+            self.stats.items -= 1
+            self._refresh_item(item_id)
+        return deleted
+
+    def hard_delete_item(self, item_id: int) -> bool:
+        item = self.shop.get_item(item_id)
+        cart_ids = list(self.shop.get_cart_totals(item_id=item_id))
+        deleted = self.shop.hard_delete_item(item_id)
+        if deleted:
+            if item is not None and not item.deleted:
+                self.stats.items -= 1
+            self._apply(self.shop.get_cart_totals(cart_ids), cart_ids)
+        return deleted
+
+    def create_cart(self) -> Cart:
+        cart = self.shop.create_cart()
+        self._touch(cart.id)
+        self.stats.set_cart(cart.id, 0.0, 0)
+        return cart
+
+    def add_item_to_cart(self, cart_id: int, item_id: int, quantity: int = 1) -> Cart:
+        cart = self.shop.add_item_to_cart(cart_id, item_id, quantity)
+        if cart is not None:
+            # В корзину добавляются только неудаленные товары; None - товар успели удалить совсем
+            item = self.shop.get_item(item_id)
+            if item is None:
+                self._refresh(cart_id)
+            else:
+                self._shift(cart_id, item.price * quantity, quantity)
+        return cart
+
+    def remove_item_from_cart(self, cart_id: int, item_id: int) -> Cart:
+        cart = self.shop.remove_item_from_cart(cart_id, item_id)
+        if cart is not None:
+            self._set_from_cart(cart)
+        return cart
+
+    def update_cart_item_quantity(self, cart_id: int, item_id: int, quantity: int) -> Cart:
+        cart = self.shop.update_cart_item_quantity(cart_id, item_id, quantity)
+        if cart is not None:
+            self._set_from_cart(cart)
+        return cart
+
+    def clear_cart(self, cart_id: int) -> Cart:
+        cart = self.shop.clear_cart(cart_id)
+        if cart is not None:
+            self._touch(cart_id)
+            self.stats.set_cart(cart_id, 0.0, 0)
+        return cart
+
+    def delete_cart(self, cart_id: int) -> bool:
+        deleted = self.shop.delete_cart(cart_id)
+        if deleted:
+            self._touch(cart_id)
+            self.stats.remove_cart(cart_id)
+        return deleted
+
+    def apply_cart_deltas(self, deltas: dict[tuple[int, int], int], synchronous_commit: bool = True) -> int:
+        applied = self.shop.apply_cart_deltas(deltas, synchronous_commit)
+        prices = {}
+        for cart_id, item_id in deltas:
+            if item_id not in prices:
+                item = self.shop.get_item(item_id)
+                prices[item_id] = None if item is None or item.deleted else item.price
+        shifts = {}
+        for (cart_id, item_id), quantity in deltas.items():
+            # Приращения удаленных товаров хранилище не применяет
+            if prices[item_id] is not None:
+                price, total = shifts.get(cart_id, (0.0, 0))
+                shifts[cart_id] = (price + prices[item_id] * quantity, total + quantity)
+        for cart_id, (price, quantity) in shifts.items():
+            self._shift(cart_id, price, quantity)
+        return applied
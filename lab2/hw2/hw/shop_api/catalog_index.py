@@ -0,0 +1,380 @@
+import bisect
+import logging
+import os
+import threading
+from array import array
+
+from prometheus_client import Counter, Gauge
+
+from .models import CreateItemRequest, GetItemsRequest, Item, UpdateItemRequest
+from .replicas import use_primary
+from .storage import DelegatingShop, ShopStorage
+
+
+CATALOG_INDEX_SIZE = Gauge(
+    'app_catalog_index_items',
+    'Non-deleted items held by the in-process price index',
+    multiprocess_mode='livemax'
+)
+CATALOG_INDEX_RELOADS = Counter(
+    'app_catalog_index_reloads_total',
+    'Full reloads of the in-process price index after catalog changes by other workers'
+)
+CATALOG_INDEX_REFRESH_ERRORS = Counter(
+    'app_catalog_index_refresh_errors_total',
+    'Background catalog version checks or reloads of the price index that failed'
+)
+CATALOG_INDEX_HITS = Counter(
+    'app_catalog_index_hits_total',
+    'Catalog pages served from the in-process price index'
+)
+
+LOAD_PAGE_SIZE = 10_000
+
+logger = logging.getLogger(__name__)
+
+
+def encode_cursor(price: float, item_id: int) -> str:
+    return f"{price!r}:{item_id}"
+
+
+def decode_cursor(cursor: str) -> tuple[float, int]:
+    price, _, item_id = cursor.partition(':')
+    return float(price), int(item_id)
+
+
+def next_cursor(items: list[Item], filters: GetItemsRequest) -> str:
+    """Курсор следующей страницы при sort=price; None, если страница последняя"""
+    if filters.sort != 'price' or len(items) < filters.limit:
+        return None
+    return encode_cursor(items[-1].price, items[-1].id)
+
+
+class PriceIndex:
+    """Отсортированный список (price, id) для диапазонных запросов по цене"""
+    __slots__ = ('_keys',)
+
+    def __init__(self, keys: list[tuple[float, int]] = None):
+        self._keys: list[tuple[float, int]] = sorted(keys) if keys is not None else []
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, price: float, item_id: int):
+        bisect.insort(self._keys, (price, item_id))
+
+    def remove(self, price: float, item_id: int):
+        position = bisect.bisect_left(self._keys, (price, item_id))
+        if position < len(self._keys) and self._keys[position] == (price, item_id):
+            del self._keys[position]
+
+    def _bounds(self, min_price: float = None, max_price: float = None, after: tuple[float, int] = None) -> tuple[int, int]:
+        low = 0 if min_price is None else bisect.bisect_left(self._keys, (min_price, -1))
+        if after is not None:
+            low = max(low, bisect.bisect_right(self._keys, after))
+        high = len(self._keys) if max_price is None else bisect.bisect_right(self._keys, (max_price, float('inf')))
+        return low, high
+
+    def range(self, min_price: float = None, max_price: float = None) -> list[int]:
+        low, high = self._bounds(min_price, max_price)
+        return [item_id for _, item_id in self._keys[low:high]]
+
+    def page(self, min_price: float = None, max_price: float = None, after: tuple[float, int] = None,
+             offset: int = 0, limit: int = 10) -> list[int]:
+        """id страницы в порядке (price, id) после ключа after: O(log n + offset + limit)"""
+        low, high = self._bounds(min_price, max_price, after)
+        start = low + offset
+        return [item_id for _, item_id in self._keys[start:min(high, start + limit)]]
+
+    def scan(self, min_price: float = None, max_price: float = None, after: tuple[float, int] = None):
+        """Итератор id по возрастанию (price, id), для фильтрации на лету"""
+        low, high = self._bounds(min_price, max_price, after)
+        for position in range(low, high):
+            yield self._keys[position][1]
+
+
+def trigrams(text: str) -> set[str]:
+    return {text[position:position + 3] for position in range(len(text) - 2)}
+
+
+class NgramIndex:
+    """Триграммный инвертированный индекс названий в нижнем регистре для поиска подстроки.
+
+    Списки id по триграмме хранятся отсортированными массивами: кандидаты
+    на подстроку - пересечение списков всех ее триграмм, его обход идет по
+    самому короткому списку. Переименование только добавляет новые
+    триграммы, старые остаются: кандидаты всегда надо проверять по
+    текущему названию. Для подстрок короче трех символов индекс не помогает.
+    """
+    __slots__ = ('postings',)
+
+    def __init__(self, names=None):
+        self.postings: dict[str, array] = {}
+        for item_id, name in names or ():
+            self.add(item_id, name)
+
+    def add(self, item_id: int, name: str):
+        for gram in trigrams(name.lower()):
+            posting = self.postings.get(gram)
+            if posting is None:
+                self.postings[gram] = array('i', [item_id])
+            elif posting[-1] < item_id:
+                posting.append(item_id)
+            else:
+                position = bisect.bisect_left(posting, item_id)
+                if position == len(posting) or posting[position] != item_id:
+                    posting.insert(position, item_id)
+
+    def _postings(self, needle: str) -> list[array]:
+        grams = trigrams(needle)
+        if not grams:
+            return None
+        return sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+
+    def estimate(self, needle: str) -> int:
+        """Верхняя оценка числа кандидатов; None, если подстрока слишком короткая для индекса"""
+        postings = self._postings(needle)
+        return None if postings is None else len(postings[0])
+
+    def candidates(self, needle: str):
+        """id по возрастанию, в названиях которых могут быть все триграммы needle; None - индекс не применим"""
+        postings = self._postings(needle)
+        if postings is None:
+            return None
+        return self._intersect(postings[0], postings[1:])
+
+    @staticmethod
+    def _intersect(smallest, others):
+        for item_id in smallest:
+            for posting in others:
+                position = bisect.bisect_left(posting, item_id)
+                if position == len(posting) or posting[position] != item_id:
+                    break
+            else:
+                yield item_id
+
+
+# Сколько кандидатов поиска по названию еще выгодно сортировать по цене, а не обходить индекс цен
+SEARCH_SORT_LIMIT = 10_000
+
+
+def search_candidates(index: NgramIndex, needle: str, price_of, filters: GetItemsRequest):
+    """id кандидатов поиска по названию в порядке filters.sort, отфильтрованные по цене и курсору.
+
+    price_of(id) -> цена или None, если товара нет. None вместо результата -
+    индекс не поможет (короткая подстрока или слишком много кандидатов
+    для сортировки по цене), нужен обычный обход с проверкой названия.
+    """
+    estimate = index.estimate(needle)
+    if estimate is None or filters.sort == 'price' and estimate > SEARCH_SORT_LIMIT:
+        return None
+    low = float('-inf') if filters.min_price is None else filters.min_price
+    high = float('inf') if filters.max_price is None else filters.max_price
+    matched = ((item_id, price_of(item_id)) for item_id in index.candidates(needle))
+    matched = ((item_id, price) for item_id, price in matched if price is not None and low <= price <= high)
+    if filters.sort != 'price':
+        return (item_id for item_id, _ in matched)
+    keys = sorted((price, item_id) for item_id, price in matched)
+    if filters.cursor:
+        keys = keys[bisect.bisect_right(keys, decode_cursor(filters.cursor)):]
+    return [item_id for _, item_id in keys]
+
+
+class IndexedCatalogShop(DelegatingShop):
+    """Хранилище, отдающее страницы GET /item?sort=price и поиск по названию из индекса в памяти процесса.
+
+    Индекс держит неудаленные товары: (price, id) в PriceIndex, триграммы
+    названий в NgramIndex (если names=True) и сами Item по id.
+    Свои create/update/delete применяются к индексу сразу и, если между ними
+    и загрузкой не было чужих записей, сдвигают версию загрузки. Изменения других
+    воркеров ловит фоновый поток: раз в refresh_interval он сравнивает версию
+    каталога с той, с которой индекс загружен, и перезагружает индекс целиком.
+    С шиной инвалидации (invalidate) измененные товары перечитываются по id
+    сразу, а проверка версии остается страховкой.
+    """
+
+    def __init__(self, shop: ShopStorage, refresh_interval: float = 1.0, names: bool = True):
+        super().__init__(shop)
+        self.refresh_interval = refresh_interval
+        self.names = names
+        self.lock = threading.Lock()
+        self.price_index = PriceIndex()
+        self.name_index = NgramIndex()
+        self.items: dict[int, Item] = {}
+        self.loaded_version = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, shop: ShopStorage) -> 'IndexedCatalogShop':
+        return cls(shop, refresh_interval=float(os.getenv('CATALOG_INDEX_REFRESH_SECONDS', '1')),
+                   names=os.getenv('CATALOG_INDEX_NAMES', '1') == '1')
+
+    def warm_up(self, connections: int = 5):
+        self.shop.warm_up(connections)
+        self.reload()
+        if self.refresh_interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='catalog-index-refresh', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.shop.close()
+
+    def _run(self):
+        while not self._stopped.wait(self.refresh_interval):
+            self.poll()
+
+    def poll(self) -> bool:
+        """Одна проверка фонового потока: True, если версия каталога разошлась и индекс перезагружен"""
+        try:
+            if self.shop.get_catalog_version() == self.loaded_version:
+                return False
+            self.reload()
+        except Exception:
+            CATALOG_INDEX_REFRESH_ERRORS.inc()
+            logger.exception("Catalog index refresh failed")
+            return False
+        CATALOG_INDEX_RELOADS.inc()
+        return True
+
+    def reload(self):
+        """Полная загрузка keyset-страницами; версия читается до загрузки, чтобы не пропустить изменения"""
+        version = self.shop.get_catalog_version()
+        items = {}
+        cursor = None
+        while True:
+            page = self.shop.get_all_items(GetItemsRequest(sort='price', limit=LOAD_PAGE_SIZE, cursor=cursor))
+            items.update((item.id, item) for item in page)
+            if len(page) < LOAD_PAGE_SIZE:
+                break
+            cursor = encode_cursor(page[-1].price, page[-1].id)
+        price_index = PriceIndex([(item.price, item_id) for item_id, item in items.items()])
+        name_index = NgramIndex(sorted((item_id, item.name) for item_id, item in items.items()) if self.names else None)
+        with self.lock:
+            self.items, self.price_index, self.name_index, self.loaded_version = items, price_index, name_index, version
+            CATALOG_INDEX_SIZE.set(len(items))
+
+    def invalidate(self, item_ids: list[int] = None):
+        """Подписчик InvalidationBus: перечитать товары из primary, None - перезагрузить индекс"""
+        if item_ids is None:
+            self.reload()
+            CATALOG_INDEX_RELOADS.inc()
+            return
+        with use_primary():
+            # Версия читается до товаров: изменения после нее придут следующими сообщениями
+            version = self.shop.get_catalog_version()
+            for item_id in item_ids:
+                item = self.shop.get_item(item_id)
+                if item is None:
+                    self._drop(item_id)
+                else:
+                    self._put(item)
+        with self.lock:
+            if self.loaded_version is not None and version > self.loaded_version:
+                self.loaded_version = version
+
+    def _put(self, item: Item):
+        with self.lock:
+            previous = self.items.get(item.id)
+            if previous is not None and item._version is not None and previous._version is not None \
+                    and previous._version > item._version:
+                return
+            if previous is not None:
+                del self.items[item.id]
+                self.price_index.remove(previous.price, previous.id)
+            if not item.deleted:
+                self.items[item.id] = item
+                self.price_index.add(item.price, item.id)
+                if self.names:
+                    self.name_index.add(item.id, item.name)
+            CATALOG_INDEX_SIZE.set(len(self.items))
+
+    def _advance_after_own_write(self):
+        """Своя запись уже в индексе: если других изменений после загрузки не было, версия сдвигается без перезагрузки"""
+        version = self.shop.get_catalog_version()
+        with self.lock:
+            if self.loaded_version is not None and version == self.loaded_version + 1:
+                self.loaded_version = version
+
+    def _drop(self, item_id: int):
+        with self.lock:
+            previous = self.items.pop(item_id, None)
+            if previous is not None:
+                self.price_index.remove(previous.price, previous.id)
+            CATALOG_INDEX_SIZE.set(len(self.items))
+
+    def _search(self, filters: GetItemsRequest) -> list[Item]:
+        """Страница поиска по названию из NgramIndex; None - индекс не применим"""
+        needle = filters.q.lower()
+        with self.lock:
+            items = self.items
+            candidates = search_candidates(
+                self.name_index, needle, lambda item_id: getattr(items.get(item_id), 'price', None), filters
+            )
+            if candidates is None:
+                return None
+            skip = filters.offset
+            result = []
+            for item_id in candidates:
+                item = items[item_id]
+                if needle not in item.name.lower():
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                result.append(item)
+                if len(result) == filters.limit:
+                    break
+        CATALOG_INDEX_HITS.inc()
+        return result
+
+    def get_catalog_version(self) -> int:
+        """Версия, с которой загружен индекс: по ней же собраны его страницы, и ETag списка не ходит в базу"""
+        with self.lock:
+            version = self.loaded_version
+        return self.shop.get_catalog_version() if version is None else version
+
+    def get_all_items(self, filters: GetItemsRequest = None) -> list[Item]:
+        if filters is None or filters.show_deleted or self.loaded_version is None:
+            return self.shop.get_all_items(filters)
+        if filters.q is not None:
+            items = self._search(filters) if self.names else None
+            return self.shop.get_all_items(filters) if items is None else items
+        if filters.sort != 'price':
+            return self.shop.get_all_items(filters)
+        after = decode_cursor(filters.cursor) if filters.cursor else None
+        with self.lock:
+            item_ids = self.price_index.page(filters.min_price, filters.max_price, after, filters.offset, filters.limit)
+            items = [self.items[item_id] for item_id in item_ids]
+        CATALOG_INDEX_HITS.inc()
+        return items
+
+    def create_item(self, item_data: CreateItemRequest) -> Item:
+        item = self.shop.create_item(item_data)
+        self._put(item)
+        self._advance_after_own_write()
+        return item
+
+    def update_item(self, item_id: int, update_data: UpdateItemRequest, expected_version: int = None) -> Item:
+        item = self.shop.update_item(item_id, update_data, expected_version)
+        if item is not None:
+            self._put(item)
+            self._advance_after_own_write()
+        return item
+
+    def delete_item(self, item_id: int) -> bool:
+        deleted = self.shop.delete_item(item_id)
+        if deleted:
+            self._drop(item_id)
+            self._advance_after_own_write()
+        return deleted
+
+    def hard_delete_item(self, item_id: int) -> bool:
+        deleted = self.shop.hard_delete_item(item_id)
+        if deleted:
+            self._drop(item_id)
+            self._advance_after_own_write()
+        return deleted
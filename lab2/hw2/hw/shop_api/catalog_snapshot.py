@@ -0,0 +1,382 @@
+"""Бинарный снапшот каталога товаров, который воркеры отображают в память через mmap.
+
+    python -m shop_api.catalog_snapshot build catalog.snapshot
+    python -m shop_api.catalog_snapshot info catalog.snapshot
+
+Формат (порядок байт платформы): заголовок SNAPSHOT_HEADER, затем массивы
+ids (q), prices (d), versions (q), by_price (I) - позиции в порядке
+(price, id), name_offsets (I, count + 1 элемент), deleted (B) и таблица
+строк названий в UTF-8. Все массивы читаются через memoryview прямо из
+отображенного файла, поэтому несколько воркеров делят одни страницы
+page cache и ничего не копируют при старте.
+"""
+import argparse
+import bisect
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+
+from prometheus_client import Counter, Gauge
+
+from .catalog_index import LOAD_PAGE_SIZE, decode_cursor, encode_cursor
+from .models import CreateItemRequest, GetItemsRequest, Item, UpdateItemRequest, items_from_rows
+from .replicas import use_primary
+from .storage import DelegatingShop, ShopStorage
+
+
+logger = logging.getLogger(__name__)
+
+CATALOG_SNAPSHOT_AGE = Gauge(
+    'app_catalog_snapshot_age_seconds',
+    'Seconds since the mapped catalog snapshot was written',
+    multiprocess_mode='livemax'
+)
+CATALOG_SNAPSHOT_WARM_SECONDS = Gauge(
+    'app_catalog_snapshot_warm_seconds',
+    'Time from the start of warm-up until the catalog snapshot was mapped',
+    multiprocess_mode='livemax'
+)
+CATALOG_SNAPSHOT_ITEMS = Gauge(
+    'app_catalog_snapshot_items',
+    'Items in the mapped catalog snapshot',
+    multiprocess_mode='livemax'
+)
+CATALOG_SNAPSHOT_LOADS = Counter(
+    'app_catalog_snapshot_loads_total',
+    'Catalog snapshots mapped by source: an existing current file or a fresh build from the database',
+    ['source']
+)
+CATALOG_SNAPSHOT_REFRESH_ERRORS = Counter(
+    'app_catalog_snapshot_refresh_errors_total',
+    'Failed background refreshes of the mapped catalog snapshot'
+)
+CATALOG_SNAPSHOT_HITS = Counter(
+    'app_catalog_snapshot_hits_total',
+    'Catalog reads served from the mapped snapshot',
+    ['method']
+)
+
+SNAPSHOT_MAGIC = b'SHOPCAT1'
+SNAPSHOT_HEADER = struct.Struct('=8sIqdQ')  # magic, count, catalog_version, created_at, names_size
+
+
+def write_snapshot(path: str, items, catalog_version: int, created_at: float = None):
+    """Атомарная запись снапшота: временный файл, fsync и os.replace.
+
+    Уже отображенный старый файл остается валидным у читателей до закрытия.
+    """
+    items = sorted(items, key=lambda item: item.id)
+    ids = array('q', [item.id for item in items])
+    prices = array('d', [item.price for item in items])
+    versions = array('q', [item._version or 1 for item in items])
+    by_price = array('I', sorted(range(len(items)), key=lambda position: (prices[position], ids[position])))
+    deleted = array('B', [item.deleted for item in items])
+    names = bytearray()
+    name_offsets = array('I', [0])
+    for item in items:
+        names += item.name.encode()
+        name_offsets.append(len(names))
+
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(items), catalog_version,
+                                  time.time() if created_at is None else created_at, len(names))
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'wb') as snapshot:
+        snapshot.write(header)
+        for column in (ids, prices, versions, by_price, name_offsets, deleted):
+            column.tofile(snapshot)
+        snapshot.write(names)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(tmp_path, path)
+
+
+class CatalogSnapshot:
+    """Снапшот каталога, отображенный в память только для чтения"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as snapshot:
+            self._mmap = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, self.catalog_version, self.created_at, names_size = SNAPSHOT_HEADER.unpack_from(self._mmap)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        self.path = path
+        self.count = count
+        view = self._view = memoryview(self._mmap)
+        offset = SNAPSHOT_HEADER.size
+        columns = []
+        for code, length in (('q', count), ('d', count), ('q', count), ('I', count), ('I', count + 1), ('B', count)):
+            size = struct.calcsize(code) * length
+            columns.append(view[offset:offset + size].cast(code))
+            offset += size
+        self.ids, self.prices, self.versions, self.by_price, self.name_offsets, self.deleted = columns
+        self.names = view[offset:offset + names_size]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def age(self) -> float:
+        return time.time() - self.created_at
+
+    def position(self, item_id: int) -> int:
+        position = bisect.bisect_left(self.ids, item_id)
+        if position < self.count and self.ids[position] == item_id:
+            return position
+        return None
+
+    def name(self, position: int) -> str:
+        return str(self.names[self.name_offsets[position]:self.name_offsets[position + 1]], 'utf-8')
+
+    def row(self, position: int) -> dict:
+        return {'id': self.ids[position], 'name': self.name(position), 'price': self.prices[position],
+                'deleted': bool(self.deleted[position])}
+
+    def get(self, item_id: int) -> Item:
+        position = self.position(item_id)
+        if position is None:
+            return None
+        item = Item(**self.row(position))
+        item._version = self.versions[position]
+        return item
+
+    def _positions(self, filters: GetItemsRequest):
+        """Позиции в порядке filters.sort, начиная с первой подходящей по нижней границе"""
+        if filters.sort != 'price':
+            return range(self.count)
+        key = lambda position: (self.prices[position], self.ids[position])
+        start = 0 if filters.min_price is None else bisect.bisect_left(self.by_price, (filters.min_price, -1), key=key)
+        if filters.cursor:
+            start = max(start, bisect.bisect_right(self.by_price, decode_cursor(filters.cursor), key=key))
+        return (self.by_price[index] for index in range(start, self.count))
+
+    def page(self, filters: GetItemsRequest) -> list[Item]:
+        """Страница GET /item без поиска по названию: O(log n + просмотренные строки)"""
+        low = float('-inf') if filters.min_price is None else filters.min_price
+        high = float('inf') if filters.max_price is None else filters.max_price
+        skip = filters.offset
+        positions = []
+        for position in self._positions(filters):
+            price = self.prices[position]
+            if price > high and filters.sort == 'price':
+                break
+            if not low <= price <= high or not filters.show_deleted and self.deleted[position]:
+                continue
+            if skip:
+                skip -= 1
+                continue
+            positions.append(position)
+            if len(positions) == filters.limit:
+                break
+        return items_from_rows([self.row(position) for position in positions],
+                               [self.versions[position] for position in positions])
+
+    def close(self):
+        for column in (self.ids, self.prices, self.versions, self.by_price, self.name_offsets, self.deleted,
+                       self.names, self._view):
+            column.release()
+        self._mmap.close()
+
+
+def load_catalog(shop: ShopStorage) -> list[Item]:
+    """Весь каталог с удаленными keyset-страницами по (price, id), как его видит get_all_items"""
+    items = []
+    cursor = None
+    while True:
+        page = shop.get_all_items(GetItemsRequest(sort='price', show_deleted=True, limit=LOAD_PAGE_SIZE, cursor=cursor))
+        items.extend(page)
+        if len(page) < LOAD_PAGE_SIZE:
+            return items
+        cursor = encode_cursor(page[-1].price, page[-1].id)
+
+
+def build_snapshot(shop: ShopStorage, path: str) -> int:
+    """Снапшот текущего каталога; версия читается до загрузки, чтобы не пропустить изменения"""
+    version = shop.get_catalog_version()
+    write_snapshot(path, load_catalog(shop), version)
+    return version
+
+
+class SnapshotCatalogShop(DelegatingShop):
+    """Хранилище, отдающее товары из снапшота каталога, отображенного в память.
+
+    При старте воркер отображает файл, если его версия каталога совпадает с
+    текущей; иначе один воркер (под flock) пересобирает снапшот из базы, а
+    остальные дожидаются его и отображают готовый файл. Свои записи товаров
+    кладутся в overlay поверх снапшота, пока в нем нет нового состояния;
+    списки при непустом overlay идут в базу. Изменения других воркеров ловит
+    фоновый поток: раз в refresh_interval он сравнивает версию каталога и
+    при расхождении подменяет снапшот на свежий; с шиной инвалидации
+    (invalidate) товары, измененные другими воркерами, сразу попадают в overlay.
+    """
+
+    def __init__(self, shop: ShopStorage, path: str, refresh_interval: float = 5.0):
+        super().__init__(shop)
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.snapshot: CatalogSnapshot = None
+        self.overlay: dict[int, Item] = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, shop: ShopStorage) -> 'SnapshotCatalogShop':
+        return cls(shop, path=os.getenv('CATALOG_SNAPSHOT_PATH', 'catalog.snapshot'),
+                   refresh_interval=float(os.getenv('CATALOG_SNAPSHOT_REFRESH_SECONDS', '5')))
+
+    def warm_up(self, connections: int = 5):
+        started = time.perf_counter()
+        self.shop.warm_up(connections)
+        self.refresh()
+        CATALOG_SNAPSHOT_WARM_SECONDS.set(time.perf_counter() - started)
+        if self.refresh_interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='catalog-snapshot-refresh', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.shop.close()
+
+    def _run(self):
+        while not self._stopped.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:
+                # Воркер продолжает отвечать из прежнего снапшота; возраст растет в app_catalog_snapshot_age_seconds
+                CATALOG_SNAPSHOT_REFRESH_ERRORS.inc()
+                logger.exception("Catalog snapshot refresh failed")
+
+    def _current_file(self, version: int) -> CatalogSnapshot:
+        if not os.path.exists(self.path):
+            return None
+        snapshot = CatalogSnapshot(self.path)
+        if snapshot.catalog_version != version:
+            snapshot.close()
+            return None
+        return snapshot
+
+    def refresh(self):
+        """Отобразить снапшот текущей версии каталога, при необходимости пересобрав файл"""
+        version = self.shop.get_catalog_version()
+        if self.snapshot is None or self.snapshot.catalog_version != version:
+            # Файл пересобирает один воркер, остальные ждут блокировку и берут готовый
+            with open(f"{self.path}.lock", 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    snapshot = self._current_file(version)
+                    source = 'file'
+                    if snapshot is None:
+                        build_snapshot(self.shop, self.path)
+                        snapshot = CatalogSnapshot(self.path)
+                        source = 'built'
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            self._swap(snapshot)
+            CATALOG_SNAPSHOT_LOADS.labels(source).inc()
+        CATALOG_SNAPSHOT_AGE.set(self.snapshot.age())
+
+    def _swap(self, snapshot: CatalogSnapshot):
+        with self.lock:
+            # Из overlay уходят записи, которые уже видны в новом снапшоте
+            for item_id, item in list(self.overlay.items()):
+                position = snapshot.position(item_id)
+                if item is None and position is None or \
+                        item is not None and position is not None and snapshot.versions[position] >= (item._version or 1):
+                    del self.overlay[item_id]
+            # Старый снапшот не закрываем: его memoryview могут быть в работе у других потоков
+            self.snapshot = snapshot
+            CATALOG_SNAPSHOT_ITEMS.set(len(snapshot))
+
+    def get_item(self, item_id: int) -> Item:
+        with self.lock:
+            if item_id in self.overlay:
+                return self.overlay[item_id]
+            snapshot = self.snapshot
+        item = snapshot.get(item_id) if snapshot is not None else None
+        if item is None:
+            # Товар мог появиться у другого воркера после снапшота
+            return self.shop.get_item(item_id)
+        CATALOG_SNAPSHOT_HITS.labels('get_item').inc()
+        return item
+
+    def get_item_version(self, item_id: int) -> int:
+        item = self.get_item(item_id)
+        return item._version if item is not None else None
+
+    def get_all_items(self, filters: GetItemsRequest = None) -> list[Item]:
+        with self.lock:
+            snapshot = self.snapshot if not self.overlay else None
+        if filters is None or filters.q is not None or snapshot is None:
+            return self.shop.get_all_items(filters)
+        CATALOG_SNAPSHOT_HITS.labels('get_all_items').inc()
+        return snapshot.page(filters)
+
+    def invalidate(self, item_ids: list[int] = None):
+        """Подписчик InvalidationBus: свежие товары из primary в overlay, None - сверить снапшот с базой"""
+        if item_ids is None:
+            self.refresh()
+            return
+        with use_primary():
+            for item_id in item_ids:
+                self._remember(item_id, self.shop.get_item(item_id))
+
+    def _remember(self, item_id: int, item: Item):
+        with self.lock:
+            self.overlay[item_id] = item
+
+    def create_item(self, item_data: CreateItemRequest) -> Item:
+        item = self.shop.create_item(item_data)
+        self._remember(item.id, item)
+        return item
+
+    def update_item(self, item_id: int, update_data: UpdateItemRequest, expected_version: int = None) -> Item:
+        item = self.shop.update_item(item_id, update_data, expected_version)
+        if item is not None:
+            self._remember(item_id, item)
+        return item
+
+    def delete_item(self, item_id: int) -> bool:
+        deleted = self.shop.delete_item(item_id)
+        if deleted:
+            self._remember(item_id, self.shop.get_item(item_id))
+        return deleted
+
+    def hard_delete_item(self, item_id: int) -> bool:
+        deleted = self.shop.hard_delete_item(item_id)
+        if deleted:
+            self._remember(item_id, None)
+        return deleted
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Build or inspect the binary catalog snapshot')
+    parser.add_argument('command', choices=['build', 'info'])
+    parser.add_argument('path', nargs='?', default=os.getenv('CATALOG_SNAPSHOT_PATH', 'catalog.snapshot'))
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        from .storage import create_shop
+        shop = create_shop()
+        try:
+            version = build_snapshot(shop, args.path)
+        finally:
+            shop.close()
+        print(f"{args.path}: catalog version {version}")
+        return 0
+
+    snapshot = CatalogSnapshot(args.path)
+    print(f"{args.path}: {len(snapshot)} items, catalog version {snapshot.catalog_version}, "
+          f"age {snapshot.age():.1f}s, {os.path.getsize(args.path)} bytes")
+    snapshot.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""Перенос давно удаленных товаров из items в items_archive.
+
+    python -m shop_api.compaction --retention-days 365 --batch-size 500
+
+Хранилище строится как в приложении (create_storage), поэтому id каждой
+перенесенной пачки публикуются в шину INVALIDATION_BUS после ее COMMIT, и
+кеши каталога в воркерах выбрасывают архивные товары.
+"""
+import argparse
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+
+from prometheus_client import Counter, Histogram
+
+from .database import Shop
+from .storage import create_storage
+
+
+COMPACTION_ROWS = Counter(
+    'app_catalog_compaction_rows_total',
+    'Deleted items moved from items to items_archive'
+)
+COMPACTION_DURATION = Histogram(
+    'app_catalog_compaction_duration_seconds',
+    'Duration of one catalog compaction run',
+    buckets=[0.1, 0.5, 1, 5, 10, 30, 60, 300, 900]
+)
+
+
+class CompactionResult(NamedTuple):
+    moved: int
+    batches: int
+    seconds: float
+
+
+def compact(shop: Shop, retention: timedelta, batch_size: int = 500, pause: float = 0.0,
+            max_batches: int = None) -> CompactionResult:
+    """Переносит пачками, пока есть что переносить; между пачками спит pause секунд"""
+    deleted_before = datetime.now(timezone.utc) - retention
+    started = time.perf_counter()
+    moved = batches = 0
+    while max_batches is None or batches < max_batches:
+        count = len(shop.archive_deleted_items(deleted_before, batch_size))
+        if count == 0:
+            break
+        moved += count
+        batches += 1
+        COMPACTION_ROWS.inc(count)
+        if count < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    seconds = time.perf_counter() - started
+    COMPACTION_DURATION.observe(seconds)
+    return CompactionResult(moved=moved, batches=batches, seconds=seconds)
+
+
+def main(argv: list[str] = None) -> CompactionResult:
+    parser = argparse.ArgumentParser(description='Move long-deleted items to items_archive')
+    parser.add_argument('--retention-days', type=float, default=float(os.getenv('CATALOG_RETENTION_DAYS', '365')))
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--pause', type=float, default=0.05, help='seconds to sleep between batches')
+    parser.add_argument('--max-batches', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    # Та же реализация, что у приложения: с CART_STORAGE=events товары корзин ищутся в журнале
+    shop = create_storage()
+    if not hasattr(shop, 'archive_deleted_items'):
+        shop.close()
+        parser.error("compaction requires the sql backend")
+    try:
+        result = compact(shop, timedelta(days=args.retention_days), args.batch_size, args.pause, args.max_batches)
+    finally:
+        shop.close()
+    print(f"moved {result.moved} items in {result.batches} batches, {result.seconds:.2f}s")
+    return result
+
+
+if __name__ == "__main__":
+    main()
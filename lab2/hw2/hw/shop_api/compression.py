@@ -0,0 +1,299 @@
+import os
+import time
+import zlib
+
+from prometheus_client import Counter, Histogram
+
+from .conditional import encoded_etag
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSION_RATIO = Histogram(
+    'app_response_compression_ratio',
+    'Compressed to original body size of compressed responses',
+    ['encoding'],
+    buckets=[0.02, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0]
+)
+COMPRESSION_CPU_SECONDS = Histogram(
+    'app_response_compression_cpu_seconds',
+    'CPU time spent compressing one response body',
+    ['encoding'],
+    buckets=[0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1]
+)
+COMPRESSION_BYTES = Counter(
+    'app_response_compression_bytes_total',
+    'Response body bytes before and after compression',
+    ['encoding', 'stage']
+)
+COMPRESSION_SKIPPED = Counter(
+    'app_response_compression_skipped_total',
+    'Responses sent uncompressed, by reason',
+    ['reason']
+)
+
+# Не сжимаем то, что уже сжато, и бинарные форматы
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/', 'application/javascript',
+                      'application/xml', 'application/openmetrics-text')
+
+
+class GzipCompressor:
+    def __init__(self, level: int):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        """Отдает все накопленное, не закрывая поток: для StreamingResponse"""
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    def __init__(self, level: int):
+        # У brotli уровни 0-11, у gzip 1-9: переносим ту же долю шкалы
+        self.compressor = brotli.Compressor(quality=min(11, round(level * 11 / 9)))
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush()
+
+    def finish(self) -> bytes:
+        return self.compressor.finish()
+
+
+class ZstdCompressor:
+    def __init__(self, level: int):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+def available_encodings() -> dict:
+    """Кодировки в порядке предпочтения сервера; brotli и zstd - если установлены"""
+    encodings = {}
+    if zstandard is not None:
+        encodings['zstd'] = ZstdCompressor
+    if brotli is not None:
+        encodings['br'] = BrotliCompressor
+    encodings['gzip'] = GzipCompressor
+    return encodings
+
+
+def parse_accept_encoding(header: str) -> dict[str, float]:
+    """'gzip;q=0.8, br' -> {'gzip': 0.8, 'br': 1.0}"""
+    weights = {}
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding] = q
+    return weights
+
+
+def negotiate(header: str, encodings) -> str:
+    """Лучшая из encodings по q клиента, при равенстве - по порядку сервера; None - без сжатия"""
+    weights = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class CompressionMiddleware:
+    """ASGI-middleware, сжимающее тела ответов по Accept-Encoding.
+
+    Ответ с известной длиной (Content-Length или единственное сообщение body)
+    сжимается целиком, только если он не меньше minimum_size. Потоковый ответ
+    без Content-Length сжимается по частям: каждая часть сбрасывается flush,
+    чтобы клиент получал данные сразу.
+    Сильный ETag сжатого ответа получает суффикс кодировки (conditional.encoded_etag),
+    HEAD-запросы не сжимаются.
+    Работает на уровне ASGI-сообщений и не буферизует потоковые ответы,
+    в отличие от BaseHTTPMiddleware.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, level: int = 6, encodings: list[str] = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        compressors = available_encodings()
+        if encodings is not None:
+            compressors = {encoding: compressors[encoding] for encoding in encodings if encoding in compressors}
+        self.compressors = compressors
+
+    @classmethod
+    def options_from_env(cls) -> dict:
+        encodings = os.getenv('COMPRESSION_ENCODINGS')
+        return {
+            'minimum_size': int(os.getenv('COMPRESSION_MIN_SIZE', '1024')),
+            'level': int(os.getenv('COMPRESSION_LEVEL', '6')),
+            'encodings': [encoding.strip() for encoding in encodings.split(',')] if encodings else None,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        accept = ''
+        for name, value in scope['headers']:
+            if name == b'accept-encoding':
+                accept = value.decode('latin-1')
+                break
+        encoding = negotiate(accept, self.compressors) if accept else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        if scope['method'] == 'HEAD':
+            # Тела нет: сжатие отдало бы Content-Length пустого gzip-потока вместо длины GET-ответа
+            COMPRESSION_SKIPPED.labels('head').inc()
+            await self.app(scope, receive, send)
+            return
+        responder = CompressionResponder(self, encoding, send)
+        await self.app(scope, receive, responder.send)
+
+
+class CompressionResponder:
+    """Состояние одного ответа: решение о сжатии принимается по первому сообщению body"""
+
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self._send = send
+        self.start = None
+        self.compressor = None
+        self.passthrough = False
+        self.streaming = False
+        self.buffer: list[bytes] = []
+        self.original_size = 0
+        self.compressed_size = 0
+        self.cpu_seconds = 0.0
+
+    def skip(self, reason: str) -> bool:
+        COMPRESSION_SKIPPED.labels(reason).inc()
+        self.passthrough = True
+        return True
+
+    def should_skip(self, headers: list) -> bool:
+        status = self.start['status']
+        content_type = b''
+        for name, value in headers:
+            if name == b'content-encoding':
+                return self.skip('already_encoded')
+            if name == b'content-type':
+                content_type = value
+        if status < 200 or status in (204, 304):
+            return self.skip('no_body')
+        if not content_type.decode('latin-1').startswith(COMPRESSIBLE_TYPES):
+            return self.skip('content_type')
+        return False
+
+    def _compress(self, data: bytes, final: bool) -> bytes:
+        started = time.thread_time()
+        chunk = self.compressor.compress(data)
+        chunk += self.compressor.finish() if final else self.compressor.flush()
+        self.cpu_seconds += time.thread_time() - started
+        self.original_size += len(data)
+        self.compressed_size += len(chunk)
+        return chunk
+
+    def _observe(self):
+        encoding = self.encoding
+        COMPRESSION_CPU_SECONDS.labels(encoding).observe(self.cpu_seconds)
+        COMPRESSION_BYTES.labels(encoding, 'original').inc(self.original_size)
+        COMPRESSION_BYTES.labels(encoding, 'compressed').inc(self.compressed_size)
+        if self.original_size:
+            COMPRESSION_RATIO.labels(encoding).observe(self.compressed_size / self.original_size)
+
+    def _headers(self, content_length: int = None) -> list:
+        encoding = self.encoding.encode('latin-1')
+        headers = []
+        for name, value in self.start['headers']:
+            if name == b'etag':
+                value = encoded_etag(value.decode('latin-1'), self.encoding).encode('latin-1')
+            if name != b'content-length':
+                headers.append((name, value))
+        headers.append((b'content-encoding', encoding))
+        vary = [value for name, value in headers if name == b'vary']
+        if not any(b'accept-encoding' in value.lower() or value == b'*' for value in vary):
+            headers.append((b'vary', b'Accept-Encoding'))
+        if content_length is not None:
+            headers.append((b'content-length', str(content_length).encode('latin-1')))
+        return headers
+
+    def _content_length(self) -> int:
+        for name, value in self.start['headers']:
+            if name == b'content-length':
+                return int(value)
+        return None
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            self.start = message
+            return
+        if message['type'] != 'http.response.body' or self.passthrough:
+            await self._send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if self.compressor is None:
+            size = self._content_length()
+            if size is None and not more_body:
+                size = len(body)
+            if size is not None and size < self.middleware.minimum_size:
+                self.skip('below_threshold')
+            if self.passthrough or self.should_skip(self.start['headers']):
+                await self._send(self.start)
+                await self._send(message)
+                return
+            self.compressor = self.middleware.compressors[self.encoding](self.middleware.level)
+            self.streaming = size is None
+            if self.streaming:
+                await self._send({**self.start, 'headers': self._headers()})
+
+        if self.streaming:
+            chunk = self._compress(body, final=not more_body)
+            await self._send({'type': 'http.response.body', 'body': chunk, 'more_body': more_body})
+        else:
+            # Длина известна заранее (в том числе когда BaseHTTPMiddleware режет тело на части):
+            # копим тело и отдаем одним куском с точным Content-Length
+            self.buffer.append(body)
+            if more_body:
+                return
+            compressed = self._compress(b''.join(self.buffer), final=True)
+            await self._send({**self.start, 'headers': self._headers(len(compressed))})
+            await self._send({'type': 'http.response.body', 'body': compressed})
+        if not more_body:
+            self._observe()
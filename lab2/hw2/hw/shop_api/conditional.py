@@ -0,0 +1,79 @@
+import http
+import re
+import zlib
+
+from fastapi import Response
+from pydantic import BaseModel
+
+
+def item_etag(item_id: int, version: int) -> str:
+    return f'"item-{item_id}-v{version}"' if version is not None else None
+
+
+def cart_etag(cart_id: int, version: str) -> str:
+    return f'"cart-{cart_id}-v{version}"' if version is not None else None
+
+
+def list_etag(resource: str, catalog_version: int, filters: BaseModel) -> str:
+    """ETag страницы списка: версия каталога плюс хеш параметров запроса"""
+    digest = zlib.crc32(filters.model_dump_json().encode()) & 0xffffffff
+    return f'"{resource}-v{catalog_version}-{digest:08x}"'
+
+
+# Суффикс, которым CompressionMiddleware отличает сжатое представление: у разных байтов разные сильные ETag
+_ENCODING_SUFFIX = re.compile(r'-(gzip|br|zstd)"$')
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """ETag сжатого тела; слабые теги и так не обещают побайтового совпадения"""
+    if etag.startswith('W/') or not etag.endswith('"'):
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def representation_etag(tag: str) -> str:
+    """Тег из заголовка запроса без W/ и суффикса сжатия - в том виде, в каком его строит приложение"""
+    return _ENCODING_SUFFIX.sub('"', tag.removeprefix('W/'))
+
+
+def etag_headers(etag: str) -> dict:
+    return {"ETag": etag} if etag is not None else None
+
+
+def not_modified(etag: str) -> Response:
+    """304 без тела: ответ не строится и не сериализуется"""
+    return Response(status_code=http.HTTPStatus.NOT_MODIFIED, headers=etag_headers(etag))
+
+
+def _etags(header: str) -> list[str]:
+    return [tag.strip() for tag in header.split(',') if tag.strip()]
+
+
+def none_match(header: str, etag: str) -> bool:
+    """If-None-Match совпал: клиенту можно ответить 304 (слабое сравнение)"""
+    if not header or etag is None:
+        return False
+    for tag in _etags(header):
+        if tag == '*' or representation_etag(tag) == etag:
+            return True
+    return False
+
+
+_ITEM_ETAG = re.compile(r'^"item-(\d+)-v(\d+)"$')
+
+
+def if_match_version(header: str, item_id: int):
+    """Версия товара из If-Match.
+
+    Возвращает None, если заголовка нет или он равен `*`, и -1, если ни один
+    тег не относится к этому товару: такая версия никогда не совпадет.
+    """
+    if not header:
+        return None
+    for tag in _etags(header):
+        if tag == '*':
+            return None
+        match = _ITEM_ETAG.match(representation_etag(tag))
+        if match and int(match.group(1)) == item_id:
+            return int(match.group(2))
+    return -1
@@ -1,55 +1,218 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from .db_models import Base, CartDB, CartItemDB, ItemDB
-from .models import Cart, CreateItemRequest, GetCartsRequest, GetItemsRequest, Item, UpdateItemRequest
+from datetime import datetime, timezone
+from sqlalchemy import and_, case, create_engine, delete, event, func, insert, literal, or_, select, text, union_all
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import selectinload, sessionmaker
+from .catalog_index import decode_cursor
+from .db_models import ArchivedItemDB, Base, CartDB, CartItemDB, CounterDB, ItemDB
+from .query_metrics import instrument_engine
+from .models import (
+    Cart, CartResponse, CreateItemRequest, GetCartsRequest, GetItemsRequest, Item, UpdateItemRequest, items_from_rows,
+)
+from .replicas import Replica, ReplicaSet, primary_required
+from .storage import BusinessMetrics, ShopStorage, VersionConflict
+from .transactions import CART_WRITE, CATALOG_WRITE, READ, TransactionPolicy, current_isolation, transactional
 import os
 from sqlalchemy.orm import Session
 
 class Database:
-    def __init__(self):
+    def __init__(self, url: str = None, replica_urls: list[str] = None):
         self.db_host = os.getenv('DB_HOST', 'db')
         self.db_port = os.getenv('DB_PORT', '5432')
         self.db_name = os.getenv('DB_NAME', 'myshop')
         self.db_user = os.getenv('DB_USER', 'user')
         self.db_password = os.getenv('DB_PASSWORD', 'password')
         
-        self.database_url = f"postgresql://{self.db_user}:{self.db_password}@{self.db_host}:{self.db_port}/{self.db_name}"
-        self.engine = create_engine(self.database_url)
+        self.pool_size = int(os.getenv('DB_POOL_SIZE', '5'))
+        self.max_overflow = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+        
+        self.database_url = url or os.getenv(
+            'DATABASE_URL',
+            f"postgresql+psycopg2://{self.db_user}:{self.db_password}@{self.db_host}:{self.db_port}/{self.db_name}"
+        )
+        self.engine = self.create_engine(self.database_url)
         self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        
+        if replica_urls is None:
+            replica_urls = [url.strip() for url in os.getenv('DB_REPLICA_URLS', '').split(',') if url.strip()]
+        self.replicas = ReplicaSet(
+            [self.create_replica(url) for url in replica_urls],
+            eject_seconds=float(os.getenv('DB_REPLICA_EJECT_SECONDS', '30')),
+        )
+    
+    def create_replica(self, url: str) -> Replica:
+        engine = self.create_engine(url)
+        return Replica(url, engine, sessionmaker(autocommit=False, autoflush=False, bind=engine))
+    
+    def create_engine(self, url: str):
+        if make_url(url).get_backend_name() == 'sqlite':
+            engine = create_engine(url, connect_args={'check_same_thread': False})
+            event.listen(engine, 'connect', unicode_lower)
+        else:
+            engine = create_engine(
+                url,
+                pool_size=self.pool_size,
+                max_overflow=self.max_overflow,
+                pool_pre_ping=True,
+            )
+        instrument_engine(engine)
+        return engine
     
     def create_tables(self):
         Base.metadata.create_all(bind=self.engine)
     
-    def get_session(self):
-        return self.SessionLocal()
+    def get_session(self, read_only: bool = False):
+        """Сессия в primary; только читающие операции могут уйти на реплику"""
+        if read_only and not primary_required():
+            replica = self.replicas.pick()
+            while replica is not None:
+                session = replica.session_factory()
+                try:
+                    session.connection(execution_options=self.isolation_options(session))
+                    return session
+                except OperationalError:
+                    session.close()
+                    self.replicas.eject(replica)
+                    replica = self.replicas.pick()
+        session = self.SessionLocal()
+        options = self.isolation_options(session)
+        if options:
+            session.connection(execution_options=options)
+        return session
     
+    def isolation_options(self, session: Session) -> dict:
+        """Уровень изоляции текущей операции. SQLite и так сериализует запись блокировкой файла, поэтому только Postgres"""
+        level = current_isolation()
+        if level is None or session.get_bind().dialect.name != 'postgresql':
+            return {}
+        return {'isolation_level': level}
+    
+    def warm_up(self, connections: int):
+        """Заранее открываем соединения пула, чтобы первые запросы не ждали connect()"""
+        for engine in [self.engine] + [replica.engine for replica in self.replicas.replicas]:
+            opened = []
+            try:
+                for _ in range(connections):
+                    connection = engine.connect()
+                    connection.execute(text("SELECT 1"))
+                    opened.append(connection)
+            except Exception:
+                if engine is self.engine:
+                    raise
+            finally:
+                for connection in opened:
+                    connection.close()
+    
+    def ping(self) -> bool:
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            return True
+        except Exception:
+            return False
+    
+    def dispose(self):
+        self.engine.dispose()
+        self.replicas.dispose()
+    
+
+CATALOG_COUNTER = 'catalog'
+
+
+def unicode_lower(connection, _record):
+    """Встроенный lower() в SQLite меняет регистр только у ASCII: заменяем его на str.lower,
+    иначе поиск «мол» не находит «Молоко»"""
+    connection.create_function('lower', 1, lambda value: value.lower() if isinstance(value, str) else value,
+                               deterministic=True)
+
+
+def after_cursor(price, item_id, cursor: str):
+    """Keyset-условие (price, id) > курсора; без row values, чтобы работало и в SQLite"""
+    cursor_price, cursor_id = decode_cursor(cursor)
+    return or_(price > cursor_price, and_(price == cursor_price, item_id > cursor_id))
 
-class Shop:
-    def __init__(self):
-        self.db = Database()
+
+def name_matches(name, q: str):
+    """Подстрока без учета регистра: ILIKE в Postgres (индекс ix_items_name_trgm), lower() LIKE в SQLite
+    (lower там - str.lower, см. unicode_lower)"""
+    escaped = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return name.ilike(f"%{escaped}%", escape='\\')
+
+
+class Shop(ShopStorage):
+    def __init__(self, database_url: str = None, replica_urls: list[str] = None):
+        self.db = Database(database_url, replica_urls)
+        self.transactions = TransactionPolicy.from_env()
+        # InvalidationBus для кешей каталога в других воркерах; задается в create_shop
+        self.bus = None
         self.db.create_tables()
+        self._ensure_counter(CATALOG_COUNTER)
+    
+    def _ensure_counter(self, name: str):
+        session = self.db.get_session()
+        try:
+            if session.get(CounterDB, name) is None:
+                session.add(CounterDB(name=name, value=0))
+                session.commit()
+        except IntegrityError:
+            session.rollback()
+        finally:
+            session.close()
     
+    def _bump_catalog_version(self, session: Session, item_ids: list[int]):
+        session.query(CounterDB).filter(CounterDB.name == CATALOG_COUNTER).update(
+            {CounterDB.value: CounterDB.value + 1}, synchronize_session=False
+        )
+        if self.bus is not None:
+            self.bus.publish(session, item_ids)
+    
+    def _bump_cart_version(self, session: Session, cart_id: int):
+        session.query(CartDB).filter(CartDB.id == cart_id).update(
+            {CartDB.version: CartDB.version + 1}, synchronize_session=False
+        )
+    
+    def warm_up(self, connections: int = 5):
+        """Прогрев пула и кэша скомпилированных запросов для горячих чтений"""
+        self.db.warm_up(connections)
+        if self.bus is not None:
+            self.bus.start()
+        self.get_all_items(GetItemsRequest())
+        self.get_cart_responses(GetCartsRequest())
+    
+    def ping(self) -> bool:
+        return self.db.ping()
+    
+    def close(self):
+        if self.bus is not None:
+            self.bus.close()
+        self.db.dispose()
+    
+    @transactional(CATALOG_WRITE)
     def create_item(self, item_data: CreateItemRequest) -> Item:
         session = self.db.get_session()
         try:
             item_db = ItemDB(name=item_data.name, price=item_data.price)
             session.add(item_db)
+            session.flush()
+            self._bump_catalog_version(session, [item_db.id])
             session.commit()
             session.refresh(item_db)
             return item_db.to_pydantic()
         finally:
             session.close()
     
+    @transactional(READ)
     def get_item(self, item_id: int) -> Item:
-        session = self.db.get_session()
+        session = self.db.get_session(read_only=True)
         try:
             item_db = session.query(ItemDB).filter(ItemDB.id == item_id).first()
             return item_db.to_pydantic() if item_db else None
         finally:
             session.close()
     
+    @transactional(READ)
     def get_all_items(self, filters: GetItemsRequest = None) -> list[Item]:
-        session = self.db.get_session()
+        session = self.db.get_session(read_only=True)
         try:
             query = session.query(ItemDB)
             
@@ -62,30 +225,91 @@ class Shop:
                 
                 if filters.max_price is not None:
                     query = query.filter(ItemDB.price <= filters.max_price)
+                
+                if filters.q is not None:
+                    query = query.filter(name_matches(ItemDB.name, filters.q))
+            
+            if not filters or filters.show_deleted:
+                return self._items_with_archive(session, filters)
             
-            items_db = query.offset(filters.offset if filters else 0).limit(filters.limit if filters else 10).all()
-            return [item_db.to_pydantic() for item_db in items_db]
+            if filters.sort == 'price':
+                if filters.cursor:
+                    query = query.filter(after_cursor(ItemDB.price, ItemDB.id, filters.cursor))
+                query = query.order_by(ItemDB.price, ItemDB.id)
+            else:
+                query = query.order_by(ItemDB.id)
+            items_db = query.offset(filters.offset).limit(filters.limit).all()
+            return items_from_rows(
+                [{'id': item_db.id, 'name': item_db.name, 'price': item_db.price, 'deleted': item_db.deleted}
+                 for item_db in items_db],
+                [item_db.version for item_db in items_db],
+            )
         finally:
             session.close()
     
-    def update_item(self, item_id: int, update_data: UpdateItemRequest) -> Item:
+    def _items_with_archive(self, session: Session, filters: GetItemsRequest = None) -> list[Item]:
+        """show_deleted: живые товары и архив одним UNION ALL, порядок по id как у обычного списка"""
+        live = select(ItemDB.id, ItemDB.name, ItemDB.price, ItemDB.deleted, ItemDB.version)
+        archived = select(
+            ArchivedItemDB.id, ArchivedItemDB.name, ArchivedItemDB.price,
+            literal(True).label('deleted'), ArchivedItemDB.version
+        )
+        if filters and filters.min_price is not None:
+            live = live.where(ItemDB.price >= filters.min_price)
+            archived = archived.where(ArchivedItemDB.price >= filters.min_price)
+        if filters and filters.max_price is not None:
+            live = live.where(ItemDB.price <= filters.max_price)
+            archived = archived.where(ArchivedItemDB.price <= filters.max_price)
+        if filters and filters.q is not None:
+            live = live.where(name_matches(ItemDB.name, filters.q))
+            archived = archived.where(name_matches(ArchivedItemDB.name, filters.q))
+        
+        catalog = union_all(live, archived).subquery()
+        query = select(catalog).order_by(catalog.c.id)
+        if filters and filters.sort == 'price':
+            query = select(catalog).order_by(catalog.c.price, catalog.c.id)
+            if filters.cursor:
+                query = query.where(after_cursor(catalog.c.price, catalog.c.id, filters.cursor))
+        rows = session.execute(
+            query
+            .offset(filters.offset if filters else 0)
+            .limit(filters.limit if filters else 10)
+        )
+        rows = rows.all()
+        return items_from_rows(
+            [{'id': row.id, 'name': row.name, 'price': row.price, 'deleted': bool(row.deleted)} for row in rows],
+            [row.version for row in rows],
+        )
+    
+    @transactional(CATALOG_WRITE)
+    def update_item(self, item_id: int, update_data: UpdateItemRequest, expected_version: int = None) -> Item:
         session = self.db.get_session()
         try:
-            item_db = session.query(ItemDB).filter(ItemDB.id == item_id).first()
-            if not item_db:
-                return None
-            
+            values = {ItemDB.version: ItemDB.version + 1}
             if update_data.name is not None:
-                item_db.name = update_data.name
+                values[ItemDB.name] = update_data.name
             if update_data.price is not None:
-                item_db.price = update_data.price
+                values[ItemDB.price] = update_data.price
+            
+            query = session.query(ItemDB).filter(ItemDB.id == item_id)
+            if expected_version is not None:
+                query = query.filter(ItemDB.version == expected_version)
             
+            if query.update(values, synchronize_session=False) == 0:
+                session.rollback()
+                current_version = session.query(ItemDB.version).filter(ItemDB.id == item_id).scalar()
+                if current_version is None:
+                    return None
+                raise VersionConflict(item_id, current_version)
+            
+            self._bump_catalog_version(session, [item_id])
             session.commit()
-            session.refresh(item_db)
+            item_db = session.query(ItemDB).filter(ItemDB.id == item_id).first()
             return item_db.to_pydantic()
         finally:
             session.close()
     
+    @transactional(CATALOG_WRITE)
     def delete_item(self, item_id: int) -> bool:
         session = self.db.get_session()
         try:
@@ -94,11 +318,15 @@ class Shop:
                 return False
             
             item_db.deleted = True
+            item_db.deleted_at = datetime.now(timezone.utc)
+            item_db.version = ItemDB.version + 1
+            self._bump_catalog_version(session, [item_id])
             session.commit()
             return True
         finally:
             session.close()
     
+    @transactional(CATALOG_WRITE)
     def hard_delete_item(self, item_id: int) -> bool:
         session = self.db.get_session()
         try:
@@ -107,16 +335,19 @@ class Shop:
                 return False
             
             session.delete(item_db)
+            self._bump_catalog_version(session, [item_id])
             session.commit()
             return True
         finally:
             session.close()
     
     
-    def create_cart(self) -> Cart:
+    @transactional(CART_WRITE)
+    def create_cart(self, cart_id: int = None) -> Cart:
+        """cart_id задается при шардировании: id выдает общий счетчик, а не автоинкремент шарда"""
         session = self.db.get_session()
         try:
-            cart_db = CartDB()
+            cart_db = CartDB(id=cart_id)
             session.add(cart_db)
             session.commit()
             session.refresh(cart_db)
@@ -124,25 +355,27 @@ class Shop:
         finally:
             session.close()
     
+    @transactional(READ)
     def get_cart(self, cart_id: int) -> Cart:
-        session = self.db.get_session()
+        session = self.db.get_session(read_only=True)
         try:
             cart_db = session.query(CartDB).filter(CartDB.id == cart_id).first()
             return cart_db.to_pydantic() if cart_db else None
         finally:
             session.close()
     
+    @transactional(READ)
     def get_all_carts(self, filters: GetCartsRequest = None) -> list[Cart]:
-        session = self.db.get_session()
+        session = self.db.get_session(read_only=True)
         try:
-            query = session.query(CartDB)
-
+            query = session.query(CartDB).order_by(CartDB.id)
             
             carts_db = query.offset(filters.offset if filters else 0).limit(filters.limit if filters else 10).all()
             return [cart_db.to_pydantic() for cart_db in carts_db]
         finally:
             session.close()
     
+    @transactional(CART_WRITE)
     def add_item_to_cart(self, cart_id: int, item_id: int, quantity: int = 1) -> Cart:
         session = self.db.get_session()
         try:
@@ -163,12 +396,14 @@ class Shop:
                 cart_item_db = CartItemDB(cart_id=cart_id, item_id=item_id, quantity=quantity)
                 session.add(cart_item_db)
             
+            cart_db.version = CartDB.version + 1
             session.commit()
             session.refresh(cart_db)
             return cart_db.to_pydantic()
         finally:
             session.close()
     
+    @transactional(CART_WRITE)
     def remove_item_from_cart(self, cart_id: int, item_id: int) -> Cart:
         session = self.db.get_session()
         try:
@@ -181,6 +416,7 @@ class Shop:
                 return None
             
             session.delete(cart_item_db)
+            self._bump_cart_version(session, cart_id)
             session.commit()
             
             cart_db = session.query(CartDB).filter(CartDB.id == cart_id).first()
@@ -188,6 +424,7 @@ class Shop:
         finally:
             session.close()
     
+    @transactional(CART_WRITE)
     def update_cart_item_quantity(self, cart_id: int, item_id: int, quantity: int) -> Cart:
         session = self.db.get_session()
         try:
@@ -204,6 +441,7 @@ class Shop:
             else:
                 cart_item_db.quantity = quantity
             
+            self._bump_cart_version(session, cart_id)
             session.commit()
             
             cart_db = session.query(CartDB).filter(CartDB.id == cart_id).first()
@@ -211,6 +449,7 @@ class Shop:
         finally:
             session.close()
     
+    @transactional(CART_WRITE)
     def clear_cart(self, cart_id: int) -> Cart:
         session = self.db.get_session()
         try:
@@ -219,12 +458,14 @@ class Shop:
                 return None
             
             session.query(CartItemDB).filter(CartItemDB.cart_id == cart_id).delete()
+            cart_db.version = CartDB.version + 1
             session.commit()
             session.refresh(cart_db)
             return cart_db.to_pydantic()
         finally:
             session.close()
     
+    @transactional(CART_WRITE)
     def delete_cart(self, cart_id: int) -> bool:
         session = self.db.get_session()
         try:
@@ -238,9 +479,211 @@ class Shop:
         finally:
             session.close()
     
+    @transactional(CART_WRITE)
+    def apply_cart_deltas(self, deltas: dict[tuple[int, int], int], synchronous_commit: bool = True) -> int:
+        """Применить накопленные приращения количеств одной транзакцией"""
+        if not deltas:
+            return 0
+        session = self.db.get_session()
+        try:
+            if not synchronous_commit and session.get_bind().dialect.name == 'postgresql':
+                session.execute(text("SET LOCAL synchronous_commit TO OFF"))
+            
+            cart_ids = {cart_id for cart_id, _ in deltas}
+            item_ids = {item_id for _, item_id in deltas}
+            existing_carts = {row.id for row in session.query(CartDB.id).filter(CartDB.id.in_(cart_ids))}
+            lines = {
+                (line.cart_id, line.item_id): line
+                for line in session.query(CartItemDB).filter(
+                    CartItemDB.cart_id.in_(existing_carts),
+                    CartItemDB.item_id.in_(item_ids)
+                )
+            }
+            
+            applied = 0
+            for (cart_id, item_id), quantity in deltas.items():
+                if cart_id not in existing_carts:
+                    continue
+                line = lines.get((cart_id, item_id))
+                if line:
+                    line.quantity = CartItemDB.quantity + quantity
+                else:
+                    session.add(CartItemDB(cart_id=cart_id, item_id=item_id, quantity=quantity))
+                applied += 1
+            
+            session.query(CartDB).filter(CartDB.id.in_(existing_carts)).update(
+                {CartDB.version: CartDB.version + 1}, synchronize_session=False
+            )
+            session.commit()
+            return applied
+        finally:
+            session.close()
+    
+    @transactional(CART_WRITE)
+    def import_carts(self, carts: list[Cart]) -> int:
+        """Корзины с заданными id и строками одной транзакцией; уже существующие id пропускаются"""
+        if not carts:
+            return 0
+        session = self.db.get_session()
+        try:
+            existing = set(session.scalars(select(CartDB.id).where(CartDB.id.in_([cart.id for cart in carts]))))
+            imported = [cart for cart in carts if cart.id not in existing]
+            for cart in imported:
+                session.add(CartDB(id=cart.id))
+            session.flush()
+            lines = [
+                {'cart_id': cart.id, 'item_id': item_id, 'quantity': quantity}
+                for cart in imported for item_id, quantity in cart.items.items()
+            ]
+            if lines:
+                session.execute(insert(CartItemDB), lines)
+            session.commit()
+            return len(imported)
+        finally:
+            session.close()
+    
+    @transactional(CATALOG_WRITE)
+    def archive_deleted_items(self, deleted_before: datetime, batch_size: int = 500, keep=()) -> list[int]:
+        """Переносит в items_archive одну пачку товаров, удаленных раньше deleted_before.
+        
+        Товары, на которые ссылаются корзины, и товары из keep остаются в
+        items. Пачка - одна короткая транзакция; в Postgres строки берутся
+        с SKIP LOCKED, чтобы не ждать параллельных писателей. Возвращает id
+        перенесенных товаров.
+        """
+        session = self.db.get_session()
+        try:
+            query = select(ItemDB.id).where(
+                ItemDB.deleted == True, ItemDB.deleted_at < deleted_before, ~self._in_carts(ItemDB.id)
+            )
+            if keep:
+                query = query.where(ItemDB.id.notin_(keep))
+            ids = session.scalars(query.order_by(ItemDB.id).limit(batch_size).with_for_update(skip_locked=True)).all()
+            self._archive(session, ids)
+            return ids
+        finally:
+            session.close()
+    
+    @transactional(CATALOG_WRITE)
+    def archive_items(self, item_ids: list[int]) -> list[int]:
+        """Переносит в items_archive удаленные товары item_ids, если на них не ссылаются корзины"""
+        session = self.db.get_session()
+        try:
+            ids = session.scalars(
+                select(ItemDB.id)
+                .where(ItemDB.id.in_(item_ids), ItemDB.deleted == True, ~self._in_carts(ItemDB.id))
+                .order_by(ItemDB.id)
+                .with_for_update(skip_locked=True)
+            ).all()
+            self._archive(session, ids)
+            return ids
+        finally:
+            session.close()
+    
+    def _archive(self, session, ids: list[int]):
+        if not ids:
+            return
+        session.execute(insert(ArchivedItemDB).from_select(
+            ['id', 'name', 'price', 'version', 'created_at', 'deleted_at', 'archived_at'],
+            select(
+                ItemDB.id, ItemDB.name, ItemDB.price, ItemDB.version, ItemDB.created_at, ItemDB.deleted_at,
+                literal(datetime.now(timezone.utc), type_=ArchivedItemDB.archived_at.type)
+            ).where(ItemDB.id.in_(ids))
+        ))
+        session.execute(delete(ItemDB).where(ItemDB.id.in_(ids)))
+        if self.bus is not None:
+            self.bus.publish(session, ids)
+        session.commit()
+    
+    @transactional(READ)
+    def deleted_items_in_carts(self) -> list[int]:
+        """Удаленные товары, на которые еще ссылаются корзины этой базы (с primary: реплика могла отстать)"""
+        session = self.db.get_session()
+        try:
+            return list(session.scalars(select(ItemDB.id).where(ItemDB.deleted == True, self._in_carts(ItemDB.id))))
+        finally:
+            session.close()
+    
+    @transactional(CART_WRITE)
+    def reserve_ids(self, name: str, count: int) -> int:
+        """Резервирует count следующих значений счетчика name и возвращает первое из них"""
+        self._ensure_counter(name)
+        session = self.db.get_session()
+        try:
+            session.query(CounterDB).filter(CounterDB.name == name).update(
+                {CounterDB.value: CounterDB.value + count}, synchronize_session=False
+            )
+            value = session.query(CounterDB.value).filter(CounterDB.name == name).scalar()
+            session.commit()
+            return value - count + 1
+        finally:
+            session.close()
+    
+    @transactional(CATALOG_WRITE)
+    def replicate_items(self, items: list[Item]) -> int:
+        """Копии товаров общего каталога: новые вставляются, существующие обновляются, только если версия новее"""
+        if not items:
+            return 0
+        session = self.db.get_session()
+        try:
+            existing = dict(session.query(ItemDB.id, ItemDB.version).filter(ItemDB.id.in_([item.id for item in items])))
+            written = 0
+            for item in items:
+                version = item._version or 1
+                values = {'name': item.name, 'price': item.price, 'deleted': item.deleted, 'version': version}
+                if item.id not in existing:
+                    session.add(ItemDB(id=item.id, **values))
+                    written += 1
+                elif existing[item.id] < version:
+                    written += session.query(ItemDB).filter(ItemDB.id == item.id, ItemDB.version < version).update(
+                        values, synchronize_session=False
+                    )
+            session.commit()
+            return written
+        finally:
+            session.close()
+    
+    def _in_carts(self, item_id):
+        """Условие «товар лежит в какой-нибудь корзине» для коррелированного подзапроса"""
+        return select(CartItemDB.id).where(CartItemDB.item_id == item_id).exists()
+    
+    @transactional(READ)
+    def get_item_version(self, item_id: int) -> int:
+        session = self.db.get_session(read_only=True)
+        try:
+            return session.query(ItemDB.version).filter(ItemDB.id == item_id).scalar()
+        finally:
+            session.close()
+    
+    @transactional(READ)
+    def get_cart_version(self, cart_id: int) -> str:
+        """Версия корзины вместе с суммой версий ее товаров: меняется при любом изменении CartResponse"""
+        session = self.db.get_session(read_only=True)
+        try:
+            row = (
+                session.query(CartDB.version, func.coalesce(func.sum(ItemDB.version), 0))
+                .outerjoin(CartItemDB, CartItemDB.cart_id == CartDB.id)
+                .outerjoin(ItemDB, ItemDB.id == CartItemDB.item_id)
+                .filter(CartDB.id == cart_id)
+                .group_by(CartDB.id)
+                .first()
+            )
+            return f"{row[0]}.{row[1]}" if row else None
+        finally:
+            session.close()
+    
+    @transactional(READ)
+    def get_catalog_version(self) -> int:
+        session = self.db.get_session(read_only=True)
+        try:
+            return session.query(CounterDB.value).filter(CounterDB.name == CATALOG_COUNTER).scalar() or 0
+        finally:
+            session.close()
+    
+    @transactional(READ)
     def get_cart_response(self, cart_id: int) -> tuple:
         """Получить CartResponse для корзины"""
-        session = self.db.get_session()
+        session = self.db.get_session(read_only=True)
         try:
             cart_db = session.query(CartDB).filter(CartDB.id == cart_id).first()
             if not cart_db:
@@ -249,12 +692,93 @@ class Shop:
             item_ids = [cart_item.item_id for cart_item in cart_db.items]
             items_db = session.query(ItemDB).filter(ItemDB.id.in_(item_ids)).all()
             
-            items_dict = {item.id: item.to_pydantic() for item in items_db}
+            items_dict = {item.id: item for item in items_db}
             
             return cart_db.create_cart_response(items_dict)
         finally:
             session.close()
     
-    def get_all_items_dict(self) -> dict[int, Item]:
-        items = self.get_all_items()
-        return {item.id: item for item in items}
\ No newline at end of file
+    @transactional(READ)
+    def get_cart_responses(self, filters: GetCartsRequest = None) -> list[CartResponse]:
+        """Страница CartResponse: фильтры и пагинация считаются одним агрегатом в БД"""
+        filters = filters or GetCartsRequest()
+        session = self.db.get_session(read_only=True)
+        try:
+            price = func.coalesce(func.sum(ItemDB.price * CartItemDB.quantity), 0.0)
+            quantity = func.coalesce(func.sum(CartItemDB.quantity), 0)
+            query = (
+                session.query(CartDB.id)
+                .outerjoin(CartItemDB, CartItemDB.cart_id == CartDB.id)
+                .outerjoin(ItemDB, ItemDB.id == CartItemDB.item_id)
+                .group_by(CartDB.id)
+            )
+            
+            if filters.min_price is not None:
+                query = query.having(price >= filters.min_price)
+            if filters.max_price is not None:
+                query = query.having(price <= filters.max_price)
+            if filters.min_quantity is not None:
+                query = query.having(quantity >= filters.min_quantity)
+            if filters.max_quantity is not None:
+                query = query.having(quantity <= filters.max_quantity)
+            
+            cart_ids = [row.id for row in query.order_by(CartDB.id).offset(filters.offset).limit(filters.limit)]
+            if not cart_ids:
+                return []
+            
+            carts_db = (
+                session.query(CartDB)
+                .options(selectinload(CartDB.items).joinedload(CartItemDB.item))
+                .filter(CartDB.id.in_(cart_ids))
+                .order_by(CartDB.id)
+                .all()
+            )
+            responses = []
+            for cart_db in carts_db:
+                items_dict = {cart_item.item_id: cart_item.item for cart_item in cart_db.items}
+                cart_response, _ = cart_db.create_cart_response(items_dict)
+                responses.append(cart_response)
+            return responses
+        finally:
+            session.close()
+    
+    @transactional(READ)
+    def get_cart_totals(self, cart_ids: list[int] = None, item_id: int = None) -> dict[int, tuple[float, int]]:
+        """Итоги корзин одним агрегатом; удаленные товары в цену не входят, как в get_business_metrics"""
+        session = self.db.get_session(read_only=True)
+        try:
+            available_price = case((ItemDB.deleted == False, ItemDB.price * CartItemDB.quantity), else_=0.0)
+            query = (
+                session.query(
+                    CartDB.id,
+                    func.coalesce(func.sum(available_price), 0.0).label('price'),
+                    func.coalesce(func.sum(CartItemDB.quantity), 0).label('quantity'),
+                )
+                .outerjoin(CartItemDB, CartItemDB.cart_id == CartDB.id)
+                .outerjoin(ItemDB, ItemDB.id == CartItemDB.item_id)
+                .group_by(CartDB.id)
+            )
+            if cart_ids is not None:
+                query = query.filter(CartDB.id.in_(cart_ids))
+            if item_id is not None:
+                query = query.filter(CartDB.id.in_(select(CartItemDB.cart_id).where(CartItemDB.item_id == item_id)))
+            return {row.id: (float(row.price), int(row.quantity)) for row in query}
+        finally:
+            session.close()
+    
+    @transactional(READ)
+    def get_business_metrics(self) -> BusinessMetrics:
+        session = self.db.get_session(read_only=True)
+        try:
+            carts_count = session.query(func.count(CartDB.id)).scalar()
+            items_count = session.query(func.count(ItemDB.id)).filter(ItemDB.deleted == False).scalar()
+            cart_price_sum = (
+                session.query(func.coalesce(func.sum(ItemDB.price * CartItemDB.quantity), 0.0))
+                .select_from(CartItemDB)
+                .join(ItemDB, ItemDB.id == CartItemDB.item_id)
+                .filter(ItemDB.deleted == False)
+                .scalar()
+            )
+            return BusinessMetrics(carts=carts_count, items=items_count, cart_price_sum=cart_price_sum)
+        finally:
+            session.close()
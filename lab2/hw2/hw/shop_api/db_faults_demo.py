@@ -1,10 +1,89 @@
 # transaction_demo.py
+import argparse
+import json
+import math
+import random
 import threading
 import time
 from .database import Shop
+from .models import UpdateItemRequest
+from .transactions import CART_WRITE, CATALOG_WRITE, DB_TRANSACTION_RETRIES, ISOLATION_LEVELS, TransactionPolicy, retry_reason
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 
+class StressStats:
+    """Результаты потоков стресс-прогона; пишутся под одной блокировкой"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.write_latencies = []
+        self.read_latencies = []
+        self.adds = {}
+        self.aborts = {}
+        self.read_violations = 0
+    
+    def record_write(self, latency: float, added: int = None):
+        with self.lock:
+            self.write_latencies.append(latency)
+            if added is not None:
+                self.adds[added] = self.adds.get(added, 0) + 1
+    
+    def record_read(self, latency: float, went_back: bool):
+        with self.lock:
+            self.read_latencies.append(latency)
+            self.read_violations += went_back
+    
+    def record_abort(self, reason: str):
+        with self.lock:
+            self.aborts[reason] = self.aborts.get(reason, 0) + 1
+    
+    def report(self, isolation: str, elapsed: float, stored: dict[int, int], duplicate_lines: int, retries: int) -> dict:
+        lost_updates = sum(self.adds.get(cart_id, 0) - quantity for cart_id, quantity in stored.items())
+        return {
+            'isolation': isolation,
+            'committed_ops_per_sec': len(self.write_latencies) / elapsed,
+            'reads_per_sec': len(self.read_latencies) / elapsed,
+            'aborts': sum(self.aborts.values()),
+            'abort_reasons': dict(self.aborts),
+            'retries': retries,
+            'write_p99_ms': p99(self.write_latencies) * 1000,
+            'read_p99_ms': p99(self.read_latencies) * 1000,
+            'successful_adds': sum(self.adds.values()),
+            'lost_updates': lost_updates,
+            'duplicate_lines': duplicate_lines,
+            'read_violations': self.read_violations,
+        }
+
+
+def p99(latencies: list[float]) -> float:
+    if not latencies:
+        return 0.0
+    ordered = sorted(latencies)
+    return ordered[max(0, math.ceil(0.99 * len(ordered)) - 1)]
+
+
+def retries_total() -> float:
+    return sum(
+        sample.value
+        for metric in DB_TRANSACTION_RETRIES.collect()
+        for sample in metric.samples
+        if sample.name.endswith('_total')
+    )
+
+
+def format_stress_table(reports: list[dict]) -> str:
+    columns = ['committed_ops_per_sec', 'aborts', 'retries', 'write_p99_ms', 'read_p99_ms',
+               'lost_updates', 'duplicate_lines', 'read_violations']
+    lines = [f"{'isolation':<18}" + ''.join(f"{column:>22}" for column in columns)]
+    for report in reports:
+        lines.append(f"{report['isolation']:<18}" + ''.join(
+            f"{report[column]:>22.2f}" if isinstance(report[column], float) else f"{report[column]:>22}"
+            for column in columns
+        ))
+    return '\n'.join(lines)
+
+
 class TransactionDemo:
     def __init__(self):
         self.shop = Shop()
@@ -141,6 +220,7 @@ class TransactionDemo:
                 time.sleep(2)
                 
                 count2 = session.execute(text("SELECT COUNT(*) FROM items WHERE deleted = false")).fetchone()[0]
+                print(f"👤 Пользователь: Было товаров {count1}, стало {count2}")
                 
                 session.execute(text("COMMIT"))
                 
@@ -157,15 +237,104 @@ class TransactionDemo:
                 session.execute(text("COMMIT"))
             finally:
                 session.close()
+        
+        t1 = threading.Thread(target=user_browse_products)
+        t2 = threading.Thread(target=admin_add_product)
+        
+        t1.start()
+        t2.start()
+        t1.join()
+        t2.join()
             
-            t1 = threading.Thread(target=user_browse_products)
-            t2 = threading.Thread(target=admin_add_product)
-            
-            t1.start()
-            t2.start()
-            t1.join()
-            t2.join()
-            
+    def stress(self, isolation: str, writers: int = 8, readers: int = 4, duration: float = 5.0,
+               update_share: float = 0.2, retries: bool = True) -> dict:
+        """Нагрузка на add_item_to_cart и update_item при одном уровне изоляции.
+
+        Писатели добавляют товары в две горячие корзины и меняют цены,
+        читатели перечитывают корзины. После прогона сумма количеств в
+        корзинах сравнивается с числом успешных добавлений: разница -
+        потерянные обновления. Читатели проверяют, что количество товаров в
+        корзине не уменьшается между их чтениями: удалений в прогоне нет.
+        """
+        self.setup_test_data()
+        self.shop.transactions = TransactionPolicy(
+            overrides={CART_WRITE: isolation, CATALOG_WRITE: isolation},
+            max_attempts=5 if retries else 1,
+        )
+        cart_ids = [1, 2]
+        item_ids = [1, 2, 3]
+        stats = StressStats()
+        retries_before = retries_total()
+        deadline = time.perf_counter() + duration
+        
+        def writer(seed):
+            rng = random.Random(seed)
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    if rng.random() < update_share:
+                        self.shop.update_item(rng.choice(item_ids), UpdateItemRequest(price=round(rng.uniform(1, 2000), 2)))
+                        stats.record_write(time.perf_counter() - started, added=None)
+                    else:
+                        cart_id = rng.choice(cart_ids)
+                        added = self.shop.add_item_to_cart(cart_id, rng.choice(item_ids)) is not None
+                        stats.record_write(time.perf_counter() - started, added=cart_id if added else None)
+                except DBAPIError as error:
+                    stats.record_abort(retry_reason(error) or type(error.orig).__name__)
+        
+        def reader():
+            last_seen = {}
+            while time.perf_counter() < deadline:
+                cart_id = random.choice(cart_ids)
+                started = time.perf_counter()
+                try:
+                    cart_response, total_quantity = self.shop.get_cart_response(cart_id)
+                except DBAPIError as error:
+                    stats.record_abort(retry_reason(error) or type(error.orig).__name__)
+                    continue
+                stats.record_read(time.perf_counter() - started, went_back=total_quantity < last_seen.get(cart_id, 0))
+                last_seen[cart_id] = total_quantity
+        
+        threads = [threading.Thread(target=writer, args=(seed,)) for seed in range(writers)]
+        threads += [threading.Thread(target=reader) for _ in range(readers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        
+        stored = self.stored_quantities(cart_ids)
+        return stats.report(isolation, elapsed, stored, self.duplicate_lines(), retries_total() - retries_before)
+    
+    def stored_quantities(self, cart_ids: list[int]) -> dict[int, int]:
+        session = self.shop.db.get_session()
+        try:
+            rows = session.execute(text("SELECT cart_id, SUM(quantity) FROM cart_items GROUP BY cart_id")).fetchall()
+            quantities = {cart_id: 0 for cart_id in cart_ids}
+            quantities.update({row[0]: row[1] for row in rows})
+            return quantities
+        finally:
+            session.close()
+    
+    def duplicate_lines(self) -> int:
+        """Строки (cart_id, item_id), вставленные дважды параллельными добавлениями"""
+        session = self.shop.db.get_session()
+        try:
+            return session.execute(text(
+                "SELECT COUNT(*) FROM (SELECT cart_id, item_id FROM cart_items "
+                "GROUP BY cart_id, item_id HAVING COUNT(*) > 1) AS duplicates"
+            )).scalar()
+        finally:
+            session.close()
+    
+    def run_stress(self, levels: list[str], **options) -> list[dict]:
+        reports = [self.stress(level, **options) for level in levels]
+        print(format_stress_table(reports))
+        if self.engine.dialect.name != 'postgresql':
+            print(f"{self.engine.dialect.name} ignores isolation levels: rows differ only by chance")
+        return reports
+    
     def run_all_demos(self):
         print("Демонстрация проблем транзакций")
         
@@ -181,5 +350,29 @@ class TransactionDemo:
         print("Все демонстрации завершены!")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Transaction anomalies demo and concurrency stress test')
+    parser.add_argument('mode', nargs='?', choices=['demo', 'stress'], default='demo')
+    parser.add_argument('--levels', default=','.join(ISOLATION_LEVELS))
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--update-share', type=float, default=0.2)
+    parser.add_argument('--no-retry', action='store_true')
+    parser.add_argument('--json', dest='json_path')
+    args = parser.parse_args()
+    
     demo = TransactionDemo()
-    demo.run_all_demos()
\ No newline at end of file
+    if args.mode == 'demo':
+        demo.run_all_demos()
+    else:
+        reports = demo.run_stress(
+            [level.strip() for level in args.levels.split(',')],
+            writers=args.writers,
+            readers=args.readers,
+            duration=args.duration,
+            update_share=args.update_share,
+            retries=not args.no_retry,
+        )
+        if args.json_path:
+            with open(args.json_path, 'w') as f:
+                json.dump(reports, f, indent=2)
\ No newline at end of file
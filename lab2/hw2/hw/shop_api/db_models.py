@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, ForeignKey
+from sqlalchemy import create_engine, Column, DDL, DateTime, Integer, String, Float, Boolean, ForeignKey, Index, event
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.sql import func
@@ -8,34 +8,68 @@ Base = declarative_base()
 
 class ItemDB(Base):
     __tablename__ = 'items'
+    # id не переиспользуются после удаления: иначе новый товар совпал бы по id с архивным
+    __table_args__ = (
+        Index('ix_items_price_id', 'price', 'id'),
+        # Триграммы для GET /item?q=: ILIKE '%q%' идет по индексу, а не сканом каталога
+        Index(
+            'ix_items_name_trgm', 'name',
+            postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'},
+        ).ddl_if(dialect='postgresql'),
+        {'sqlite_autoincrement': True},
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(100), nullable=False)
     price = Column(Float, nullable=False)
     deleted = Column(Boolean, default=False)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
     created_at = Column(String, default=func.now())
+    deleted_at = Column(DateTime(timezone=True), nullable=True)
     
     cart_items = relationship("CartItemDB", back_populates="item")
     
     def to_pydantic(self):
-        from models import Item
-        return Item(
+        from .models import Item
+        item = Item(
             id=self.id,
             name=self.name,
             price=self.price,
             deleted=self.deleted
         )
+        item._version = self.version
+        return item
+
+event.listen(
+    ItemDB.__table__, 'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'),
+)
+
+
+class ArchivedItemDB(Base):
+    """Удаленные товары, перенесенные из items задачей компактизации"""
+    __tablename__ = 'items_archive'
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String(100), nullable=False)
+    price = Column(Float, nullable=False)
+    version = Column(Integer, nullable=False)
+    created_at = Column(String)
+    deleted_at = Column(DateTime(timezone=True))
+    archived_at = Column(DateTime(timezone=True), nullable=False)
+
 
 class CartDB(Base):
     __tablename__ = 'carts'
     
     id = Column(Integer, primary_key=True, autoincrement=True)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
     created_at = Column(String, default=func.now())
     
     items = relationship("CartItemDB", back_populates="cart", cascade="all, delete-orphan")
     
     def to_pydantic(self):
-        from models import Cart
+        from .models import Cart
         items_dict = {cart_item.item_id: cart_item.quantity for cart_item in self.items}
         return Cart(
             id=self.id,
@@ -43,31 +77,29 @@ class CartDB(Base):
         )
     
     def create_cart_response(self, items_dict: dict):
-        from models import CartResponse, CartResponseItem
+        from .models import cart_response_from_rows
         
         price = 0.0
         total_quantity = 0
-        prepared_items = []
+        items_version = 0
+        lines = []
 
         for cart_item in self.items:
             item = items_dict.get(cart_item.item_id)
             if item:
+                items_version += item.version
                 total_quantity += cart_item.quantity
                 price += item.price * cart_item.quantity
-                prepared_items.append(
-                    CartResponseItem(
-                        id=item.id,
-                        name=item.name,
-                        quantity=cart_item.quantity,
-                        available=(not item.deleted),
-                    )
-                )
-
-        return CartResponse(
-            id=self.id, 
-            items=prepared_items, 
-            price=price
-        ), total_quantity
+                lines.append({
+                    'id': item.id,
+                    'name': item.name,
+                    'quantity': cart_item.quantity,
+                    'available': not item.deleted,
+                })
+
+        cart_response = cart_response_from_rows(self.id, lines, price)
+        cart_response._version = f"{self.version}.{items_version}"
+        return cart_response, total_quantity
 
 class CartItemDB(Base):
     __tablename__ = 'cart_items'
@@ -77,5 +109,61 @@ class CartItemDB(Base):
     item_id = Column(Integer, ForeignKey('items.id'), nullable=False)
     quantity = Column(Integer, default=1)
 
+    __table_args__ = (
+        Index('ix_cart_items_cart_id_item_id', 'cart_id', 'item_id'),
+    )
+
     cart = relationship("CartDB", back_populates="items")
-    item = relationship("ItemDB", back_populates="cart_items")
\ No newline at end of file
+    item = relationship("ItemDB", back_populates="cart_items")
+
+
+class CartEventDB(Base):
+    """Журнал изменений корзин в режиме CART_STORAGE=events: строки только добавляются"""
+    __tablename__ = 'cart_events'
+    __table_args__ = (
+        Index('ix_cart_events_cart_id_id', 'cart_id', 'id'),
+        {'sqlite_autoincrement': True},
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    cart_id = Column(Integer, ForeignKey('carts.id'), nullable=False)
+    kind = Column(String(16), nullable=False)
+    # Индекс нужен компактизации каталога: товар из журнала корзины не архивируется
+    item_id = Column(Integer, nullable=True, index=True)
+    quantity = Column(Integer, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class CartSnapshotDB(Base):
+    """Состояние корзины после события last_event_id; строки - в cart_snapshot_items"""
+    __tablename__ = 'cart_snapshots'
+    
+    cart_id = Column(Integer, ForeignKey('carts.id'), primary_key=True)
+    last_event_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class CartSnapshotItemDB(Base):
+    __tablename__ = 'cart_snapshot_items'
+    
+    cart_id = Column(Integer, ForeignKey('carts.id'), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    item_id = Column(Integer, ForeignKey('items.id'), nullable=False, index=True)
+    quantity = Column(Integer, nullable=False)
+
+
+class CartShardBucketDB(Base):
+    """Какой шард хранит корзины бакета cart_id % BUCKETS; таблица живет в общей базе"""
+    __tablename__ = 'cart_shard_buckets'
+    
+    bucket = Column(Integer, primary_key=True, autoincrement=False)
+    shard = Column(Integer, nullable=False)
+    # Корзины бакета переносятся: воркеры отвечают 503, пока rebalance не снимет флаг
+    moving = Column(Boolean, nullable=False, default=False)
+
+
+class CounterDB(Base):
+    __tablename__ = 'counters'
+    
+    name = Column(String(50), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,228 @@
+"""Шина инвалидации кешей каталога между воркерами.
+
+Запись товара публикует id измененных товаров в той же транзакции: у
+PostgresInvalidationBus это pg_notify, который Postgres доставляет
+слушателям только после COMMIT и не доставляет при откате. Каждый воркер
+слушает канал в фоновом потоке и передает id подписчикам - кешам, которые
+перечитывают или выбрасывают затронутые товары. Пока слушатель был
+отключен, уведомления терялись, поэтому после переподключения подписчики
+получают полный сброс (item_ids=None). LocalInvalidationBus - замена для
+нескольких хранилищ в одном процессе, например в тестах.
+"""
+import json
+import logging
+import os
+import select
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import create_engine, event, func
+from sqlalchemy import select as sql_select
+from sqlalchemy.pool import NullPool
+
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'shop_invalidation'
+# payload pg_notify ограничен 8000 байтами
+MAX_IDS_PER_MESSAGE = 500
+
+INVALIDATION_LAG = Histogram(
+    'app_invalidation_lag_seconds',
+    'Time from publishing a catalog invalidation to delivering it to this worker\'s caches',
+    buckets=[0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5]
+)
+INVALIDATION_MESSAGES = Counter(
+    'app_invalidation_messages_total',
+    'Catalog invalidation messages published and received by this worker',
+    ['direction']
+)
+INVALIDATION_FLUSHES = Counter(
+    'app_invalidation_flushes_total',
+    'Full cache flushes after the invalidation listener reconnected'
+)
+INVALIDATION_ERRORS = Counter(
+    'app_invalidation_errors_total',
+    'Failed cache invalidations and listener failures, by stage',
+    ['stage']
+)
+INVALIDATION_LISTENER_UP = Gauge(
+    'app_invalidation_listener_up',
+    'Whether the invalidation listener is connected and listening',
+    multiprocess_mode='livemin'
+)
+
+
+class Invalidation(NamedTuple):
+    item_ids: tuple = None  # None - сбросить все
+    sent_at: float = 0.0
+
+
+def encode_message(item_ids, sent_at: float) -> str:
+    return json.dumps({'ids': list(item_ids), 't': sent_at}, separators=(',', ':'))
+
+
+def decode_message(payload: str) -> Invalidation:
+    data = json.loads(payload)
+    return Invalidation(tuple(data['ids']), data['t'])
+
+
+class InvalidationBus(ABC):
+    """Публикация id измененных товаров и доставка их подписчикам.
+
+    Подписчик - функция callback(item_ids), где item_ids - список id или
+    None для полного сброса. Ошибка одного подписчика не мешает остальным.
+    """
+
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    @abstractmethod
+    def publish(self, session, item_ids):
+        """Опубликовать изменение товаров в транзакции session: доставка только после ее COMMIT"""
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def deliver(self, message: Invalidation):
+        if message.item_ids is None:
+            INVALIDATION_FLUSHES.inc()
+        else:
+            INVALIDATION_MESSAGES.labels('received').inc()
+            INVALIDATION_LAG.observe(max(0.0, time.time() - message.sent_at))
+        item_ids = None if message.item_ids is None else list(message.item_ids)
+        for callback in self.subscribers:
+            try:
+                callback(item_ids)
+            except Exception:
+                INVALIDATION_ERRORS.labels('subscriber').inc()
+                logger.exception("Cache invalidation by %r failed", callback)
+
+
+class LocalInvalidationBus(InvalidationBus):
+    """Доставка подписчикам этого процесса сразу после COMMIT транзакции записи"""
+
+    def publish(self, session, item_ids):
+        message = Invalidation(tuple(item_ids), time.time())
+        INVALIDATION_MESSAGES.labels('published').inc()
+        if session is None:
+            self.deliver(message)
+        else:
+            event.listen(session, 'after_commit', lambda session: self.deliver(message), once=True)
+
+    def flush(self):
+        """То, что получают подписчики после переподключения слушателя"""
+        self.deliver(Invalidation(None, time.time()))
+
+
+class PostgresInvalidationBus(InvalidationBus):
+    """NOTIFY в транзакции записи и LISTEN в фоновом потоке на отдельном соединении вне пула"""
+
+    def __init__(self, url, channel: str = INVALIDATION_CHANNEL, reconnect_delay: float = 1.0,
+                 poll_interval: float = 1.0, start_timeout: float = 5.0):
+        super().__init__()
+        self.engine = create_engine(url, poolclass=NullPool)
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.poll_interval = poll_interval
+        self.start_timeout = start_timeout
+        self._listening = threading.Event()
+        self._stopped = threading.Event()
+        self._started = False
+        self._thread = None
+
+    def publish(self, session, item_ids):
+        sent_at = time.time()
+        item_ids = sorted(set(item_ids))
+        for start in range(0, len(item_ids), MAX_IDS_PER_MESSAGE):
+            payload = encode_message(item_ids[start:start + MAX_IDS_PER_MESSAGE], sent_at)
+            session.execute(sql_select(func.pg_notify(self.channel, payload)))
+            INVALIDATION_MESSAGES.labels('published').inc()
+
+    def start(self):
+        """Запускает слушателя и ждет LISTEN, чтобы кеши грузились уже под подпиской"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='invalidation-listener', daemon=True)
+        self._thread.start()
+        self._listening.wait(self.start_timeout)
+        # Кеши загружаются после start(): подключения до этой отметки ничего не пропустили
+        self._started = True
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.engine.dispose()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                connection = self.engine.raw_connection()
+            except Exception:
+                INVALIDATION_ERRORS.labels('connect').inc()
+                logger.exception("Invalidation listener could not connect")
+                self._stopped.wait(self.reconnect_delay)
+                continue
+            try:
+                self._listen(connection.driver_connection)
+            except Exception:
+                # После переподключения подписчики получат полный сброс вместо пропущенных уведомлений
+                INVALIDATION_ERRORS.labels('listener').inc()
+                logger.exception("Invalidation listener failed, reconnecting")
+            finally:
+                INVALIDATION_LISTENER_UP.set(0)
+                self._listening.clear()
+                try:
+                    connection.close()
+                except Exception:
+                    # Соединение уже сломано: его ошибка записана выше
+                    pass
+            self._stopped.wait(self.reconnect_delay)
+
+    def _listen(self, connection):
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.channel}"')
+        INVALIDATION_LISTENER_UP.set(1)
+        self._listening.set()
+        if self._started:
+            self.deliver(Invalidation(None, time.time()))
+        while not self._stopped.is_set():
+            if not select.select([connection], [], [], self.poll_interval)[0]:
+                continue
+            connection.poll()
+            while connection.notifies:
+                notify = connection.notifies.pop(0)
+                try:
+                    message = decode_message(notify.payload)
+                except (ValueError, KeyError):
+                    INVALIDATION_ERRORS.labels('decode').inc()
+                    logger.warning("Ignoring malformed invalidation payload %r", notify.payload)
+                    continue
+                self.deliver(message)
+
+
+def create_invalidation_bus(url) -> InvalidationBus:
+    """Шина по INVALIDATION_BUS: postgres, local или none"""
+    kind = os.getenv('INVALIDATION_BUS', 'none')
+    if kind == 'none':
+        return None
+    if kind == 'local':
+        return LocalInvalidationBus()
+    if kind == 'postgres':
+        return PostgresInvalidationBus(
+            url,
+            channel=os.getenv('INVALIDATION_CHANNEL', INVALIDATION_CHANNEL),
+            reconnect_delay=float(os.getenv('INVALIDATION_RECONNECT_SECONDS', '1')),
+        )
+    raise ValueError(f"Unknown INVALIDATION_BUS: {kind}")
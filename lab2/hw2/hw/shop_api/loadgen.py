@@ -0,0 +1,305 @@
+"""Сценарный генератор нагрузки для shop_api.
+
+    python -m shop_api.loadgen --items 1000 --carts 200 --duration 30 --concurrency 32
+    python -m shop_api.loadgen --spawn --rate 500 --json report.json
+
+С --spawn генератор сам поднимает uvicorn на SQLite-файле (или на
+DATABASE_URL, если он задан), иначе бьет в уже запущенный --base-url.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import NamedTuple
+
+import httpx
+from faker import Faker
+
+
+DEFAULT_WEIGHTS = {'browse': 5, 'view_cart': 3, 'add_to_cart': 2, 'reprice': 1}
+
+
+class LoadConfig(NamedTuple):
+    items: int = 100
+    carts: int = 20
+    items_per_cart: int = 3
+    duration: float = 10.0
+    concurrency: int = 16
+    rate: float = None
+    weights: dict = DEFAULT_WEIGHTS
+    seed: int = 0
+
+
+class EndpointStats:
+    """Задержки и ошибки одного эндпоинта"""
+    __slots__ = ('latencies', 'errors')
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.errors = 0
+
+    def report(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {
+            'requests': count,
+            'errors': self.errors,
+            'error_rate': self.errors / count if count else 0.0,
+            'throughput_rps': count / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+        }
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """Перцентиль по рангу (nearest-rank), без интерполяции"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(q / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class LoadState:
+    """Сид-данные и статистика одного прогона"""
+
+    def __init__(self, config: LoadConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.faker = Faker()
+        self.faker.seed_instance(config.seed)
+        self.item_ids: list[int] = []
+        self.cart_ids: list[int] = []
+        self.stats: dict[str, EndpointStats] = {}
+
+    async def request(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs) -> httpx.Response:
+        """Запрос с замером; endpoint - шаблон пути, чтобы не плодить строк в отчете"""
+        stats = self.stats.get(endpoint)
+        if stats is None:
+            stats = self.stats[endpoint] = EndpointStats()
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            stats.latencies.append(time.perf_counter() - started)
+            stats.errors += 1
+            return None
+        stats.latencies.append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            stats.errors += 1
+        return response
+
+    def price(self) -> float:
+        return round(self.random.uniform(1, 1000), 2)
+
+
+async def seed(client: httpx.AsyncClient, state: LoadState):
+    """Создает товары и корзины; в статистику нагрузки не попадает"""
+    config = state.config
+    for _ in range(config.items):
+        response = await client.post('/item', json={'name': state.faker.catch_phrase(), 'price': state.price()})
+        response.raise_for_status()
+        state.item_ids.append(response.json()['id'])
+    for _ in range(config.carts):
+        response = await client.post('/cart')
+        response.raise_for_status()
+        cart_id = response.json()['id']
+        state.cart_ids.append(cart_id)
+        for item_id in state.random.sample(state.item_ids, min(config.items_per_cart, len(state.item_ids))):
+            (await client.post(f'/cart/{cart_id}/add/{item_id}')).raise_for_status()
+
+
+async def browse(client: httpx.AsyncClient, state: LoadState):
+    low = state.random.choice([None, 0, 100, 250])
+    params = {'offset': state.random.randrange(0, max(1, len(state.item_ids)), 10), 'limit': 10}
+    if low is not None:
+        params['min_price'] = low
+        params['max_price'] = low + state.random.choice([100, 500, 1000])
+    await state.request(client, '/item', 'GET', '/item', params=params)
+
+
+async def view_cart(client: httpx.AsyncClient, state: LoadState):
+    cart_id = state.random.choice(state.cart_ids)
+    await state.request(client, '/cart/{cart_id}', 'GET', f'/cart/{cart_id}')
+
+
+async def add_to_cart(client: httpx.AsyncClient, state: LoadState):
+    cart_id = state.random.choice(state.cart_ids)
+    item_id = state.random.choice(state.item_ids)
+    await state.request(client, '/cart/{cart_id}/add/{item_id}', 'POST', f'/cart/{cart_id}/add/{item_id}')
+
+
+async def reprice(client: httpx.AsyncClient, state: LoadState):
+    item_id = state.random.choice(state.item_ids)
+    await state.request(client, '/item/{item_id}', 'PATCH', f'/item/{item_id}', json={'price': state.price()})
+
+
+SCENARIOS = {
+    'browse': browse,
+    'view_cart': view_cart,
+    'add_to_cart': add_to_cart,
+    'reprice': reprice,
+}
+
+
+def parse_weights(value: str) -> dict:
+    """'browse=5,reprice=1' -> {'browse': 5, 'reprice': 1}"""
+    weights = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise ValueError(f"unknown scenario {name.strip()!r}, expected one of {sorted(SCENARIOS)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+async def run_load(client: httpx.AsyncClient, config: LoadConfig) -> dict:
+    """Сидирует данные и гоняет сценарии duration секунд.
+
+    Без rate работает закрытая модель: concurrency воркеров шлют запросы
+    один за другим. С rate - открытая: сценарии стартуют с заданной
+    частотой независимо от ответов, concurrency ограничивает число
+    одновременно выполняющихся.
+    """
+    state = LoadState(config)
+    await seed(client, state)
+    names = list(config.weights)
+    weights = [config.weights[name] for name in names]
+
+    def pick():
+        return SCENARIOS[state.random.choices(names, weights)[0]]
+
+    started = time.perf_counter()
+    deadline = started + config.duration
+
+    if config.rate is None:
+        async def worker():
+            while time.perf_counter() < deadline:
+                await pick()(client, state)
+
+        await asyncio.gather(*(worker() for _ in range(config.concurrency)))
+    else:
+        slots = asyncio.Semaphore(config.concurrency)
+        tasks = set()
+
+        async def launch(scenario):
+            async with slots:
+                await scenario(client, state)
+
+        interval = 1 / config.rate
+        next_start = started
+        while next_start < deadline:
+            task = asyncio.create_task(launch(pick()))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            next_start += interval
+            await asyncio.sleep(max(0.0, next_start - time.perf_counter()))
+        await asyncio.gather(*tasks)
+
+    elapsed = time.perf_counter() - started
+    return {
+        'config': {**config._asdict(), 'elapsed': elapsed},
+        'endpoints': {endpoint: stats.report(elapsed) for endpoint, stats in sorted(state.stats.items())},
+    }
+
+
+def format_table(report: dict) -> str:
+    columns = ['requests', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'error_rate']
+    header = f"{'endpoint':<32}" + ''.join(f"{column:>15}" for column in columns)
+    lines = [header, '-' * len(header)]
+    for endpoint, row in report['endpoints'].items():
+        cells = ''.join(
+            f"{row[column]:>15}" if column == 'requests' else
+            f"{row[column]:>15.2%}" if column == 'error_rate' else
+            f"{row[column]:>15.2f}"
+            for column in columns
+        )
+        lines.append(f"{endpoint:<32}{cells}")
+    return '\n'.join(lines)
+
+
+def spawn_server(port: int, workdir: str) -> subprocess.Popen:
+    """Локальный uvicorn; без DATABASE_URL - на SQLite-файле во временном каталоге"""
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(workdir, 'loadgen.db')}")
+    return subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'shop_api.main:app', '--port', str(port), '--log-level', 'warning'],
+        cwd=os.path.join(os.path.dirname(__file__), '..'),
+        env=env,
+    )
+
+
+async def wait_ready(client: httpx.AsyncClient, timeout: float = 30.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            if (await client.get('/readyz')).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError('shop_api did not become ready')
+
+
+async def main_async(args) -> dict:
+    config = LoadConfig(
+        items=args.items,
+        carts=args.carts,
+        items_per_cart=args.items_per_cart,
+        duration=args.duration,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        weights=parse_weights(args.scenarios),
+        seed=args.seed,
+    )
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout) as client:
+        await wait_ready(client)
+        return await run_load(client, config)
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description='Load generator for shop_api')
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--spawn', action='store_true', help='start a local uvicorn for the run')
+    parser.add_argument('--port', type=int, default=8765, help='port for --spawn')
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--carts', type=int, default=20)
+    parser.add_argument('--items-per-cart', type=int, default=3)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rate', type=float, default=None, help='scenarios per second (open model)')
+    parser.add_argument('--scenarios', default=','.join(f"{name}={weight}" for name, weight in DEFAULT_WEIGHTS.items()))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--json', dest='json_path', help='write the report to this file')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        server = None
+        if args.spawn:
+            server = spawn_server(args.port, workdir)
+            args.base_url = f'http://127.0.0.1:{args.port}'
+        try:
+            report = asyncio.run(main_async(args))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    print(format_table(report))
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
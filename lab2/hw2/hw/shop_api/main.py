@@ -1,17 +1,16 @@
 import http
+import os
+import time
+from contextlib import asynccontextmanager
 from typing import Annotated, List
-from fastapi import FastAPI, HTTPException, Query, Response
 
-from .models import Cart, CartResponse, CreateItemRequest, GeneratedID, GetCartsRequest, GetItemsRequest, Item, UpdateItemRequest
-from .database import  Shop
+_import_started = time.perf_counter()
 
-
-app = FastAPI(title="Shop API")
-shop = Shop()
-
-import http
-from typing import Annotated, List
-from fastapi import FastAPI, HTTPException, Query, Response
+from fastapi import FastAPI, Header, HTTPException, Query, Response
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Match
 from prometheus_client import Counter, Histogram, Gauge
 from prometheus_fastapi_instrumentator import Instrumentator
 from prometheus_fastapi_instrumentator.metrics import (
@@ -22,11 +21,51 @@ from prometheus_fastapi_instrumentator.metrics import (
 )
 
 
-from .models import Cart, GeneratedID, GetCartsRequest, GetItemsRequest, Item, UpdateItemRequest
-from.database import Shop
+from .models import (
+    Cart, CartResponse, CartStatsResponse, CreateItemRequest, GeneratedID, GetCartsRequest, GetCartStatsRequest,
+    GetItemsRequest, Item, UpdateItemRequest,
+)
+from .metrics import cleanup_dead_workers
+from .query_metrics import QUERY_METRICS, finish_request, track_queries, untracked
+from .cart_stats import CartStatsShop
+from .admission import AdmissionMiddleware
+from .catalog_index import next_cursor
+from .compression import CompressionMiddleware
+from .conditional import cart_etag, etag_headers, if_match_version, item_etag, list_etag, none_match, not_modified
+from .storage import ShardUnavailable, ShopStorage, VersionConflict, create_shop
+from .replicas import use_primary
+from .timing import RequestTimingMiddleware, TimedRoute, untimed
+from .responses import CART_RESPONSE_ADAPTER, CART_RESPONSE_LIST_ADAPTER, ITEM_ADAPTER, ITEM_LIST_ADAPTER, fast_json
+
+WARMUP_CONNECTIONS = int(os.getenv('DB_WARMUP_CONNECTIONS', os.getenv('DB_POOL_SIZE', '5')))
+
+shop: ShopStorage = None
+ready = False
+# SINGLE_FLIGHT: чтения, которые склеивает CoalescingShop, идут в пул потоков
+coalesce_reads = False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Магазин создается при старте воркера, а не при импорте модуля"""
+    global shop, ready, coalesce_reads
+    started = time.perf_counter()
+    cleanup_dead_workers()
+    coalesce_reads = os.getenv('SINGLE_FLIGHT', '0') == '1'
+    shop = create_shop()
+    shop.warm_up(WARMUP_CONNECTIONS)
+    STARTUP_DURATION.set(time.perf_counter() - started)
+    ready = True
+    try:
+        yield
+    finally:
+        ready = False
+        shop.close()
+        shop = None
 
-app = FastAPI(title="Shop API")
-shop = Shop()
+
+app = FastAPI(title="Shop API", lifespan=lifespan)
+app.router.route_class = TimedRoute
 
 REQUEST_COUNT = Counter(
     'app_request_count_total', 
@@ -40,41 +79,46 @@ REQUEST_DURATION = Histogram(
     ['method', 'endpoint']
 )
 
-ACTIVE_CARTS = Gauge('app_active_carts', 'Number of active shopping carts')
-ITEMS_COUNT = Gauge('app_items_count', 'Total number of items in the shop')
-CART_PRICE_SUM = Gauge('app_cart_price_sum', 'Total price of all carts')
+IMPORT_DURATION = Gauge('app_import_duration_seconds', 'Time spent importing shop_api.main', multiprocess_mode='livemax')
+STARTUP_DURATION = Gauge('app_startup_duration_seconds', 'Time spent creating and warming up the shop', multiprocess_mode='livemax')
+
+ACTIVE_CARTS = Gauge('app_active_carts', 'Number of active shopping carts', multiprocess_mode='livemostrecent')
+ITEMS_COUNT = Gauge('app_items_count', 'Total number of items in the shop', multiprocess_mode='livemostrecent')
+CART_PRICE_SUM = Gauge('app_cart_price_sum', 'Total price of all carts', multiprocess_mode='livemostrecent')
+CART_PRICE_QUANTILE = Gauge(
+    'app_cart_price_quantile',
+    'Cart price quantiles from the incremental cart stats sketch',
+    ['quantile'],
+    multiprocess_mode='livemostrecent'
+)
+CART_QUANTITY_QUANTILE = Gauge(
+    'app_cart_quantity_quantile',
+    'Cart total quantity quantiles from the incremental cart stats sketch',
+    ['quantile'],
+    multiprocess_mode='livemostrecent'
+)
 
 def update_business_metrics():
-    """Обновляем кастомные бизнес-метрики с учетом работы с БД"""
+    """Обновляем кастомные бизнес-метрики по данным хранилища"""
     try:
-        # Получаем данные из базы данных
-        session = shop.db.get_session()
-        try:
-            carts_count = session.query(shop.db.CartDB).count()
-            ACTIVE_CARTS.set(carts_count)
-            
-            items_count = session.query(shop.db.ItemDB).filter(shop.db.ItemDB.deleted == False).count()
-            ITEMS_COUNT.set(items_count)
-            
-            total_price = 0
-            carts = session.query(shop.db.CartDB).all()
-            for cart_db in carts:
-                for cart_item in cart_db.items:
-                    item = session.query(shop.db.ItemDB).filter(shop.db.ItemDB.id == cart_item.item_id).first()
-                    if item and not item.deleted:
-                        total_price += item.price * cart_item.quantity
-            
-            CART_PRICE_SUM.set(total_price)
-            
-        finally:
-            session.close()
+        metrics = shop.get_business_metrics()
+        ACTIVE_CARTS.set(metrics.carts)
+        ITEMS_COUNT.set(metrics.items)
+        CART_PRICE_SUM.set(metrics.cart_price_sum)
+        if isinstance(shop, CartStatsShop):
+            # Квантили дешевы только из инкрементальных скетчей: без них это был бы проход по всем корзинам
+            summary = shop.get_cart_stats().summary()
+            for name, value in summary['price']['quantiles'].items():
+                CART_PRICE_QUANTILE.labels(name).set(value or 0)
+            for name, value in summary['quantity']['quantiles'].items():
+                CART_QUANTITY_QUANTILE.labels(name).set(value or 0)
             
     except Exception as e:
         ACTIVE_CARTS.set(0)
         ITEMS_COUNT.set(0)
         CART_PRICE_SUM.set(0)
 
-instrumentator = Instrumentator()
+instrumentator = Instrumentator(excluded_handlers=["/healthz", "/readyz"])
 
 instrumentator.add(
     default()
@@ -93,47 +137,127 @@ instrumentator.instrument(app).expose(app)
 @app.middleware("http")
 async def update_metrics_middleware(request, call_next):
     response = await call_next(request)
-    update_business_metrics()
+    # Обновление метрик не относится к запросу: его SQL не считается в X-DB-Queries,
+    # бюджете эндпоинта и фазе db
+    with untracked(), untimed():
+        update_business_metrics()
     return response
 
 
-@app.get("/cart/{cart_id}")
-async def get_cart(cart_id: int) -> CartResponse:
-    cart_response, _ = shop.get_cart_response(cart_id)
+@app.middleware("http")
+async def read_your_writes_middleware(request, call_next):
+    """Изменяющие запросы и запросы с X-Read-Your-Writes читают только из primary"""
+    if request.method in ("GET", "HEAD") and request.headers.get("x-read-your-writes") is None:
+        return await call_next(request)
+    with use_primary():
+        return await call_next(request)
+
+
+def endpoint_template(request) -> str:
+    """Шаблон пути маршрута, а не сам путь: у /cart/1 и /cart/2 одна метка"""
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+@app.middleware("http")
+async def query_budget_middleware(request, call_next):
+    """Считает SQL-запросы на HTTP-запрос и помечает превысившие DB_QUERY_BUDGET"""
+    if not QUERY_METRICS:
+        return await call_next(request)
+    with track_queries(endpoint_template(request)) as stats:
+        response = await call_next(request)
+    response.headers["X-DB-Queries"] = str(stats.count)
+    if finish_request(stats):
+        response.headers["X-DB-Query-Budget-Exceeded"] = "1"
+    return response
+
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request, exc):
+    """Пул соединений исчерпан: просим повторить позже, а не отвечаем 500"""
+    return JSONResponse(
+        {"detail": "Database is overloaded"},
+        status_code=http.HTTPStatus.SERVICE_UNAVAILABLE,
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.exception_handler(ShardUnavailable)
+async def shard_unavailable_handler(request, exc):
+    """Бакет корзины переносится или карта шардов устарела: запись в старый шард потерялась бы"""
+    return JSONResponse(
+        {"detail": "Cart shard is temporarily unavailable"},
+        status_code=http.HTTPStatus.SERVICE_UNAVAILABLE,
+        headers={"Retry-After": "1"},
+    )
+
+
+# Снаружи BaseHTTPMiddleware, но внутри admission control: ожидание в очереди не входит в фазы
+app.add_middleware(RequestTimingMiddleware)
+
+if os.getenv('ADMISSION_CONTROL', '1') == '1':
+    app.add_middleware(AdmissionMiddleware)
+
+# Добавляется последним, то есть оборачивает все остальное: сжимаются итоговые байты ответа
+if os.getenv('RESPONSE_COMPRESSION', '1') == '1':
+    app.add_middleware(CompressionMiddleware, **CompressionMiddleware.options_from_env())
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz(response: Response):
+    if not ready or not shop.ping():
+        response.status_code = http.HTTPStatus.SERVICE_UNAVAILABLE
+        return {"status": "starting" if not ready else "unavailable"}
+    return {"status": "ready"}
+
+
+async def shared_read(call, *args):
+    """На event loop одинаковые запросы выполняются по очереди, и склеивать их нечего:
+    с SINGLE_FLIGHT чтение уходит в пул потоков, где CoalescingShop видит одновременные вызовы"""
+    if coalesce_reads:
+        return await run_in_threadpool(call, *args)
+    return call(*args)
+
+
+async def write(call, *args):
+    """Записи идут в пул потоков: при конфликте TransactionPolicy спит перед повтором,
+    и на event loop этот сон остановил бы все запросы воркера"""
+    return await run_in_threadpool(call, *args)
+
+
+@app.get("/cart/{cart_id}", response_model=CartResponse)
+async def get_cart(cart_id: int, if_none_match: Annotated[str | None, Header()] = None):
+    if if_none_match is not None:
+        etag = cart_etag(cart_id, shop.get_cart_version(cart_id))
+        if none_match(if_none_match, etag):
+            return not_modified(etag)
+    cart_response, _ = await shared_read(shop.get_cart_response, cart_id)
     if not cart_response:
         raise HTTPException(status_code=http.HTTPStatus.NOT_FOUND)
-    return cart_response
-
-
-@app.get("/cart")
-async def get_carts(filter: Annotated[GetCartsRequest, Query()]) -> List[CartResponse]:
-    cart_data = [
-        cart.create_cart_response(shop.items) for cart in shop.carts.values()
-    ]
-
-    def is_fits(cart_tuple) -> bool:
-        cart_response, total_quantity = cart_tuple
-        price_conditions = [
-            filter.min_price is None or filter.min_price <= cart_response.price,
-            filter.max_price is None or filter.max_price >= cart_response.price
-        ]
-        quantity_conditions = [
-            filter.min_quantity is None or filter.min_quantity <= total_quantity,
-            filter.max_quantity is None or filter.max_quantity >= total_quantity
-        ]
-        return all(price_conditions + quantity_conditions)
-    
-    filtered_carts = [
-        cart_response for cart_response, total_quantity in cart_data 
-        if is_fits((cart_response, total_quantity))
-    ]
-    left_bound = filter.offset
-    right_bound = filter.offset + filter.limit
-    return filtered_carts[left_bound:right_bound]
+    etag = cart_etag(cart_id, cart_response._version)
+    return fast_json(cart_response, CART_RESPONSE_ADAPTER, headers=etag_headers(etag))
+
+
+@app.get("/cart", response_model=List[CartResponse])
+async def get_carts(filter: Annotated[GetCartsRequest, Query()]):
+    cart_responses = shop.get_cart_responses(filter)
+    return fast_json(cart_responses, CART_RESPONSE_LIST_ADAPTER)
+
+@app.get("/stats/carts", response_model=CartStatsResponse)
+async def get_cart_stats(filter: Annotated[GetCartStatsRequest, Query()]):
+    return shop.get_cart_stats().summary(filter.quantile)
 
 @app.post("/cart", status_code=http.HTTPStatus.CREATED)
 async def create_cart(response: Response) -> GeneratedID:
-    cart = shop.create_cart()
+    cart = await write(shop.create_cart)
     #response.headers["location"] = f"/cart/{cart.id}"
     return GeneratedID(id=cart.id)
 
@@ -145,7 +269,7 @@ async def add_to_cart(cart_id: int, item_id: int):
     item = shop.get_item(item_id)
     if item is None or item.deleted:
         raise HTTPException(status_code=http.HTTPStatus.NOT_FOUND)
-    updated_cart = shop.add_item_to_cart(cart_id, item_id, quantity=1)
+    updated_cart = await write(shop.add_item_to_cart, cart_id, item_id, 1)
     if updated_cart is None:
         raise HTTPException(status_code=http.HTTPStatus.NOT_FOUND)
     return None
@@ -153,44 +277,61 @@ async def add_to_cart(cart_id: int, item_id: int):
 @app.post("/item", status_code=http.HTTPStatus.CREATED)
 async def create_item(payload: CreateItemRequest, response: Response):
     request = CreateItemRequest(name=payload.name, price=payload.price)
-    item = shop.create_item(request)
+    item = await write(shop.create_item, request)
     #response.headers["location"] = f"/item/{item.id}"
     return item
     
 
-@app.get("/item/{item_id}")
-async def get_item(item_id: int) -> Item:
-    item = shop.get_item(item_id)
+@app.get("/item/{item_id}", response_model=Item)
+async def get_item(item_id: int, if_none_match: Annotated[str | None, Header()] = None):
+    if if_none_match is not None:
+        etag = item_etag(item_id, shop.get_item_version(item_id))
+        if none_match(if_none_match, etag):
+            return not_modified(etag)
+    item = await shared_read(shop.get_item, item_id)
     if item is None or item.deleted:
         raise HTTPException(status_code=http.HTTPStatus.NOT_FOUND)
-    return item
+    return fast_json(item, ITEM_ADAPTER, headers=etag_headers(item_etag(item_id, item._version)))
 
 
-@app.get("/item")
-async def get_items(filter: Annotated[GetItemsRequest, Query()]) -> List[Item]:
-    request = GetItemsRequest(filter.offset, filter.limit, filter.min_price, filter.max_price, filter.show_deleted)
-    filtered_items = shop.get_all_items(request)
-    return filtered_items
+@app.get("/item", response_model=List[Item])
+async def get_items(filter: Annotated[GetItemsRequest, Query()], if_none_match: Annotated[str | None, Header()] = None):
+    etag = list_etag("items", shop.get_catalog_version(), filter)
+    if none_match(if_none_match, etag):
+        return not_modified(etag)
+    filtered_items = shop.get_all_items(filter)
+    headers = etag_headers(etag)
+    cursor = next_cursor(filtered_items, filter)
+    if cursor is not None:
+        headers["X-Next-Cursor"] = cursor
+    return fast_json(filtered_items, ITEM_LIST_ADAPTER, headers=headers)
 
-@app.put("/item/{item_id}")
-async def put_item(item_id: int, payload: CreateItemRequest) -> Item:
-    updated_item = shop.update_item(item_id, payload)
+
+def update_item_if_match(item_id: int, payload: UpdateItemRequest, if_match: str, response: Response) -> Item:
+    try:
+        updated_item = shop.update_item(item_id, payload, expected_version=if_match_version(if_match, item_id))
+    except VersionConflict:
+        raise HTTPException(status_code=http.HTTPStatus.PRECONDITION_FAILED)
     if updated_item is None:
         raise HTTPException(status_code=http.HTTPStatus.NOT_FOUND)
+    etag = item_etag(item_id, updated_item._version)
+    if etag is not None:
+        response.headers["ETag"] = etag
     return updated_item
 
+
+@app.put("/item/{item_id}")
+async def put_item(item_id: int, payload: CreateItemRequest, response: Response, if_match: Annotated[str | None, Header()] = None) -> Item:
+    return await write(update_item_if_match, item_id, payload, if_match, response)
+
 @app.patch("/item/{item_id}")
-async def patch_item(item_id: int, payload: UpdateItemRequest) -> Item:
+async def patch_item(item_id: int, payload: UpdateItemRequest, response: Response, if_match: Annotated[str | None, Header()] = None) -> Item:
     item = shop.get_item(item_id)
     if item is None:
         raise HTTPException(status_code=http.HTTPStatus.NOT_FOUND)
     if item.deleted:
         raise HTTPException(status_code=http.HTTPStatus.NOT_MODIFIED)
-    updated_item = shop.update_item(item_id, payload)
-    if updated_item is None:
-        raise HTTPException(status_code=http.HTTPStatus.NOT_FOUND)
-    
-    return updated_item
+    return await write(update_item_if_match, item_id, payload, if_match, response)
 
 
 @app.delete("/item/{item_id}")
@@ -198,8 +339,10 @@ async def delete_item(item_id: int) -> Item:
     item = shop.get_item(item_id)
     if item is None:
         raise HTTPException(status_code=http.HTTPStatus.NOT_FOUND)
-    success = shop.delete_item(item_id)
+    success = await write(shop.delete_item, item_id)
     if not success:
         raise HTTPException(status_code=http.HTTPStatus.NOT_FOUND)
     return item
 
+
+IMPORT_DURATION.set(time.perf_counter() - _import_started)
@@ -0,0 +1,342 @@
+import os
+import pickle
+import threading
+from array import array
+
+from .models import (
+    Cart, CartResponse, CreateItemRequest, GetCartsRequest, GetItemsRequest, Item, UpdateItemRequest, cart_response_from_rows,
+)
+from .catalog_index import NgramIndex, PriceIndex, decode_cursor, search_candidates
+from .storage import BusinessMetrics, ShopStorage, VersionConflict
+
+
+class ItemColumns:
+    """Колоночное хранение товаров: id товара = индекс в массивах + 1"""
+    __slots__ = ('names', 'prices', 'deleted', 'versions')
+
+    def __init__(self):
+        self.names: list[str] = []
+        self.prices = array('d')
+        self.deleted = array('b')
+        self.versions = array('q')
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def append(self, name: str, price: float) -> int:
+        self.names.append(name)
+        self.prices.append(price)
+        self.deleted.append(0)
+        self.versions.append(1)
+        return len(self.names)
+
+    def exists(self, item_id: int) -> bool:
+        return 0 < item_id <= len(self.names) and self.names[item_id - 1] is not None
+
+    def to_item(self, item_id: int) -> Item:
+        index = item_id - 1
+        item = Item(id=item_id, name=self.names[index], price=self.prices[index], deleted=bool(self.deleted[index]))
+        item._version = self.versions[index]
+        return item
+
+
+class InMemoryShop(ShopStorage):
+    """Хранилище магазина в памяти процесса с опциональным снапшотом на диск"""
+
+    def __init__(self, snapshot_path: str = None):
+        self.snapshot_path = snapshot_path
+        self.items = ItemColumns()
+        self.price_index = PriceIndex()
+        self.name_index = NgramIndex()
+        self.carts: dict[int, dict[int, int]] = {}
+        self.cart_versions: dict[int, int] = {}
+        self.catalog_version = 0
+        self.next_cart_id = 1
+        self.lock = threading.RLock()
+        if snapshot_path and os.path.exists(snapshot_path):
+            self.load_snapshot(snapshot_path)
+
+    def close(self):
+        if self.snapshot_path:
+            self.save_snapshot(self.snapshot_path)
+
+    def save_snapshot(self, path: str):
+        with self.lock:
+            state = {
+                'names': self.items.names,
+                'prices': self.items.prices.tobytes(),
+                'deleted': self.items.deleted.tobytes(),
+                'versions': self.items.versions.tobytes(),
+                'carts': self.carts,
+                'cart_versions': self.cart_versions,
+                'catalog_version': self.catalog_version,
+                'next_cart_id': self.next_cart_id,
+            }
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as snapshot:
+                pickle.dump(state, snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+
+    def load_snapshot(self, path: str):
+        with open(path, 'rb') as snapshot:
+            state = pickle.load(snapshot)
+        with self.lock:
+            self.items = ItemColumns()
+            self.items.names = state['names']
+            self.items.prices.frombytes(state['prices'])
+            self.items.deleted.frombytes(state['deleted'])
+            self.items.versions.frombytes(state['versions'])
+            self.carts = state['carts']
+            self.cart_versions = state['cart_versions']
+            self.catalog_version = state['catalog_version']
+            self.next_cart_id = state['next_cart_id']
+            self.price_index = PriceIndex(
+                (price, index + 1)
+                for index, (name, price) in enumerate(zip(self.items.names, self.items.prices))
+                if name is not None
+            )
+            self.name_index = NgramIndex(
+                (index + 1, name) for index, name in enumerate(self.items.names) if name is not None
+            )
+
+    def create_item(self, item_data: CreateItemRequest) -> Item:
+        with self.lock:
+            item_id = self.items.append(item_data.name, item_data.price)
+            self.price_index.add(item_data.price, item_id)
+            self.name_index.add(item_id, item_data.name)
+            self.catalog_version += 1
+            return self.items.to_item(item_id)
+
+    def get_item(self, item_id: int) -> Item:
+        if not self.items.exists(item_id):
+            return None
+        return self.items.to_item(item_id)
+
+    def _item_candidates(self, filters: GetItemsRequest, needle: str = None):
+        """id товаров в порядке выдачи; названия и удаление проверяет вызывающий"""
+        if needle is not None:
+            prices = self.items.prices
+            candidates = search_candidates(self.name_index, needle, lambda item_id: prices[item_id - 1], filters)
+            if candidates is not None:
+                return candidates
+        if filters.sort == 'price':
+            after = decode_cursor(filters.cursor) if filters.cursor else None
+            return self.price_index.scan(filters.min_price, filters.max_price, after)
+        if filters.min_price is not None or filters.max_price is not None:
+            return sorted(self.price_index.range(filters.min_price, filters.max_price))
+        return range(1, len(self.items) + 1)
+
+    def get_all_items(self, filters: GetItemsRequest = None) -> list[Item]:
+        filters = filters or GetItemsRequest(show_deleted=True)
+        needle = filters.q.lower() if filters.q is not None else None
+        candidates = self._item_candidates(filters, needle)
+
+        names, deleted = self.items.names, self.items.deleted
+        skip = filters.offset
+        result = []
+        for item_id in candidates:
+            if names[item_id - 1] is None:
+                continue
+            if not filters.show_deleted and deleted[item_id - 1]:
+                continue
+            if needle is not None and needle not in names[item_id - 1].lower():
+                continue
+            if skip:
+                skip -= 1
+                continue
+            result.append(self.items.to_item(item_id))
+            if len(result) == filters.limit:
+                break
+        return result
+
+    def update_item(self, item_id: int, update_data: UpdateItemRequest, expected_version: int = None) -> Item:
+        with self.lock:
+            if not self.items.exists(item_id):
+                return None
+            index = item_id - 1
+            if expected_version is not None and self.items.versions[index] != expected_version:
+                raise VersionConflict(item_id, self.items.versions[index])
+            if update_data.name is not None:
+                self.items.names[index] = update_data.name
+                self.name_index.add(item_id, update_data.name)
+            if update_data.price is not None:
+                self.price_index.remove(self.items.prices[index], item_id)
+                self.items.prices[index] = update_data.price
+                self.price_index.add(update_data.price, item_id)
+            self.items.versions[index] += 1
+            self.catalog_version += 1
+            return self.items.to_item(item_id)
+
+    def delete_item(self, item_id: int) -> bool:
+        with self.lock:
+            if not self.items.exists(item_id):
+                return False
+            self.items.deleted[item_id - 1] = 1
+            self.items.versions[item_id - 1] += 1
+            self.catalog_version += 1
+            return True
+
+    def hard_delete_item(self, item_id: int) -> bool:
+        with self.lock:
+            if not self.items.exists(item_id):
+                return False
+            self.price_index.remove(self.items.prices[item_id - 1], item_id)
+            self.items.names[item_id - 1] = None
+            self.catalog_version += 1
+            return True
+
+    def create_cart(self) -> Cart:
+        with self.lock:
+            cart_id = self.next_cart_id
+            self.next_cart_id += 1
+            self.carts[cart_id] = {}
+            self.cart_versions[cart_id] = 1
+            return Cart(id=cart_id, items={})
+
+    def get_cart(self, cart_id: int) -> Cart:
+        quantities = self.carts.get(cart_id)
+        return Cart(id=cart_id, items=dict(quantities)) if quantities is not None else None
+
+    def get_all_carts(self, filters: GetCartsRequest = None) -> list[Cart]:
+        filters = filters or GetCartsRequest()
+        cart_ids = list(self.carts)[filters.offset:filters.offset + filters.limit]
+        return [self.get_cart(cart_id) for cart_id in cart_ids]
+
+    def add_item_to_cart(self, cart_id: int, item_id: int, quantity: int = 1) -> Cart:
+        with self.lock:
+            quantities = self.carts.get(cart_id)
+            if quantities is None or not self.items.exists(item_id) or self.items.deleted[item_id - 1]:
+                return None
+            quantities[item_id] = quantities.get(item_id, 0) + quantity
+            self.cart_versions[cart_id] += 1
+            return self.get_cart(cart_id)
+
+    def remove_item_from_cart(self, cart_id: int, item_id: int) -> Cart:
+        with self.lock:
+            quantities = self.carts.get(cart_id)
+            if not quantities or item_id not in quantities:
+                return None
+            del quantities[item_id]
+            self.cart_versions[cart_id] += 1
+            return self.get_cart(cart_id)
+
+    def update_cart_item_quantity(self, cart_id: int, item_id: int, quantity: int) -> Cart:
+        with self.lock:
+            quantities = self.carts.get(cart_id)
+            if not quantities or item_id not in quantities:
+                return None
+            if quantity <= 0:
+                del quantities[item_id]
+            else:
+                quantities[item_id] = quantity
+            self.cart_versions[cart_id] += 1
+            return self.get_cart(cart_id)
+
+    def clear_cart(self, cart_id: int) -> Cart:
+        with self.lock:
+            quantities = self.carts.get(cart_id)
+            if quantities is None:
+                return None
+            quantities.clear()
+            self.cart_versions[cart_id] += 1
+            return self.get_cart(cart_id)
+
+    def delete_cart(self, cart_id: int) -> bool:
+        with self.lock:
+            self.cart_versions.pop(cart_id, None)
+            return self.carts.pop(cart_id, None) is not None
+
+    def _cart_totals(self, quantities: dict[int, int]) -> tuple[float, int]:
+        price = 0.0
+        total_quantity = 0
+        for item_id, quantity in quantities.items():
+            if self.items.exists(item_id):
+                total_quantity += quantity
+                price += self.items.prices[item_id - 1] * quantity
+        return price, total_quantity
+
+    def _build_cart_response(self, cart_id: int, quantities: dict[int, int]) -> tuple[CartResponse, int]:
+        names, prices, deleted = self.items.names, self.items.prices, self.items.deleted
+        price = 0.0
+        total_quantity = 0
+        lines = []
+        for item_id, quantity in quantities.items():
+            if not self.items.exists(item_id):
+                continue
+            total_quantity += quantity
+            price += prices[item_id - 1] * quantity
+            lines.append({'id': item_id, 'name': names[item_id - 1], 'quantity': quantity,
+                          'available': not deleted[item_id - 1]})
+        cart_response = cart_response_from_rows(cart_id, lines, price)
+        cart_response._version = self.get_cart_version(cart_id)
+        return cart_response, total_quantity
+
+    def get_cart_response(self, cart_id: int) -> tuple:
+        quantities = self.carts.get(cart_id)
+        if quantities is None:
+            return None, 0
+        return self._build_cart_response(cart_id, quantities)
+
+    def get_cart_responses(self, filters: GetCartsRequest = None) -> list[CartResponse]:
+        filters = filters or GetCartsRequest()
+        skip = filters.offset
+        responses = []
+        for cart_id, quantities in self.carts.items():
+            price, total_quantity = self._cart_totals(quantities)
+            if filters.min_price is not None and price < filters.min_price:
+                continue
+            if filters.max_price is not None and price > filters.max_price:
+                continue
+            if filters.min_quantity is not None and total_quantity < filters.min_quantity:
+                continue
+            if filters.max_quantity is not None and total_quantity > filters.max_quantity:
+                continue
+            if skip:
+                skip -= 1
+                continue
+            responses.append(self._build_cart_response(cart_id, quantities)[0])
+            if len(responses) == filters.limit:
+                break
+        return responses
+
+    def get_cart_totals(self, cart_ids: list[int] = None, item_id: int = None) -> dict[int, tuple[float, int]]:
+        with self.lock:
+            prices, deleted = self.items.prices, self.items.deleted
+            totals = {}
+            for cart_id in self.carts if cart_ids is None else cart_ids:
+                quantities = self.carts.get(cart_id)
+                if quantities is None or (item_id is not None and item_id not in quantities):
+                    continue
+                price = 0.0
+                total_quantity = 0
+                for line_item_id, quantity in quantities.items():
+                    if self.items.exists(line_item_id):
+                        total_quantity += quantity
+                        if not deleted[line_item_id - 1]:
+                            price += prices[line_item_id - 1] * quantity
+                totals[cart_id] = (price, total_quantity)
+            return totals
+
+    def get_business_metrics(self) -> BusinessMetrics:
+        names, prices, deleted = self.items.names, self.items.prices, self.items.deleted
+        items_count = sum(1 for index, name in enumerate(names) if name is not None and not deleted[index])
+        cart_price_sum = 0.0
+        for quantities in self.carts.values():
+            for item_id, quantity in quantities.items():
+                if self.items.exists(item_id) and not deleted[item_id - 1]:
+                    cart_price_sum += prices[item_id - 1] * quantity
+        return BusinessMetrics(carts=len(self.carts), items=items_count, cart_price_sum=cart_price_sum)
+
+    def get_item_version(self, item_id: int) -> int:
+        return self.items.versions[item_id - 1] if self.items.exists(item_id) else None
+
+    def get_cart_version(self, cart_id: int) -> str:
+        quantities = self.carts.get(cart_id)
+        if quantities is None:
+            return None
+        versions = self.items.versions
+        items_version = sum(versions[item_id - 1] for item_id in quantities if self.items.exists(item_id))
+        return f"{self.cart_versions[cart_id]}.{items_version}"
+
+    def get_catalog_version(self) -> int:
+        return self.catalog_version
@@ -0,0 +1,45 @@
+import glob
+import os
+
+from prometheus_client import multiprocess
+
+
+def multiprocess_dir() -> str:
+    return os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def cleanup_dead_workers(path: str = None) -> list[int]:
+    """Убирает live-гейджи воркеров, которых больше нет.
+
+    Счетчики и гистограммы умерших воркеров остаются: иначе их значения
+    откатились бы назад и сломали rate() в Prometheus.
+    """
+    path = path or multiprocess_dir()
+    if not path:
+        return []
+    pids = set()
+    for filename in glob.glob(os.path.join(path, '*.db')):
+        _, _, pid = os.path.basename(filename)[:-len('.db')].rpartition('_')
+        if pid.isdigit():
+            pids.add(int(pid))
+    dead = sorted(pid for pid in pids if pid != os.getpid() and not _pid_alive(pid))
+    for pid in dead:
+        multiprocess.mark_process_dead(pid, path)
+    return dead
+
+
+def reset_multiprocess_dir(path: str):
+    """Каталог метрик очищается при старте мастера: файлы прошлого запуска не нужны"""
+    os.makedirs(path, exist_ok=True)
+    for filename in glob.glob(os.path.join(path, '*.db')):
+        os.remove(filename)
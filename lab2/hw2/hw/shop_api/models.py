@@ -1,4 +1,6 @@
-from pydantic import BaseModel, NonNegativeFloat, NonNegativeInt, PositiveInt
+from typing import Annotated, Literal
+
+from pydantic import BaseModel, Field, NonNegativeFloat, NonNegativeInt, PositiveInt, PrivateAttr, TypeAdapter
 
 class CreateItemRequest(BaseModel):
     name: str
@@ -10,6 +12,8 @@ class Item(BaseModel):
     price: float
     deleted: bool = False
     
+    _version: int = PrivateAttr(default=None)
+    
 class CartResponseItem(BaseModel):
     id: int
     name: str
@@ -20,6 +24,8 @@ class CartResponse(BaseModel):
     id: int
     items: list[CartResponseItem]
     price: float
+    
+    _version: str = PrivateAttr(default=None)
 
 class Cart(BaseModel):
     id: int
@@ -28,24 +34,33 @@ class Cart(BaseModel):
     def create_cart_response(self, items: dict[int, Item]) -> tuple[CartResponse, int]:
         price = 0.0
         total_quantity = 0
-        prepated_items = []
+        lines = []
 
         for item_id, quantity in self.items.items():
             item = items[item_id]
             total_quantity += quantity
             price += item.price * quantity
-            prepated_items.append(
-                CartResponseItem(
-                    id=item.id,
-                    name=item.name,
-                    quantity=quantity,
-                    available=(not item.deleted),
-                )
-            )
+            lines.append({'id': item.id, 'name': item.name, 'quantity': quantity, 'available': not item.deleted})
+
+        return cart_response_from_rows(self.id, lines, price), total_quantity
+
+
+_ITEM_ROWS = TypeAdapter(list[Item])
 
-        return CartResponse(
-            id=self.id, items=prepated_items, price=price
-        ), total_quantity
+
+def cart_response_from_rows(cart_id: int, lines: list[dict], price: float) -> CartResponse:
+    """CartResponse из наших же данных: вся корзина валидируется одним вызовом pydantic-core,
+    а не отдельным CartResponseItem на строку и повторной проверкой списка в CartResponse"""
+    return CartResponse.model_validate({'id': cart_id, 'items': lines, 'price': price})
+
+
+def items_from_rows(rows: list[dict], versions: list[int] = None) -> list[Item]:
+    """Список Item из строк БД одним вызовом валидатора; versions - версии в том же порядке"""
+    items = _ITEM_ROWS.validate_python(rows)
+    if versions is not None:
+        for item, version in zip(items, versions):
+            item._version = version
+    return items
 
 
 class GetCartsRequest(BaseModel):
@@ -63,6 +78,29 @@ class GetItemsRequest(BaseModel):
     min_price: NonNegativeFloat = None
     max_price: NonNegativeFloat = None
     show_deleted: bool = False
+    sort: Literal['id', 'price'] = 'id'
+    # Подстрока названия без учета регистра (префикс - частный случай)
+    q: Annotated[str, Field(min_length=1, max_length=100)] | None = None
+    # Ключ (price, id) последнего товара предыдущей страницы при sort=price: любой repr(float) из encode_cursor
+    cursor: Annotated[str, Field(pattern=r'^-?(\d+(\.\d+)?(e[+-]?\d+)?|inf|nan):\d+$')] | None = None
+    
+class GetCartStatsRequest(BaseModel):
+    quantile: list[Annotated[float, Field(ge=0, le=1)]] = [0.5, 0.9, 0.99]
+
+class DistributionStats(BaseModel):
+    count: int
+    sum: float
+    mean: float | None
+    min: float | None
+    max: float | None
+    quantiles: dict[str, float | None]
+
+class CartStatsResponse(BaseModel):
+    count: int
+    relative_accuracy: float
+    price: DistributionStats
+    quantity: DistributionStats
+    quantity_histogram: dict[str, int]
     
 class UpdateItemRequest(BaseModel):
     name: str = None
@@ -0,0 +1,167 @@
+import logging
+import os
+import re
+import time
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import Counter, Histogram
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .timing import add_db_time
+
+
+logger = logging.getLogger(__name__)
+
+QUERY_METRICS = os.getenv('DB_QUERY_METRICS', '1') == '1'
+QUERY_BUDGET = int(os.getenv('DB_QUERY_BUDGET', '20'))
+
+BACKGROUND = 'background'
+
+DB_QUERIES = Counter(
+    'app_db_queries_total',
+    'SQL statements executed',
+    ['endpoint', 'operation', 'table']
+)
+DB_QUERY_DURATION = Histogram(
+    'app_db_query_duration_seconds',
+    'SQL statement duration by statement fingerprint',
+    ['endpoint', 'operation', 'table', 'fingerprint'],
+    buckets=[0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0]
+)
+DB_QUERY_ROWS = Histogram(
+    'app_db_query_rows',
+    'Rows returned or affected by an SQL statement, as reported by the driver',
+    ['endpoint', 'operation', 'table'],
+    buckets=[0, 1, 5, 10, 50, 100, 500, 1000, 5000]
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    'app_db_queries_per_request',
+    'SQL statements executed while handling one HTTP request',
+    ['endpoint'],
+    buckets=[0, 1, 2, 3, 5, 8, 13, 20, 50, 100]
+)
+DB_QUERY_BUDGET_EXCEEDED = Counter(
+    'app_db_query_budget_exceeded_total',
+    'HTTP requests that executed more SQL statements than DB_QUERY_BUDGET',
+    ['endpoint']
+)
+
+
+class QueryStats:
+    """Счетчик запросов к БД в рамках одного HTTP-запроса"""
+    __slots__ = ('endpoint', 'count', 'duration', 'fingerprints')
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints: dict[str, int] = {}
+
+    def repeated(self) -> dict[str, int]:
+        """Отпечатки, выполненные больше одного раза: кандидаты в N+1"""
+        return {fingerprint: count for fingerprint, count in self.fingerprints.items() if count > 1}
+
+
+_current_stats: ContextVar[QueryStats] = ContextVar('query_stats', default=None)
+
+
+@contextmanager
+def track_queries(endpoint: str):
+    """Все запросы внутри блока приписываются endpoint"""
+    stats = QueryStats(endpoint)
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+@contextmanager
+def untracked():
+    """Запросы внутри блока идут в BACKGROUND, даже если блок выполняется внутри HTTP-запроса"""
+    token = _current_stats.set(None)
+    try:
+        yield
+    finally:
+        _current_stats.reset(token)
+
+
+def current_stats() -> QueryStats:
+    return _current_stats.get()
+
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|:\w+|\$\d+")
+_PLACEHOLDER_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_SPACES = re.compile(r"\s+")
+_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+\"?(\w+)", re.IGNORECASE)
+
+
+def normalize(statement: str) -> str:
+    """SQL без литералов и параметров: одинаковые по форме запросы совпадают"""
+    statement = _SPACES.sub(' ', _LITERALS.sub('?', statement))
+    return _PLACEHOLDER_LISTS.sub('(?)', statement).strip()
+
+
+def fingerprint(statement: str) -> tuple[str, str, str]:
+    """(operation, table, fingerprint) - короткие метки вместо полного текста SQL"""
+    normalized = normalize(statement)
+    operation = normalized.split(' ', 1)[0].upper() if normalized else 'UNKNOWN'
+    match = _TABLE.search(normalized)
+    table = match.group(1).lower() if match else ''
+    digest = zlib.crc32(normalized.encode()) & 0xffffffff
+    return operation, table, f"{digest:08x}"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    duration = time.perf_counter() - started
+    operation, table, digest = fingerprint(statement)
+    stats = _current_stats.get()
+    endpoint = stats.endpoint if stats is not None else BACKGROUND
+
+    DB_QUERIES.labels(endpoint, operation, table).inc()
+    DB_QUERY_DURATION.labels(endpoint, operation, table, digest).observe(duration)
+    if cursor.rowcount is not None and cursor.rowcount >= 0:
+        DB_QUERY_ROWS.labels(endpoint, operation, table).observe(cursor.rowcount)
+
+    add_db_time(duration)
+    if stats is not None:
+        stats.count += 1
+        stats.duration += duration
+        stats.fingerprints[digest] = stats.fingerprints.get(digest, 0) + 1
+
+
+def _handle_error(exception_context):
+    started = exception_context.connection.info.get('query_started') if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+def instrument_engine(engine: Engine):
+    """Вешает на движок хуки, пишущие метрики по каждому SQL-запросу"""
+    if not QUERY_METRICS or event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        return
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+
+def finish_request(stats: QueryStats, budget: int = None) -> bool:
+    """Записывает итог запроса; True, если бюджет по числу запросов превышен"""
+    budget = QUERY_BUDGET if budget is None else budget
+    DB_QUERIES_PER_REQUEST.labels(stats.endpoint).observe(stats.count)
+    if budget <= 0 or stats.count <= budget:
+        return False
+    DB_QUERY_BUDGET_EXCEEDED.labels(stats.endpoint).inc()
+    logger.warning(
+        "%s executed %d SQL statements (budget %d, %.1f ms); repeated fingerprints: %s",
+        stats.endpoint, stats.count, budget, stats.duration * 1000, stats.repeated(),
+    )
+    return True
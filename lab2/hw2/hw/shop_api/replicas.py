@@ -0,0 +1,77 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+
+_use_primary: ContextVar[bool] = ContextVar('use_primary', default=False)
+
+
+@contextmanager
+def use_primary():
+    """Все чтения внутри блока идут в primary (read-your-writes)"""
+    token = _use_primary.set(True)
+    try:
+        yield
+    finally:
+        _use_primary.reset(token)
+
+
+def primary_required() -> bool:
+    return _use_primary.get()
+
+
+class Replica:
+    def __init__(self, url: str, engine, session_factory):
+        self.url = url
+        self.engine = engine
+        self.session_factory = session_factory
+        self.ejected_until = 0.0
+
+    def is_healthy(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+
+class ReplicaSet:
+    """Round-robin по репликам с временным исключением недоступных"""
+
+    def __init__(self, replicas: list[Replica], eject_seconds: float = 30.0):
+        self.replicas = replicas
+        self.eject_seconds = eject_seconds
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        for replica in replicas:
+            self._watch(replica)
+
+    def _watch(self, replica: Replica):
+        @event.listens_for(replica.engine, "handle_error")
+        def eject_on_connection_error(context):
+            if context.is_disconnect or context.connection is None:
+                self.eject(replica)
+
+    def eject(self, replica: Replica):
+        with self._lock:
+            replica.ejected_until = time.monotonic() + self.eject_seconds
+
+    def pick(self) -> Replica:
+        """Следующая здоровая реплика или None, если таких нет"""
+        if not self.replicas:
+            return None
+        now = time.monotonic()
+        start = next(self._counter)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if replica.is_healthy(now):
+                return replica
+        return None
+
+    def healthy_count(self) -> int:
+        now = time.monotonic()
+        return sum(1 for replica in self.replicas if replica.is_healthy(now))
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
@@ -0,0 +1,45 @@
+import os
+import time
+
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+from .models import CartResponse, Item
+from .timing import add_render_time
+
+
+FAST_JSON_RESPONSES = os.getenv('FAST_JSON_RESPONSES', '1') == '1'
+
+ITEM_ADAPTER = TypeAdapter(Item)
+ITEM_LIST_ADAPTER = TypeAdapter(list[Item])
+CART_RESPONSE_ADAPTER = TypeAdapter(CartResponse)
+CART_RESPONSE_LIST_ADAPTER = TypeAdapter(list[CartResponse])
+
+
+class PydanticJSONResponse(Response):
+    """JSON-ответ, сериализуемый pydantic-core без повторной валидации"""
+    media_type = "application/json"
+
+    def __init__(self, content, adapter: TypeAdapter, status_code: int = 200, headers: dict = None):
+        self.adapter = adapter
+        super().__init__(content=content, status_code=status_code, headers=headers)
+
+    def render(self, content) -> bytes:
+        started = time.perf_counter()
+        body = self.adapter.dump_json(content)
+        add_render_time(time.perf_counter() - started)
+        return body
+
+
+def fast_json(value, adapter: TypeAdapter, headers: dict = None) -> Response:
+    """Отдает модели из БД сразу байтами, минуя response_model FastAPI.
+
+    Если быстрый режим выключен, делает ту же работу, что и стандартный путь
+    FastAPI: dump в dict, повторная валидация и stdlib-энкодер.
+    """
+    if not FAST_JSON_RESPONSES:
+        validated = adapter.validate_python(adapter.dump_python(value))
+        return JSONResponse(jsonable_encoder(validated), headers=headers)
+    return PydanticJSONResponse(value, adapter, headers=headers)
@@ -0,0 +1,40 @@
+"""Запуск shop_api в нескольких воркерах uvicorn с общими метриками Prometheus.
+
+    python -m shop_api.serve
+
+WEB_CONCURRENCY задает число воркеров, по умолчанию - число доступных ядер.
+"""
+import os
+
+import uvicorn
+
+from .metrics import reset_multiprocess_dir
+
+
+def worker_count() -> int:
+    configured = os.getenv('WEB_CONCURRENCY')
+    if configured:
+        return max(1, int(configured))
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def main():
+    workers = worker_count()
+    if workers > 1:
+        os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/shop_api_metrics')
+    path = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        reset_multiprocess_dir(path)
+    uvicorn.run(
+        "shop_api.main:app",
+        host=os.getenv('HOST', '0.0.0.0'),
+        port=int(os.getenv('PORT', '8000')),
+        workers=workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,538 @@
+"""Корзины на нескольких базах: маршрутизация по cart_id и перебалансировка.
+
+    DB_SHARD_URLS=sqlite:///shard0.db,sqlite:///shard1.db python -m shop_api.sharding status
+    python -m shop_api.sharding sync-catalog
+    python -m shop_api.sharding rebalance --wait 10
+
+Корзина лежит в бакете cart_id % BUCKETS, а владельца бакета задает карта
+в общей базе (DATABASE_URL). Id корзин выдает общий счетчик блоками, поэтому
+шард вычисляется из id без запросов. Каталог товаров хранится в общей базе
+и копируется в каждый шард, чтобы запросы корзин оставались JOIN внутри
+одной базы. Чтобы добавить шард, его URL дописывают в DB_SHARD_URLS и
+запускают rebalance: он копирует каталог, помечает переносимые бакеты в
+карте, ждет, пока карта воркеров заведомо обновится, переносит корзины и
+переключает владельцев. Помеченные бакеты отвечают 503. Воркер, который
+не смог перечитать карту дольше max_map_age, не знает, какие бакеты
+переносятся, и отвечает 503 на все запросы корзин, а не пишет в старый шард.
+Воркеры при старте записывают свой max_map_age в общую базу, и rebalance
+ждет не меньше наибольшего из них.
+"""
+import argparse
+import contextvars
+import heapq
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter as Tally
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from prometheus_client import Counter, Histogram
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+
+from .catalog_snapshot import load_catalog
+from .database import Shop
+from .db_models import CartDB, CartShardBucketDB, CounterDB
+from .models import Cart, CartResponse, CreateItemRequest, GetCartsRequest, Item, UpdateItemRequest
+from .storage import BusinessMetrics, DelegatingShop, ShardUnavailable, ShopStorage
+
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = 256
+CART_ID_COUNTER = 'cart_ids'
+# Наибольший max_map_age среди воркеров, в миллисекундах: меньше него rebalance не ждет
+MAP_AGE_COUNTER = 'shard_map_max_age_ms'
+MOVE_BATCH_SIZE = 500
+
+CART_SHARD_REQUESTS = Counter(
+    'app_cart_shard_requests_total',
+    'Single-cart operations routed to each shard',
+    ['shard']
+)
+SHARD_FANOUT_DURATION = Histogram(
+    'app_shard_fanout_seconds',
+    'Duration of operations fanned out to all shards, including the merge',
+    ['method'],
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0]
+)
+SHARD_REPLICATION_FAILURES = Counter(
+    'app_shard_catalog_replication_failures_total',
+    'Catalog writes that could not be copied to a shard; fixed by sync-catalog',
+    ['shard']
+)
+SHARD_MAP_REFRESH_ERRORS = Counter(
+    'app_shard_map_refresh_errors_total',
+    'Failed reloads of the shard map from the shared database'
+)
+SHARD_UNROUTABLE_REQUESTS = Counter(
+    'app_shard_unroutable_requests_total',
+    'Cart operations rejected because the bucket is moving or the shard map is stale',
+    ['reason']
+)
+
+
+class ShardMap:
+    """Владелец каждого бакета: owners[cart_id % BUCKETS] - номер шарда; moving - переносимые бакеты"""
+    __slots__ = ('owners', 'moving')
+
+    def __init__(self, owners, moving=()):
+        self.owners = list(owners)
+        self.moving = frozenset(moving)
+
+    @classmethod
+    def default(cls, shards: int) -> 'ShardMap':
+        return cls(bucket % shards for bucket in range(BUCKETS))
+
+    def shard_of(self, cart_id: int) -> int:
+        return self.owners[cart_id % BUCKETS]
+
+    def counts(self) -> Tally:
+        return Tally(self.owners)
+
+    def with_moving(self, buckets) -> 'ShardMap':
+        return ShardMap(self.owners, buckets)
+
+    def balanced(self, shards: int) -> 'ShardMap':
+        """Карта на shards шардов, отличающаяся от текущей минимальным числом бакетов"""
+        target = [BUCKETS // shards + (1 if shard < BUCKETS % shards else 0) for shard in range(shards)]
+        owners = [owner if owner < shards else None for owner in self.owners]
+        counts = Tally(owner for owner in owners if owner is not None)
+        free = [bucket for bucket, owner in enumerate(owners) if owner is None]
+        for bucket in reversed(range(BUCKETS)):
+            owner = owners[bucket]
+            if owner is not None and counts[owner] > target[owner]:
+                owners[bucket] = None
+                counts[owner] -= 1
+                free.append(bucket)
+        for shard in range(shards):
+            while counts[shard] < target[shard]:
+                owners[free.pop()] = shard
+                counts[shard] += 1
+        return ShardMap(owners)
+
+
+def load_shard_map(shop: Shop, shards: int) -> ShardMap:
+    """Карта из общей базы; при первом запуске записывается карта по умолчанию"""
+    session = shop.db.get_session()
+    try:
+        rows = session.query(CartShardBucketDB.bucket, CartShardBucketDB.shard, CartShardBucketDB.moving).all()
+        owners = {row.bucket: row.shard for row in rows}
+        if len(owners) < BUCKETS:
+            default = ShardMap.default(shards)
+            for bucket in range(BUCKETS):
+                if bucket not in owners:
+                    session.add(CartShardBucketDB(bucket=bucket, shard=default.owners[bucket]))
+            try:
+                session.commit()
+            except IntegrityError:
+                # Карту одновременно записал другой воркер
+                session.rollback()
+            rows = session.query(CartShardBucketDB.bucket, CartShardBucketDB.shard, CartShardBucketDB.moving).all()
+            owners = {row.bucket: row.shard for row in rows}
+    finally:
+        session.close()
+    shard_map = ShardMap((owners[bucket] for bucket in range(BUCKETS)), (row.bucket for row in rows if row.moving))
+    if max(shard_map.owners) >= shards:
+        raise ValueError(f"Shard map refers to shard {max(shard_map.owners)}, but only {shards} shard URLs are configured")
+    return shard_map
+
+
+def publish_max_map_age(shop: Shop, seconds: float):
+    """Поднимает общий максимум возраста карты до seconds; уменьшить его может только ручной сброс"""
+    shop._ensure_counter(MAP_AGE_COUNTER)
+    milliseconds = math.ceil(seconds * 1000)
+    session = shop.db.get_session()
+    try:
+        session.execute(update(CounterDB).where(CounterDB.name == MAP_AGE_COUNTER, CounterDB.value < milliseconds)
+                        .values(value=milliseconds))
+        session.commit()
+    finally:
+        session.close()
+
+
+def enforced_max_map_age(shop: Shop) -> float:
+    """Наибольший max_map_age, который воркеры записали в общую базу; 0, если ни один не записал"""
+    session = shop.db.get_session()
+    try:
+        return (session.scalar(select(CounterDB.value).where(CounterDB.name == MAP_AGE_COUNTER)) or 0) / 1000
+    finally:
+        session.close()
+
+
+def save_shard_map(shop: Shop, shard_map: ShardMap):
+    session = shop.db.get_session()
+    try:
+        for bucket, owner in enumerate(shard_map.owners):
+            session.execute(update(CartShardBucketDB).where(CartShardBucketDB.bucket == bucket)
+                            .values(shard=owner, moving=bucket in shard_map.moving))
+        session.commit()
+    finally:
+        session.close()
+
+
+class CartIdAllocator:
+    """Id корзин из общего счетчика, зарезервированные блоками по block штук"""
+
+    def __init__(self, shop: Shop, block: int = 100):
+        self.shop = shop
+        self.block = block
+        self.lock = threading.Lock()
+        self.next = self.end = 0
+
+    def next_id(self) -> int:
+        with self.lock:
+            if self.next >= self.end:
+                self.next = self.shop.reserve_ids(CART_ID_COUNTER, self.block)
+                self.end = self.next + self.block
+            cart_id = self.next
+            self.next += 1
+            return cart_id
+
+
+class ShardedShop(DelegatingShop):
+    """Хранилище, в котором каталог живет в общей базе self.shop, а корзины - в шардах.
+
+    Операции с одной корзиной идут в ее шард. Списки, итоги и метрики
+    параллельно опрашивают все шарды и сливают ответы. Записи каталога
+    копируются во все шарды после коммита в общей базе. Карта, которую не
+    удалось перечитать дольше max_map_age (по умолчанию два интервала
+    обновления), считается устаревшей, и корзины не маршрутизируются.
+    """
+
+    def __init__(self, shop: Shop, shards: list[Shop], id_block: int = 100, refresh_interval: float = 5.0,
+                 max_map_age: float = None):
+        super().__init__(shop)
+        self.shards = shards
+        self.refresh_interval = refresh_interval
+        self.max_map_age = 2 * refresh_interval if max_map_age is None else max_map_age
+        self.executor = ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix='cart-shard')
+        self.ids = CartIdAllocator(shop, id_block)
+        self.map_loaded_at = time.monotonic()
+        self.map = load_shard_map(shop, len(shards))
+        self._align_cart_ids()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, shop: ShopStorage) -> 'ShardedShop':
+        if not isinstance(shop, Shop):
+            raise ValueError("DB_SHARD_URLS requires the sql backend")
+        urls = [url.strip() for url in os.getenv('DB_SHARD_URLS', '').split(',') if url.strip()]
+        # Шарды той же реализации, что и общая база: строки cart_items или журнал событий
+        shards = [type(shop)(database_url=url, replica_urls=[]) for url in urls]
+        max_map_age = os.getenv('SHARD_MAP_MAX_AGE_SECONDS')
+        return cls(shop, shards, id_block=int(os.getenv('CART_ID_BLOCK', '100')),
+                   refresh_interval=float(os.getenv('SHARD_MAP_REFRESH_SECONDS', '5')),
+                   max_map_age=float(max_map_age) if max_map_age else None)
+
+    def _align_cart_ids(self):
+        """Счетчик id не ниже самой большой корзины: шардом могла стать база с прежними корзинами"""
+        largest = max(self._fan_out('max_cart_id', max_cart_id))
+        self.shop._ensure_counter(CART_ID_COUNTER)
+        session = self.shop.db.get_session()
+        try:
+            session.execute(update(CounterDB).where(CounterDB.name == CART_ID_COUNTER, CounterDB.value < largest)
+                            .values(value=largest))
+            session.commit()
+        finally:
+            session.close()
+
+    def _fan_out(self, method: str, call, shards: list[Shop] = None) -> list:
+        """call(shard) параллельно для shards (по умолчанию всех); результаты в том же порядке"""
+        started = time.perf_counter()
+        futures = [self.executor.submit(contextvars.copy_context().run, call, shard) for shard in shards or self.shards]
+        results = [future.result() for future in futures]
+        SHARD_FANOUT_DURATION.labels(method).observe(time.perf_counter() - started)
+        return results
+
+    def map_is_stale(self) -> bool:
+        # Без фонового обновления (CLI, тесты) карту меняет только этот процесс
+        return self.refresh_interval > 0 and time.monotonic() - self.map_loaded_at > self.max_map_age
+
+    def _owner(self, cart_id: int) -> int:
+        """Номер шарда корзины; ShardUnavailable, если ее бакет переносится или карта устарела"""
+        if self.map_is_stale():
+            SHARD_UNROUTABLE_REQUESTS.labels('stale').inc()
+            raise ShardUnavailable(cart_id, 'shard map is stale')
+        if cart_id % BUCKETS in self.map.moving:
+            SHARD_UNROUTABLE_REQUESTS.labels('moving').inc()
+            raise ShardUnavailable(cart_id, 'bucket is moving')
+        return self.map.shard_of(cart_id)
+
+    def _shard(self, cart_id: int) -> Shop:
+        index = self._owner(cart_id)
+        CART_SHARD_REQUESTS.labels(str(index)).inc()
+        return self.shards[index]
+
+    def warm_up(self, connections: int = 5):
+        self.shop.warm_up(connections)
+        self._fan_out('warm_up', lambda shard: shard.warm_up(connections))
+        if self.refresh_interval > 0 and self._thread is None:
+            publish_max_map_age(self.shop, self.max_map_age)
+            self._thread = threading.Thread(target=self._run, name='shard-map-refresh', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.refresh_interval):
+            # Возраст карты считается от начала чтения: после его начала она могла измениться
+            started = time.monotonic()
+            try:
+                self.map = load_shard_map(self.shop, len(self.shards))
+                self.map_loaded_at = started
+            except Exception:
+                SHARD_MAP_REFRESH_ERRORS.inc()
+                logger.exception("Shard map refresh failed")
+
+    @property
+    def bus(self):
+        """Шина общей базы: записи каталога публикуются там"""
+        return self.shop.bus
+
+    def ping(self) -> bool:
+        return self.shop.ping() and all(self._fan_out('ping', lambda shard: shard.ping()))
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.executor.shutdown()
+        for shard in self.shards:
+            shard.close()
+        self.shop.close()
+
+    def _replicate(self, items: list[Item]):
+        def replicate(shard: Shop):
+            try:
+                shard.replicate_items(items)
+            except Exception:
+                SHARD_REPLICATION_FAILURES.labels(str(self.shards.index(shard))).inc()
+        self._fan_out('replicate_items', replicate)
+
+    def create_item(self, item_data: CreateItemRequest) -> Item:
+        item = self.shop.create_item(item_data)
+        self._replicate([item])
+        return item
+
+    def update_item(self, item_id: int, update_data: UpdateItemRequest, expected_version: int = None) -> Item:
+        item = self.shop.update_item(item_id, update_data, expected_version)
+        if item is not None:
+            self._replicate([item])
+        return item
+
+    def delete_item(self, item_id: int) -> bool:
+        deleted = self.shop.delete_item(item_id)
+        if deleted:
+            self._replicate([self.shop.get_item(item_id)])
+        return deleted
+
+    def hard_delete_item(self, item_id: int) -> bool:
+        replica = self.shop.get_item(item_id)
+        deleted = self.shop.hard_delete_item(item_id)
+        if deleted:
+            # Копия в шардах остается удаленной: на нее могут ссылаться строки корзин
+            replica = replica.model_copy(update={'deleted': True})
+            replica._version = (replica._version or 1) + 1
+            self._replicate([replica])
+        return deleted
+
+    def archive_deleted_items(self, deleted_before, batch_size: int = 500) -> list[int]:
+        """Пачка компактизации: корзины лежат в шардах, поэтому товары из них исключаются явно,
+        а архив повторяется в шардах для копий каталога"""
+        referenced = set()
+        for ids in self._fan_out('deleted_items_in_carts', lambda shard: shard.deleted_items_in_carts()):
+            referenced.update(ids)
+        archived = self.shop.archive_deleted_items(deleted_before, batch_size, keep=referenced)
+        if archived:
+            self._fan_out('archive_items', lambda shard: shard.archive_items(archived))
+        return archived
+
+    def create_cart(self) -> Cart:
+        cart_id = self.ids.next_id()
+        # Новой корзине не нужен бакет, который сейчас переносится: id просто пропускаются
+        while cart_id % BUCKETS in self.map.moving:
+            cart_id = self.ids.next_id()
+        return self._shard(cart_id).create_cart(cart_id)
+
+    def get_cart(self, cart_id: int) -> Cart:
+        return self._shard(cart_id).get_cart(cart_id)
+
+    def add_item_to_cart(self, cart_id: int, item_id: int, quantity: int = 1) -> Cart:
+        return self._shard(cart_id).add_item_to_cart(cart_id, item_id, quantity)
+
+    def remove_item_from_cart(self, cart_id: int, item_id: int) -> Cart:
+        return self._shard(cart_id).remove_item_from_cart(cart_id, item_id)
+
+    def update_cart_item_quantity(self, cart_id: int, item_id: int, quantity: int) -> Cart:
+        return self._shard(cart_id).update_cart_item_quantity(cart_id, item_id, quantity)
+
+    def clear_cart(self, cart_id: int) -> Cart:
+        return self._shard(cart_id).clear_cart(cart_id)
+
+    def delete_cart(self, cart_id: int) -> bool:
+        return self._shard(cart_id).delete_cart(cart_id)
+
+    def get_cart_response(self, cart_id: int) -> tuple:
+        return self._shard(cart_id).get_cart_response(cart_id)
+
+    def get_cart_version(self, cart_id: int) -> str:
+        return self._shard(cart_id).get_cart_version(cart_id)
+
+    def _merged_page(self, method: str, fetch, filters: GetCartsRequest) -> list:
+        """Страница по id из всех шардов: каждый отдает первые offset + limit, слияние по id"""
+        filters = filters or GetCartsRequest()
+        head = filters.model_copy(update={'offset': 0, 'limit': filters.offset + filters.limit})
+        pages = self._fan_out(method, lambda shard: fetch(shard, head))
+        merged = heapq.merge(*pages, key=lambda cart: cart.id)
+        return [cart for _, cart in zip(range(filters.offset + filters.limit), merged)][filters.offset:]
+
+    def get_all_carts(self, filters: GetCartsRequest = None) -> list[Cart]:
+        return self._merged_page('get_all_carts', lambda shard, head: shard.get_all_carts(head), filters)
+
+    def get_cart_responses(self, filters: GetCartsRequest = None) -> list[CartResponse]:
+        return self._merged_page('get_cart_responses', lambda shard, head: shard.get_cart_responses(head), filters)
+
+    def get_cart_totals(self, cart_ids: list[int] = None, item_id: int = None) -> dict[int, tuple[float, int]]:
+        if cart_ids is None:
+            parts = self._fan_out('get_cart_totals', lambda shard: shard.get_cart_totals(None, item_id))
+        else:
+            by_shard: dict[Shop, list[int]] = {}
+            for cart_id in cart_ids:
+                by_shard.setdefault(self.shards[self._owner(cart_id)], []).append(cart_id)
+            if not by_shard:
+                return {}
+            parts = self._fan_out('get_cart_totals', lambda shard: shard.get_cart_totals(by_shard[shard], item_id),
+                                  list(by_shard))
+        totals = {}
+        for part in parts:
+            totals.update(part)
+        return totals
+
+    def get_cart_stats(self):
+        return ShopStorage.get_cart_stats(self)
+
+    def get_business_metrics(self) -> BusinessMetrics:
+        parts = self._fan_out('get_business_metrics', lambda shard: shard.get_business_metrics())
+        return BusinessMetrics(
+            carts=sum(part.carts for part in parts),
+            items=self.shop.get_business_metrics().items,
+            cart_price_sum=sum(part.cart_price_sum for part in parts),
+        )
+
+    def apply_cart_deltas(self, deltas: dict[tuple[int, int], int], synchronous_commit: bool = True) -> int:
+        by_shard: dict[Shop, dict] = {}
+        for (cart_id, item_id), quantity in deltas.items():
+            by_shard.setdefault(self.shards[self._owner(cart_id)], {})[(cart_id, item_id)] = quantity
+        if not by_shard:
+            return 0
+        applied = self._fan_out('apply_cart_deltas', lambda shard: shard.apply_cart_deltas(by_shard[shard], synchronous_commit),
+                                list(by_shard))
+        return sum(applied)
+
+
+def max_cart_id(shard: Shop) -> int:
+    session = shard.db.get_session()
+    try:
+        return session.scalar(select(CartDB.id).order_by(CartDB.id.desc()).limit(1)) or 0
+    finally:
+        session.close()
+
+
+def bucket_cart_ids(shard: Shop, bucket: int) -> list[int]:
+    session = shard.db.get_session()
+    try:
+        return list(session.scalars(select(CartDB.id).where(CartDB.id % BUCKETS == bucket).order_by(CartDB.id)))
+    finally:
+        session.close()
+
+
+def sync_catalog(sharded: ShardedShop) -> int:
+    """Полная копия каталога общей базы в каждый шард: для новых шардов и после сбоев репликации"""
+    items = load_catalog(sharded.shop)
+    for start in range(0, len(items), MOVE_BATCH_SIZE):
+        batch = items[start:start + MOVE_BATCH_SIZE]
+        sharded._fan_out('sync_catalog', lambda shard: shard.replicate_items(batch))
+    return len(items)
+
+
+def move_bucket(source: Shop, target: Shop, bucket: int) -> int:
+    """Корзины бакета пачками: импорт в target одной транзакцией, затем удаление из source.
+    Повторный запуск после сбоя безопасен: импорт пропускает уже перенесенные id."""
+    cart_ids = bucket_cart_ids(source, bucket)
+    for start in range(0, len(cart_ids), MOVE_BATCH_SIZE):
+        carts = [source.get_cart(cart_id) for cart_id in cart_ids[start:start + MOVE_BATCH_SIZE]]
+        target.import_carts([cart for cart in carts if cart is not None])
+        for cart in carts:
+            if cart is not None:
+                source.delete_cart(cart.id)
+    return len(cart_ids)
+
+
+class RebalanceResult(NamedTuple):
+    buckets: int
+    carts: int
+    seconds: float
+
+
+def rebalance(sharded: ShardedShop, wait: float = None) -> RebalanceResult:
+    """Выравнивает бакеты по всем шардам из DB_SHARD_URLS, перенося минимум бакетов.
+    wait по умолчанию - наибольший max_map_age воркеров; меньшее значение - ValueError."""
+    enforced = enforced_max_map_age(sharded.shop)
+    if wait is None:
+        wait = max(enforced, sharded.max_map_age)
+    elif wait < enforced:
+        raise ValueError(f"--wait {wait:g}s is below the {enforced:g}s shard map age workers enforce")
+    started = time.perf_counter()
+    current = sharded.map
+    target = current.balanced(len(sharded.shards))
+    moves = [(bucket, current.owners[bucket], target.owners[bucket])
+             for bucket in range(BUCKETS) if current.owners[bucket] != target.owners[bucket]]
+    if not moves:
+        return RebalanceResult(buckets=0, carts=0, seconds=time.perf_counter() - started)
+
+    sync_catalog(sharded)
+    marked = current.with_moving(bucket for bucket, _, _ in moves)
+    save_shard_map(sharded.shop, marked)
+    sharded.map = marked
+    # Через max_map_age у каждого воркера либо карта с пометками, либо устаревшая карта: оба не пишут в бакет
+    time.sleep(wait)
+    carts = sum(move_bucket(sharded.shards[source], sharded.shards[destination], bucket)
+                for bucket, source, destination in moves)
+    save_shard_map(sharded.shop, target)
+    sharded.map = target
+    return RebalanceResult(buckets=len(moves), carts=carts, seconds=time.perf_counter() - started)
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Inspect and rebalance cart shards')
+    parser.add_argument('command', choices=['status', 'sync-catalog', 'rebalance'])
+    parser.add_argument('--wait', type=float, default=None,
+                        help='seconds to let workers pick up the marked shard map before moving carts '
+                             '(default: the max shard map age workers enforce)')
+    args = parser.parse_args(argv)
+
+    sharded = ShardedShop.from_env(Shop())
+    try:
+        if args.command == 'sync-catalog':
+            print(f"copied {sync_catalog(sharded)} items to {len(sharded.shards)} shards")
+        elif args.command == 'rebalance':
+            try:
+                result = rebalance(sharded, args.wait)
+            except ValueError as error:
+                parser.error(str(error))
+            print(f"moved {result.carts} carts in {result.buckets} buckets, {result.seconds:.2f}s")
+        else:
+            counts = sharded.map.counts()
+            carts = sharded._fan_out('status', lambda shard: shard.get_business_metrics().carts)
+            for index, shard in enumerate(sharded.shards):
+                print(f"shard {index}: {counts[index]} buckets, {carts[index]} carts  {shard.db.database_url}")
+    finally:
+        sharded.close()
+    return 0
+
+
+if __name__ == "__main__":
+    main()
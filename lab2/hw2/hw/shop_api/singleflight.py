@@ -0,0 +1,173 @@
+import os
+import threading
+
+from prometheus_client import Counter
+
+from .models import Cart, Item, UpdateItemRequest
+from .replicas import primary_required
+from .storage import DelegatingShop, ShopStorage
+
+
+SINGLE_FLIGHT_LEADERS = Counter(
+    'app_singleflight_leaders_total',
+    'Lookups that ran the fetch themselves',
+    ['method']
+)
+SINGLE_FLIGHT_COALESCED = Counter(
+    'app_singleflight_coalesced_total',
+    'Lookups that joined an identical in-flight fetch instead of running their own',
+    ['method']
+)
+SINGLE_FLIGHT_TIMEOUTS = Counter(
+    'app_singleflight_timeouts_total',
+    'Coalesced lookups that stopped waiting for the in-flight fetch and ran their own',
+    ['method']
+)
+
+
+class Flight:
+    """Один выполняющийся запрос и его результат для всех, кто его ждет"""
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Склейка одинаковых одновременных вызовов из разных потоков.
+
+    Первый вызов с ключом (лидер) выполняет fetch, остальные ждут его
+    результат или исключение. Ключ - кортеж, первый элемент которого имя
+    метода: он же идет в метки метрик. Ждущий дольше timeout секунд
+    перестает ждать и выполняет fetch сам: для чтения это безопасно.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights: dict[tuple, Flight] = {}
+
+    def do(self, key: tuple, fetch, timeout: float = None):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if leader:
+            SINGLE_FLIGHT_LEADERS.labels(key[0]).inc()
+            try:
+                flight.result = fetch()
+                return flight.result
+            except BaseException as error:
+                flight.error = error
+                raise
+            finally:
+                with self.lock:
+                    if self.flights.get(key) is flight:
+                        del self.flights[key]
+                flight.done.set()
+
+        SINGLE_FLIGHT_COALESCED.labels(key[0]).inc()
+        if not flight.done.wait(timeout):
+            SINGLE_FLIGHT_TIMEOUTS.labels(key[0]).inc()
+            return fetch()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def forget(self, match):
+        """Новые вызовы с подходящими ключами начнут свой fetch, а не присоединятся к начатому до записи"""
+        with self.lock:
+            for key in [key for key in self.flights if match(key)]:
+                del self.flights[key]
+
+
+class CoalescingShop(DelegatingShop):
+    """Хранилище, склеивающее одновременные get_item и get_cart_response с одним ключом.
+
+    Обработчики HTTP вызывают эти чтения через пул потоков (main.shared_read),
+    иначе на event loop одинаковые запросы шли бы по очереди и склеивать было
+    бы нечего. В ключ входит и то, читает ли запрос только с primary, чтобы
+    read-your-writes не получил ответ реплики. После своих записей
+    начатые до них чтения затронутых ключей забываются.
+    """
+
+    def __init__(self, shop: ShopStorage, timeout: float = 1.0):
+        super().__init__(shop)
+        self.timeout = timeout
+        self.flights = SingleFlight()
+
+    @classmethod
+    def from_env(cls, shop: ShopStorage) -> 'CoalescingShop':
+        return cls(shop, timeout=float(os.getenv('SINGLE_FLIGHT_TIMEOUT_MS', '1000')) / 1000)
+
+    def get_item(self, item_id: int) -> Item:
+        return self.flights.do(('get_item', item_id, primary_required()),
+                               lambda: self.shop.get_item(item_id), self.timeout)
+
+    def get_cart_response(self, cart_id: int) -> tuple:
+        return self.flights.do(('get_cart_response', cart_id, primary_required()),
+                               lambda: self.shop.get_cart_response(cart_id), self.timeout)
+
+    def _forget_item(self, item_id: int):
+        # Цена и удаление товара видны во всех корзинах с ним
+        self.flights.forget(lambda key: key[0] == 'get_cart_response' or key[:2] == ('get_item', item_id))
+
+    def invalidate(self, item_ids: list[int] = None):
+        """Подписчик InvalidationBus: чтения, начатые до записи другого воркера, не раздаются новым вызовам"""
+        if item_ids is None:
+            self.flights.forget(lambda key: True)
+            return
+        for item_id in item_ids:
+            self._forget_item(item_id)
+
+    def _forget_carts(self, cart_ids):
+        cart_ids = set(cart_ids)
+        self.flights.forget(lambda key: key[0] == 'get_cart_response' and key[1] in cart_ids)
+
+    def update_item(self, item_id: int, update_data: UpdateItemRequest, expected_version: int = None) -> Item:
+        item = self.shop.update_item(item_id, update_data, expected_version)
+        self._forget_item(item_id)
+        return item
+
+    def delete_item(self, item_id: int) -> bool:
+        deleted = self.shop.delete_item(item_id)
+        self._forget_item(item_id)
+        return deleted
+
+    def hard_delete_item(self, item_id: int) -> bool:
+        deleted = self.shop.hard_delete_item(item_id)
+        self._forget_item(item_id)
+        return deleted
+
+    def add_item_to_cart(self, cart_id: int, item_id: int, quantity: int = 1) -> Cart:
+        cart = self.shop.add_item_to_cart(cart_id, item_id, quantity)
+        self._forget_carts([cart_id])
+        return cart
+
+    def remove_item_from_cart(self, cart_id: int, item_id: int) -> Cart:
+        cart = self.shop.remove_item_from_cart(cart_id, item_id)
+        self._forget_carts([cart_id])
+        return cart
+
+    def update_cart_item_quantity(self, cart_id: int, item_id: int, quantity: int) -> Cart:
+        cart = self.shop.update_cart_item_quantity(cart_id, item_id, quantity)
+        self._forget_carts([cart_id])
+        return cart
+
+    def clear_cart(self, cart_id: int) -> Cart:
+        cart = self.shop.clear_cart(cart_id)
+        self._forget_carts([cart_id])
+        return cart
+
+    def delete_cart(self, cart_id: int) -> bool:
+        deleted = self.shop.delete_cart(cart_id)
+        self._forget_carts([cart_id])
+        return deleted
+
+    def apply_cart_deltas(self, deltas: dict[tuple[int, int], int], synchronous_commit: bool = True) -> int:
+        applied = self.shop.apply_cart_deltas(deltas, synchronous_commit)
+        self._forget_carts(cart_id for cart_id, _ in deltas)
+        return applied
@@ -0,0 +1,268 @@
+import os
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+
+from .models import Cart, CartResponse, CreateItemRequest, GetCartsRequest, GetItemsRequest, Item, UpdateItemRequest
+
+
+class BusinessMetrics(NamedTuple):
+    carts: int
+    items: int
+    cart_price_sum: float
+
+
+class VersionConflict(Exception):
+    """Версия из If-Match не совпала с текущей версией записи"""
+
+    def __init__(self, entity_id: int, current_version: int):
+        super().__init__(f"Version conflict for {entity_id}: current version is {current_version}")
+        self.entity_id = entity_id
+        self.current_version = current_version
+
+
+class ShardUnavailable(Exception):
+    """Корзину нельзя направить в шард: ее бакет переносится или карта шардов устарела"""
+
+    def __init__(self, cart_id: int, reason: str):
+        super().__init__(f"Cart {cart_id} cannot be routed: {reason}")
+        self.cart_id = cart_id
+        self.reason = reason
+
+
+class ShopStorage(ABC):
+    """Интерфейс хранилища магазина, общий для SQL и in-memory реализаций"""
+
+    @abstractmethod
+    def create_item(self, item_data: CreateItemRequest) -> Item: ...
+
+    @abstractmethod
+    def get_item(self, item_id: int) -> Item: ...
+
+    @abstractmethod
+    def get_all_items(self, filters: GetItemsRequest = None) -> list[Item]: ...
+
+    @abstractmethod
+    def update_item(self, item_id: int, update_data: UpdateItemRequest, expected_version: int = None) -> Item: ...
+
+    @abstractmethod
+    def delete_item(self, item_id: int) -> bool: ...
+
+    @abstractmethod
+    def hard_delete_item(self, item_id: int) -> bool: ...
+
+    @abstractmethod
+    def create_cart(self) -> Cart: ...
+
+    @abstractmethod
+    def get_cart(self, cart_id: int) -> Cart: ...
+
+    @abstractmethod
+    def get_all_carts(self, filters: GetCartsRequest = None) -> list[Cart]: ...
+
+    @abstractmethod
+    def add_item_to_cart(self, cart_id: int, item_id: int, quantity: int = 1) -> Cart: ...
+
+    @abstractmethod
+    def remove_item_from_cart(self, cart_id: int, item_id: int) -> Cart: ...
+
+    @abstractmethod
+    def update_cart_item_quantity(self, cart_id: int, item_id: int, quantity: int) -> Cart: ...
+
+    @abstractmethod
+    def clear_cart(self, cart_id: int) -> Cart: ...
+
+    @abstractmethod
+    def delete_cart(self, cart_id: int) -> bool: ...
+
+    @abstractmethod
+    def get_cart_response(self, cart_id: int) -> tuple: ...
+
+    @abstractmethod
+    def get_cart_responses(self, filters: GetCartsRequest = None) -> list[CartResponse]: ...
+
+    @abstractmethod
+    def get_business_metrics(self) -> BusinessMetrics: ...
+
+    @abstractmethod
+    def get_item_version(self, item_id: int) -> int: ...
+
+    @abstractmethod
+    def get_cart_version(self, cart_id: int) -> str: ...
+
+    @abstractmethod
+    def get_catalog_version(self) -> int: ...
+
+    def warm_up(self, connections: int = 5):
+        pass
+
+    def ping(self) -> bool:
+        return True
+
+    def close(self):
+        pass
+
+    def apply_cart_deltas(self, deltas: dict[tuple[int, int], int], synchronous_commit: bool = True) -> int:
+        """Применить накопленные приращения количеств {(cart_id, item_id): quantity}"""
+        applied = 0
+        for (cart_id, item_id), quantity in deltas.items():
+            if self.add_item_to_cart(cart_id, item_id, quantity) is not None:
+                applied += 1
+        return applied
+
+    @abstractmethod
+    def get_cart_totals(self, cart_ids: list[int] = None, item_id: int = None) -> dict[int, tuple[float, int]]:
+        """{cart_id: (цена доступных товаров, общее количество)} одним проходом.
+
+        cart_ids ограничивает набор корзин, item_id - корзинами с этим товаром.
+        """
+        pass
+
+    def get_cart_stats(self):
+        """Распределения по корзинам, собранные одним проходом по get_cart_totals"""
+        from .cart_stats import CartStats
+        return CartStats.from_totals(self.get_cart_totals(), self.get_business_metrics().items)
+
+    def get_all_items_dict(self) -> dict[int, Item]:
+        items = self.get_all_items()
+        return {item.id: item for item in items}
+
+
+class DelegatingShop(ShopStorage):
+    """Обертка над другим хранилищем: по умолчанию все вызовы уходят в self.shop"""
+
+    def __init__(self, shop: ShopStorage):
+        self.shop = shop
+
+    def warm_up(self, connections: int = 5):
+        self.shop.warm_up(connections)
+
+    def ping(self) -> bool:
+        return self.shop.ping()
+
+    def close(self):
+        self.shop.close()
+
+    def create_item(self, item_data: CreateItemRequest) -> Item:
+        return self.shop.create_item(item_data)
+
+    def get_item(self, item_id: int) -> Item:
+        return self.shop.get_item(item_id)
+
+    def get_all_items(self, filters: GetItemsRequest = None) -> list[Item]:
+        return self.shop.get_all_items(filters)
+
+    def update_item(self, item_id: int, update_data: UpdateItemRequest, expected_version: int = None) -> Item:
+        return self.shop.update_item(item_id, update_data, expected_version)
+
+    def delete_item(self, item_id: int) -> bool:
+        return self.shop.delete_item(item_id)
+
+    def hard_delete_item(self, item_id: int) -> bool:
+        return self.shop.hard_delete_item(item_id)
+
+    def create_cart(self) -> Cart:
+        return self.shop.create_cart()
+
+    def get_cart(self, cart_id: int) -> Cart:
+        return self.shop.get_cart(cart_id)
+
+    def get_all_carts(self, filters: GetCartsRequest = None) -> list[Cart]:
+        return self.shop.get_all_carts(filters)
+
+    def add_item_to_cart(self, cart_id: int, item_id: int, quantity: int = 1) -> Cart:
+        return self.shop.add_item_to_cart(cart_id, item_id, quantity)
+
+    def remove_item_from_cart(self, cart_id: int, item_id: int) -> Cart:
+        return self.shop.remove_item_from_cart(cart_id, item_id)
+
+    def update_cart_item_quantity(self, cart_id: int, item_id: int, quantity: int) -> Cart:
+        return self.shop.update_cart_item_quantity(cart_id, item_id, quantity)
+
+    def clear_cart(self, cart_id: int) -> Cart:
+        return self.shop.clear_cart(cart_id)
+
+    def delete_cart(self, cart_id: int) -> bool:
+        return self.shop.delete_cart(cart_id)
+
+    def get_cart_response(self, cart_id: int) -> tuple:
+        return self.shop.get_cart_response(cart_id)
+
+    def get_cart_responses(self, filters: GetCartsRequest = None) -> list[CartResponse]:
+        return self.shop.get_cart_responses(filters)
+
+    def get_business_metrics(self) -> BusinessMetrics:
+        return self.shop.get_business_metrics()
+
+    def get_item_version(self, item_id: int) -> int:
+        return self.shop.get_item_version(item_id)
+
+    def get_cart_version(self, cart_id: int) -> str:
+        return self.shop.get_cart_version(cart_id)
+
+    def get_catalog_version(self) -> int:
+        return self.shop.get_catalog_version()
+
+    def apply_cart_deltas(self, deltas: dict[tuple[int, int], int], synchronous_commit: bool = True) -> int:
+        return self.shop.apply_cart_deltas(deltas, synchronous_commit)
+
+    def get_cart_totals(self, cart_ids: list[int] = None, item_id: int = None) -> dict[int, tuple[float, int]]:
+        return self.shop.get_cart_totals(cart_ids, item_id)
+
+    def get_cart_stats(self):
+        return self.shop.get_cart_stats()
+
+
+def create_storage() -> ShopStorage:
+    """Хранилище без кешей: бэкенд по SHOP_BACKEND и CART_STORAGE, шина инвалидации и шарды.
+    Его же используют фоновые задачи, которым кеши воркера не нужны."""
+    backend = os.getenv('SHOP_BACKEND', 'sql')
+    if backend == 'memory':
+        from .memory import InMemoryShop
+        shop = InMemoryShop(snapshot_path=os.getenv('SHOP_SNAPSHOT_PATH'))
+    elif backend in ('sql', 'postgres') and os.getenv('CART_STORAGE', 'rows') == 'events':
+        from .cart_events import EventSourcedShop
+        shop = EventSourcedShop()
+    elif backend in ('sql', 'postgres'):
+        from .database import Shop
+        shop = Shop()
+    else:
+        raise ValueError(f"Unknown SHOP_BACKEND: {backend}")
+
+    # Шина нужна только кешам над общей базой: in-memory бэкенд живет в одном процессе
+    bus = None
+    if backend != 'memory':
+        from .invalidation import create_invalidation_bus
+        bus = shop.bus = create_invalidation_bus(shop.db.database_url)
+
+    if os.getenv('DB_SHARD_URLS'):
+        from .sharding import ShardedShop
+        shop = ShardedShop.from_env(shop)
+    return shop
+
+
+def create_shop() -> ShopStorage:
+    """Реализация хранилища выбирается переменной окружения SHOP_BACKEND"""
+    shop = create_storage()
+    bus = getattr(shop, 'bus', None)
+    if os.getenv('CATALOG_SNAPSHOT', '0') == '1':
+        from .catalog_snapshot import SnapshotCatalogShop
+        shop = SnapshotCatalogShop.from_env(shop)
+        if bus is not None:
+            bus.subscribe(shop.invalidate)
+    if os.getenv('SINGLE_FLIGHT', '0') == '1':
+        from .singleflight import CoalescingShop
+        shop = CoalescingShop.from_env(shop)
+        if bus is not None:
+            bus.subscribe(shop.invalidate)
+    if os.getenv('CATALOG_INDEX', '0') == '1':
+        from .catalog_index import IndexedCatalogShop
+        shop = IndexedCatalogShop.from_env(shop)
+        if bus is not None:
+            bus.subscribe(shop.invalidate)
+    if os.getenv('CART_WRITE_BEHIND', '0') == '1':
+        from .write_behind import WriteBehindShop
+        shop = WriteBehindShop.from_env(shop)
+    if os.getenv('CART_STATS', '0') == '1':
+        from .cart_stats import CartStatsShop
+        shop = CartStatsShop.from_env(shop)
+    return shop
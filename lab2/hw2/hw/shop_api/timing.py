@@ -0,0 +1,173 @@
+import functools
+import inspect
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi.routing import APIRoute
+from prometheus_client import Histogram
+
+
+SERVER_TIMING_HEADER = os.getenv('SERVER_TIMING', '0') == '1'
+
+REQUEST_PHASE_DURATION = Histogram(
+    'app_request_phase_seconds',
+    'Time spent in each phase of handling a request',
+    ['route', 'phase'],
+    buckets=[0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5]
+)
+
+# labels() на каждый запрос стоит дороже самого замера: дочерние метрики кешируются
+_children: dict[tuple[str, str], object] = {}
+
+
+class RequestTimer:
+    """Отметки времени одного запроса; фазы считаются из них в phases()"""
+    __slots__ = ('route', 'handler_started', 'endpoint_started', 'endpoint_finished', 'handler_finished',
+                 'db', 'db_at_endpoint_start', 'db_at_endpoint_finish', 'rendered')
+
+    def __init__(self):
+        self.route = None
+        self.handler_started = self.endpoint_started = self.endpoint_finished = self.handler_finished = None
+        self.db = 0.0
+        self.db_at_endpoint_start = self.db_at_endpoint_finish = 0.0
+        self.rendered = 0.0
+
+    def phases(self) -> dict[str, float]:
+        """validation - разбор и валидация до вызова эндпоинта, model - работа эндпоинта без БД и рендера,
+        serialize - рендер тела в эндпоинте и сериализация response_model после него"""
+        if self.handler_finished is None or self.endpoint_finished is None:
+            return {}
+        db_in_endpoint = self.db_at_endpoint_finish - self.db_at_endpoint_start
+        endpoint = self.endpoint_finished - self.endpoint_started
+        return {
+            'validation': self.endpoint_started - self.handler_started,
+            'db': self.db,
+            'model': max(0.0, endpoint - db_in_endpoint - self.rendered),
+            'serialize': self.rendered + self.handler_finished - self.endpoint_finished,
+        }
+
+
+_timer: ContextVar[RequestTimer] = ContextVar('request_timer', default=None)
+
+
+def add_db_time(seconds: float):
+    timer = _timer.get()
+    if timer is not None:
+        timer.db += seconds
+
+
+@contextmanager
+def untimed():
+    """Работа внутри блока не попадает в фазы текущего запроса"""
+    token = _timer.set(None)
+    try:
+        yield
+    finally:
+        _timer.reset(token)
+
+
+def add_render_time(seconds: float):
+    timer = _timer.get()
+    if timer is not None:
+        timer.rendered += seconds
+
+
+def timed_endpoint(endpoint):
+    """Отмечает начало и конец вызова эндпоинта; сигнатура сохраняется для FastAPI через __wrapped__"""
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            timer = _timer.get()
+            if timer is None:
+                return await endpoint(*args, **kwargs)
+            timer.endpoint_started = time.perf_counter()
+            timer.db_at_endpoint_start = timer.db
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                timer.db_at_endpoint_finish = timer.db
+                timer.endpoint_finished = time.perf_counter()
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            timer = _timer.get()
+            if timer is None:
+                return endpoint(*args, **kwargs)
+            timer.endpoint_started = time.perf_counter()
+            timer.db_at_endpoint_start = timer.db
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                timer.db_at_endpoint_finish = timer.db
+                timer.endpoint_finished = time.perf_counter()
+    return wrapper
+
+
+class TimedRoute(APIRoute):
+    """Маршрут, размечающий фазы запроса для RequestTimingMiddleware"""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, timed_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = self.path_format
+
+        async def timed_handler(request):
+            timer = _timer.get()
+            if timer is None:
+                return await handler(request)
+            timer.route = route
+            timer.handler_started = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                timer.handler_finished = time.perf_counter()
+        return timed_handler
+
+
+def server_timing(phases: dict[str, float], total: float) -> bytes:
+    parts = [f"{phase};dur={seconds * 1000:.3f}" for phase, seconds in phases.items()]
+    parts.append(f"total;dur={total * 1000:.3f}")
+    return ', '.join(parts).encode('latin-1')
+
+
+def observe(route: str, phases: dict[str, float]):
+    for phase, seconds in phases.items():
+        child = _children.get((route, phase))
+        if child is None:
+            child = _children[(route, phase)] = REQUEST_PHASE_DURATION.labels(route, phase)
+        child.observe(seconds)
+
+
+class RequestTimingMiddleware:
+    """ASGI-middleware: заводит RequestTimer на запрос, пишет фазы в гистограммы
+    и, если server_timing включен, в заголовок Server-Timing"""
+
+    def __init__(self, app, server_timing: bool = None):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timer = RequestTimer()
+        token = _timer.set(timer)
+        started = time.perf_counter()
+        header_enabled = SERVER_TIMING_HEADER if self.server_timing is None else self.server_timing
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start' and header_enabled and timer.route is not None:
+                header = server_timing(timer.phases(), time.perf_counter() - started)
+                message = {**message, 'headers': [*message.get('headers', []), (b'server-timing', header)]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _timer.reset(token)
+            if timer.route is not None:
+                observe(timer.route, timer.phases())
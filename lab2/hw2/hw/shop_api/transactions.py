@@ -0,0 +1,180 @@
+import functools
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from prometheus_client import Counter
+from sqlalchemy.exc import DBAPIError
+
+
+ISOLATION_LEVELS = ('READ COMMITTED', 'REPEATABLE READ', 'SERIALIZABLE')
+
+CART_WRITE = 'cart_write'
+CATALOG_WRITE = 'catalog_write'
+READ = 'read'
+
+DEFAULT_ISOLATION = {
+    CART_WRITE: 'REPEATABLE READ',
+    CATALOG_WRITE: 'READ COMMITTED',
+    READ: 'READ COMMITTED',
+}
+
+# SQLSTATE, при которых транзакцию безопасно повторить целиком
+RETRYABLE_SQLSTATES = {
+    '40001': 'serialization_failure',
+    '40P01': 'deadlock',
+}
+
+DB_TRANSACTIONS = Counter(
+    'app_db_transactions_total',
+    'Shop operations run as database transactions',
+    ['operation']
+)
+DB_TRANSACTION_RETRIES = Counter(
+    'app_db_transaction_retries_total',
+    'Transactions retried after a serialization failure or deadlock',
+    ['operation', 'reason']
+)
+DB_TRANSACTION_ABORTS = Counter(
+    'app_db_transaction_aborts_total',
+    'Transactions given up after exhausting attempts or the retry budget',
+    ['operation', 'reason']
+)
+
+
+_isolation: ContextVar[str] = ContextVar('isolation_level', default=None)
+
+
+def current_isolation() -> str:
+    """Уровень изоляции операции, которая сейчас выполняется в этом контексте"""
+    return _isolation.get()
+
+
+def retry_reason(error: Exception) -> str:
+    """Причина для метрик, если ошибку можно лечить повтором, иначе None"""
+    if not isinstance(error, DBAPIError):
+        return None
+    orig = error.orig
+    sqlstate = getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None)
+    if sqlstate in RETRYABLE_SQLSTATES:
+        return RETRYABLE_SQLSTATES[sqlstate]
+    if 'database is locked' in str(orig):
+        return 'locked'
+    return None
+
+
+def parse_isolation(value: str) -> dict[str, str]:
+    """'cart_write=SERIALIZABLE,update_item=REPEATABLE READ' -> словарь переопределений"""
+    overrides = {}
+    for part in filter(None, (part.strip() for part in value.split(','))):
+        name, _, level = part.partition('=')
+        level = level.strip().upper().replace('_', ' ')
+        if level not in ISOLATION_LEVELS:
+            raise ValueError(f"Unknown isolation level {level!r} for {name.strip()!r}")
+        overrides[name.strip()] = level
+    return overrides
+
+
+class RetryBudget:
+    """Бюджет повторов: каждая транзакция добавляет ratio токенов, каждый повтор тратит один.
+
+    При массовых конфликтах повторы не умножают нагрузку на базу: их доля
+    ограничена ratio от числа транзакций плюс небольшой запас.
+    """
+
+    def __init__(self, ratio: float = 0.2, reserve: float = 10.0):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = reserve
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class TransactionPolicy:
+    """Уровни изоляции по операциям и повтор транзакций при конфликтах.
+
+    Пауза перед повтором - обычный time.sleep в вызывающем потоке, поэтому
+    записи из async-обработчиков идут через пул потоков (main.write). Сумма
+    пауз одной операции не больше max_total_delay: после нее операция
+    прерывается, как при исчерпанных попытках.
+    """
+
+    def __init__(self, overrides: dict[str, str] = None, max_attempts: int = 5, base_delay: float = 0.005,
+                 max_delay: float = 0.2, budget: RetryBudget = None, max_total_delay: float = 0.25):
+        self.overrides = overrides or {}
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_total_delay = max_total_delay
+        self.budget = budget or RetryBudget()
+
+    @classmethod
+    def from_env(cls) -> 'TransactionPolicy':
+        return cls(
+            overrides=parse_isolation(os.getenv('DB_ISOLATION', '')),
+            max_attempts=int(os.getenv('DB_RETRY_ATTEMPTS', '5')),
+            base_delay=float(os.getenv('DB_RETRY_BASE_MS', '5')) / 1000,
+            max_delay=float(os.getenv('DB_RETRY_MAX_MS', '200')) / 1000,
+            max_total_delay=float(os.getenv('DB_RETRY_MAX_TOTAL_MS', '250')) / 1000,
+            budget=RetryBudget(ratio=float(os.getenv('DB_RETRY_BUDGET_RATIO', '0.2'))),
+        )
+
+    def isolation_for(self, operation: str, kind: str) -> str:
+        return self.overrides.get(operation) or self.overrides.get(kind) or DEFAULT_ISOLATION[kind]
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: равномерно от нуля до экспоненциально растущего потолка"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def run(self, operation: str, kind: str, function, *args, **kwargs):
+        token = _isolation.set(self.isolation_for(operation, kind))
+        DB_TRANSACTIONS.labels(operation).inc()
+        self.budget.deposit()
+        try:
+            attempt = 0
+            slept = 0.0
+            while True:
+                try:
+                    return function(*args, **kwargs)
+                except DBAPIError as error:
+                    reason = retry_reason(error)
+                    if reason is None:
+                        raise
+                    attempt += 1
+                    delay = self.backoff(attempt)
+                    if attempt >= self.max_attempts or slept + delay > self.max_total_delay \
+                            or not self.budget.withdraw():
+                        DB_TRANSACTION_ABORTS.labels(operation, reason).inc()
+                        raise
+                    DB_TRANSACTION_RETRIES.labels(operation, reason).inc()
+                    slept += delay
+                    time.sleep(delay)
+        finally:
+            _isolation.reset(token)
+
+
+def transactional(kind: str):
+    """Метод хранилища выполняется с уровнем изоляции своей операции и повторяется при конфликтах.
+
+    Метод должен открывать свою сессию сам: повтор вызывает его заново целиком.
+    """
+    def decorator(method):
+        operation = method.__name__
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            return self.transactions.run(operation, kind, method, self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,350 @@
+import logging
+import os
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy.exc import DataError, IntegrityError
+
+from .models import Cart, CartResponse, CartResponseItem, GetCartsRequest, Item
+from .storage import BusinessMetrics, DelegatingShop, ShopStorage
+
+
+logger = logging.getLogger(__name__)
+
+WRITE_BUFFER_PENDING = Gauge(
+    'app_cart_write_buffer_pending_ops',
+    'Cart increments accepted but not yet committed',
+    multiprocess_mode='livesum'
+)
+WRITE_BUFFER_LOSS_WINDOW = Gauge(
+    'app_cart_write_buffer_loss_window_seconds',
+    'Age of the oldest uncommitted cart increment (what a crash would lose)',
+    multiprocess_mode='livemax'
+)
+WRITE_BUFFER_LAG = Histogram(
+    'app_cart_write_buffer_lag_seconds',
+    'Delay between accepting a cart increment and committing it',
+    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+)
+WRITE_BUFFER_FLUSH_DURATION = Histogram(
+    'app_cart_write_buffer_flush_seconds',
+    'Duration of one write-behind flush transaction'
+)
+WRITE_BUFFER_FLUSHED = Counter(
+    'app_cart_write_buffer_flushed_total',
+    'Merged cart rows written by write-behind flushes'
+)
+WRITE_BUFFER_FLUSH_ERRORS = Counter(
+    'app_cart_write_buffer_flush_errors_total',
+    'Write-behind flushes that failed and were retried'
+)
+WRITE_BUFFER_DROPPED = Counter(
+    'app_cart_write_buffer_dropped_ops_total',
+    'Buffered cart increments dropped because the database rejected their row'
+)
+
+
+class PendingLine:
+    __slots__ = ('quantity', 'name', 'price', 'ops')
+
+    def __init__(self, name: str, price: float):
+        self.quantity = 0
+        self.name = name
+        self.price = price
+        self.ops = 0
+
+
+class CartWriteBuffer:
+    """Копит приращения количеств по (cart_id, item_id) и сбрасывает их пачкой.
+
+    Сброс происходит раз в flush_interval секунд или при накоплении
+    max_pending_ops операций, одной транзакцией. При synchronous_commit=False
+    Postgres подтверждает коммит до записи WAL на диск: окно потерь
+    увеличивается еще на wal_writer_delay.
+
+    Если пачка не записалась isolate_after раз подряд, строки пишутся по
+    одной: строку, которую база отвергает (например, товар удален через
+    hard delete), буфер отбрасывает, чтобы она не держала остальные.
+    """
+
+    def __init__(self, shop: ShopStorage, flush_interval: float = 0.05, max_pending_ops: int = 500,
+                 synchronous_commit: bool = True, isolate_after: int = 3):
+        self.shop = shop
+        self.flush_interval = flush_interval
+        self.max_pending_ops = max_pending_ops
+        self.synchronous_commit = synchronous_commit
+        self.isolate_after = isolate_after
+        self.failed_flushes = 0
+        self.pending: dict[tuple[int, int], PendingLine] = {}
+        self.inflight: dict[tuple[int, int], PendingLine] = {}
+        self.pending_ops = 0
+        self.oldest_pending = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='cart-write-behind', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Останавливает фоновый поток и сливает остаток буфера"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Write-behind flush failed, %d consecutive failures", self.failed_flushes)
+
+    def add(self, cart_id: int, item: Item, quantity: int):
+        with self.lock:
+            line = self.pending.get((cart_id, item.id))
+            if line is None:
+                line = self.pending[cart_id, item.id] = PendingLine(item.name, item.price)
+            line.quantity += quantity
+            line.ops += 1
+            self.pending_ops += 1
+            if self.oldest_pending is None:
+                self.oldest_pending = time.monotonic()
+            WRITE_BUFFER_PENDING.set(self.pending_ops)
+            if self.pending_ops >= self.max_pending_ops:
+                self._wakeup.set()
+
+    def pending_for_cart(self, cart_id: int) -> dict[int, PendingLine]:
+        """Несброшенные строки корзины; вызывать под flush_lock, чтобы не пересечься со сбросом"""
+        with self.lock:
+            return {item_id: line for (pending_cart_id, item_id), line in self.pending.items() if pending_cart_id == cart_id}
+
+    def pending_lines(self) -> dict[tuple[int, int], PendingLine]:
+        """Копия всех несброшенных строк; вызывать под flush_lock, как pending_for_cart"""
+        with self.lock:
+            return dict(self.pending)
+
+    def has_pending(self, cart_id: int = None) -> bool:
+        with self.lock:
+            if cart_id is None:
+                return bool(self.pending)
+            return any(pending_cart_id == cart_id for pending_cart_id, _ in (*self.pending, *self.inflight))
+
+    def flush(self) -> int:
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    WRITE_BUFFER_LOSS_WINDOW.set(0)
+                    return 0
+                batch, self.pending = self.pending, {}
+                self.inflight = batch
+                batch_ops, self.pending_ops = self.pending_ops, 0
+                oldest, self.oldest_pending = self.oldest_pending, None
+
+            deltas = {key: line.quantity for key, line in batch.items()}
+            started = time.monotonic()
+            try:
+                self.shop.apply_cart_deltas(deltas, synchronous_commit=self.synchronous_commit)
+            except Exception:
+                WRITE_BUFFER_FLUSH_ERRORS.inc()
+                self.failed_flushes += 1
+                if self.failed_flushes < self.isolate_after:
+                    self._requeue(batch, batch_ops, oldest)
+                    raise
+                retry = self._apply_each(batch)
+                if retry:
+                    self._requeue(retry, sum(line.ops for line in retry.values()), oldest)
+                    raise
+                self.failed_flushes = 0
+            else:
+                self.failed_flushes = 0
+            finally:
+                with self.lock:
+                    self.inflight = {}
+
+            finished = time.monotonic()
+            WRITE_BUFFER_FLUSH_DURATION.observe(finished - started)
+            WRITE_BUFFER_LAG.observe(finished - oldest)
+            WRITE_BUFFER_FLUSHED.inc(len(batch))
+            with self.lock:
+                WRITE_BUFFER_PENDING.set(self.pending_ops)
+                WRITE_BUFFER_LOSS_WINDOW.set(finished - self.oldest_pending if self.oldest_pending else 0)
+            return len(batch)
+
+    def _apply_each(self, batch: dict[tuple[int, int], PendingLine]) -> dict[tuple[int, int], PendingLine]:
+        """Строки пачки по одной; отвергнутые базой отбрасываются, остальные сбои возвращаются на повтор"""
+        retry = {}
+        for key, line in batch.items():
+            try:
+                self.shop.apply_cart_deltas({key: line.quantity}, synchronous_commit=self.synchronous_commit)
+            except (IntegrityError, DataError):
+                WRITE_BUFFER_DROPPED.inc(line.ops)
+                logger.exception("Dropping %d buffered increments of cart %d, item %d", line.ops, *key)
+            except Exception:
+                retry[key] = line
+        return retry
+
+    def _requeue(self, batch: dict[tuple[int, int], PendingLine], batch_ops: int, oldest: float):
+        with self.lock:
+            for key, line in batch.items():
+                current = self.pending.get(key)
+                if current is None:
+                    self.pending[key] = line
+                else:
+                    current.quantity += line.quantity
+                    current.ops += line.ops
+            self.pending_ops += batch_ops
+            self.oldest_pending = min(oldest, self.oldest_pending or oldest)
+            WRITE_BUFFER_PENDING.set(self.pending_ops)
+
+
+class WriteBehindShop(DelegatingShop):
+    """Хранилище, в котором add_item_to_cart пишет через CartWriteBuffer.
+
+    Чтения одной корзины, итоги корзин и бизнес-метрики накладывают
+    несброшенные приращения поверх данных хранилища (по цене товара на
+    момент добавления); списки и прочие изменения корзин сначала сливают
+    буфер, чтобы сохранить порядок операций.
+    """
+
+    def __init__(self, shop: ShopStorage, buffer: CartWriteBuffer = None):
+        super().__init__(shop)
+        self.buffer = buffer or CartWriteBuffer(shop)
+        self.buffer.start()
+
+    @classmethod
+    def from_env(cls, shop: ShopStorage) -> 'WriteBehindShop':
+        buffer = CartWriteBuffer(
+            shop,
+            flush_interval=float(os.getenv('CART_WRITE_BEHIND_INTERVAL_MS', '50')) / 1000,
+            max_pending_ops=int(os.getenv('CART_WRITE_BEHIND_MAX_OPS', '500')),
+            synchronous_commit=os.getenv('CART_WRITE_BEHIND_SYNC_COMMIT', 'on') != 'off',
+        )
+        return cls(shop, buffer)
+
+    def close(self):
+        try:
+            self.buffer.stop()
+        finally:
+            self.shop.close()
+
+    def add_item_to_cart(self, cart_id: int, item_id: int, quantity: int = 1) -> Cart:
+        cart = self.get_cart(cart_id)
+        item = self.shop.get_item(item_id)
+        if cart is None or item is None or item.deleted:
+            return None
+        self.buffer.add(cart_id, item, quantity)
+        cart.items[item_id] = cart.items.get(item_id, 0) + quantity
+        return cart
+
+    def get_cart(self, cart_id: int) -> Cart:
+        if not self.buffer.has_pending(cart_id):
+            return self.shop.get_cart(cart_id)
+        with self.buffer.flush_lock:
+            pending = self.buffer.pending_for_cart(cart_id)
+            cart = self.shop.get_cart(cart_id)
+        if cart is None:
+            return None
+        for item_id, line in pending.items():
+            cart.items[item_id] = cart.items.get(item_id, 0) + line.quantity
+        return cart
+
+    def get_cart_response(self, cart_id: int) -> tuple:
+        if not self.buffer.has_pending(cart_id):
+            return self.shop.get_cart_response(cart_id)
+        with self.buffer.flush_lock:
+            pending = self.buffer.pending_for_cart(cart_id)
+            cart_response, total_quantity = self.shop.get_cart_response(cart_id)
+        if cart_response is None or not pending:
+            return cart_response, total_quantity
+
+        items = list(cart_response.items)
+        price = cart_response.price
+        positions = {line.id: position for position, line in enumerate(items)}
+        for item_id, line in pending.items():
+            price += line.price * line.quantity
+            total_quantity += line.quantity
+            if item_id in positions:
+                current = items[positions[item_id]]
+                items[positions[item_id]] = current.model_copy(update={'quantity': current.quantity + line.quantity})
+            else:
+                items.append(CartResponseItem(id=item_id, name=line.name, quantity=line.quantity, available=True))
+
+        merged = CartResponse(id=cart_response.id, items=items, price=price)
+        merged._version = self._pending_version(cart_response._version, pending)
+        return merged, total_quantity
+
+    def get_cart_version(self, cart_id: int) -> str:
+        if not self.buffer.has_pending(cart_id):
+            return self.shop.get_cart_version(cart_id)
+        with self.buffer.flush_lock:
+            pending = self.buffer.pending_for_cart(cart_id)
+            version = self.shop.get_cart_version(cart_id)
+        if version is None or not pending:
+            return version
+        return self._pending_version(version, pending)
+
+    def _pending_version(self, version: str, pending: dict[int, PendingLine]) -> str:
+        return f"{version}+{sum(line.ops for line in pending.values())}"
+
+    def _drained(self):
+        if self.buffer.has_pending():
+            self.buffer.flush()
+        return self.shop
+
+    def get_all_carts(self, filters: GetCartsRequest = None) -> list[Cart]:
+        return self._drained().get_all_carts(filters)
+
+    def get_cart_responses(self, filters: GetCartsRequest = None) -> list[CartResponse]:
+        return self._drained().get_cart_responses(filters)
+
+    def get_business_metrics(self) -> BusinessMetrics:
+        # Метрики читаются после каждого запроса: слив буфера здесь свел бы write-behind на нет
+        with self.buffer.flush_lock:
+            pending = self.buffer.pending_lines()
+            metrics = self.shop.get_business_metrics()
+        if not pending:
+            return metrics
+        pending_price = sum(line.price * line.quantity for line in pending.values())
+        return metrics._replace(cart_price_sum=metrics.cart_price_sum + pending_price)
+
+    def remove_item_from_cart(self, cart_id: int, item_id: int) -> Cart:
+        return self._drained().remove_item_from_cart(cart_id, item_id)
+
+    def update_cart_item_quantity(self, cart_id: int, item_id: int, quantity: int) -> Cart:
+        return self._drained().update_cart_item_quantity(cart_id, item_id, quantity)
+
+    def clear_cart(self, cart_id: int) -> Cart:
+        return self._drained().clear_cart(cart_id)
+
+    def delete_cart(self, cart_id: int) -> bool:
+        return self._drained().delete_cart(cart_id)
+
+    def apply_cart_deltas(self, deltas: dict[tuple[int, int], int], synchronous_commit: bool = True) -> int:
+        return self._drained().apply_cart_deltas(deltas, synchronous_commit)
+
+    def get_cart_totals(self, cart_ids: list[int] = None, item_id: int = None) -> dict[int, tuple[float, int]]:
+        with self.buffer.flush_lock:
+            pending = self.buffer.pending_lines()
+            totals = self.shop.get_cart_totals(cart_ids, item_id)
+            if item_id is not None:
+                # Корзины, где товар пока только в буфере, в отфильтрованный итог хранилища не попали
+                missing = {cart_id for cart_id, pending_item_id in pending
+                           if pending_item_id == item_id and cart_id not in totals
+                           and (cart_ids is None or cart_id in cart_ids)}
+                if missing:
+                    totals.update(self.shop.get_cart_totals(sorted(missing)))
+        for (cart_id, _), line in pending.items():
+            if cart_id in totals:
+                price, quantity = totals[cart_id]
+                totals[cart_id] = (price + line.price * line.quantity, quantity + line.quantity)
+        return totals
+
+    def hard_delete_item(self, item_id: int) -> bool:
+        return self._drained().hard_delete_item(item_id)
@@ -1,11 +1,16 @@
+import os
+import sys
 import pytest
 import asyncio
 from fastapi.testclient import TestClient
 from unittest.mock import AsyncMock, MagicMock, patch
 from typing import Generator
 
-from ..shop_api.main import app
-from ..shop_api.models import Cart, Item
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from shop_api.main import app
+from shop_api.memory import InMemoryShop
+from shop_api.models import Cart, CartResponse, CartResponseItem, Item
+from shop_api.storage import create_shop
 
 
 @pytest.fixture(scope="session")
@@ -21,6 +26,39 @@ def client():
     return TestClient(app)
 
 
+@pytest.fixture
+def sqlite_url(tmp_path, monkeypatch):
+    """Shop поверх SQLite-файла вместо живого Postgres"""
+    url = f"sqlite:///{tmp_path / 'shop.db'}"
+    monkeypatch.setenv("DATABASE_URL", url)
+    return url
+
+
+@pytest.fixture(params=["memory", "sqlite", "events", "sharded"])
+def storage(request, tmp_path, monkeypatch):
+    """Одни и те же тесты для каждой реализации ShopStorage"""
+    if request.param == "memory":
+        monkeypatch.setenv("SHOP_BACKEND", "memory")
+    else:
+        monkeypatch.setenv("SHOP_BACKEND", "sql")
+        monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'shop.db'}")
+    if request.param == "events":
+        monkeypatch.setenv("CART_STORAGE", "events")
+    if request.param == "sharded":
+        monkeypatch.setenv("DB_SHARD_URLS", ",".join(f"sqlite:///{tmp_path / f'shard{index}.db'}" for index in range(2)))
+    shop = create_shop()
+    yield shop
+    shop.close()
+
+
+@pytest.fixture
+def memory_client(monkeypatch):
+    """Приложение целиком поверх in-memory хранилища"""
+    monkeypatch.setenv("SHOP_BACKEND", "memory")
+    with TestClient(app) as client:
+        yield client
+
+
 @pytest.fixture
 def sample_item():
     return Item(id=1, name="Test Item", price=100.0, deleted=False)
@@ -33,11 +71,11 @@ def sample_cart():
 
 @pytest.fixture
 def sample_cart_response():
-    return {
-        "id": 1,
-        "items": [{"id": 1, "name": "Test Item", "price": 100.0, "quantity": 2}],
-        "price": 200.0
-    }
+    return CartResponse(
+        id=1,
+        items=[CartResponseItem(id=1, name="Test Item", quantity=2, available=True)],
+        price=200.0
+    )
 
 
 @pytest.fixture
@@ -45,6 +83,7 @@ def mock_shop():
     """Фикстура для мока магазина"""
     with patch('shop_api.main.shop') as mock_shop:
         mock_shop.get_cart_response = MagicMock()
+        mock_shop.get_cart_responses = MagicMock()
         mock_shop.get_cart = MagicMock()
         mock_shop.create_cart = MagicMock()
         mock_shop.get_item = MagicMock()
@@ -53,8 +92,6 @@ def mock_shop():
         mock_shop.get_all_items = MagicMock()
         mock_shop.update_item = MagicMock()
         mock_shop.delete_item = MagicMock()
-        
-        mock_shop.carts = {}
-        mock_shop.items = {}
+        mock_shop.get_business_metrics = MagicMock()
         
         yield mock_shop
\ No newline at end of file
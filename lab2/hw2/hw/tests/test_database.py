@@ -0,0 +1,1411 @@
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+import pytest
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from benchmarks import model_build
+from benchmarks.scaling import compare, run
+from shop_api.database import Shop
+from shop_api.db_faults_demo import TransactionDemo, format_stress_table
+from shop_api.cart_events import EventSourcedShop, snapshot_carts
+from shop_api.cart_stats import CartStatsShop, DDSketch
+from shop_api.catalog_index import IndexedCatalogShop, NgramIndex, PriceIndex
+from shop_api.catalog_snapshot import CatalogSnapshot, SnapshotCatalogShop, write_snapshot
+from shop_api.compaction import compact, main as compaction_main
+from shop_api.db_models import Base, ItemDB
+from shop_api.invalidation import LocalInvalidationBus, PostgresInvalidationBus, decode_message, encode_message
+from shop_api.memory import InMemoryShop
+from shop_api.models import CreateItemRequest, Item, GetCartsRequest, GetItemsRequest, UpdateItemRequest
+from shop_api.query_metrics import track_queries
+from shop_api.replicas import use_primary
+from shop_api.sharding import BUCKETS, ShardMap, ShardedShop, load_shard_map, rebalance
+from shop_api.singleflight import CoalescingShop, Flight, SingleFlight
+from shop_api.storage import BusinessMetrics, ShardUnavailable, VersionConflict, create_shop
+from shop_api.transactions import CART_WRITE, READ, RetryBudget, TransactionPolicy, current_isolation, parse_isolation
+from shop_api.write_behind import CartWriteBuffer, WriteBehindShop
+from prometheus_client import REGISTRY
+from unittest.mock import patch
+
+
+@pytest.fixture
+def replicated_shop(tmp_path, monkeypatch):
+    """Primary и реплика - два разных SQLite-файла без репликации между ними"""
+    primary_url = f"sqlite:///{tmp_path / 'primary.db'}"
+    replica_url = f"sqlite:///{tmp_path / 'replica.db'}"
+    Base.metadata.create_all(bind=create_engine(replica_url))
+    monkeypatch.setenv("DATABASE_URL", primary_url)
+    monkeypatch.setenv("DB_REPLICA_URLS", replica_url)
+    shop = Shop()
+    yield shop
+    shop.close()
+
+
+class TestReadReplicas:
+    """Тесты маршрутизации чтений на реплики"""
+    
+    def test_writes_go_to_primary_and_reads_to_replica(self, replicated_shop):
+        item = replicated_shop.create_item(CreateItemRequest(name="Item", price=10.0))
+        
+        assert replicated_shop.get_item(item.id) is None
+        assert replicated_shop.get_all_items(GetItemsRequest()) == []
+    
+    def test_use_primary_override(self, replicated_shop):
+        item = replicated_shop.create_item(CreateItemRequest(name="Item", price=10.0))
+        
+        with use_primary():
+            assert replicated_shop.get_item(item.id) == item
+    
+    def test_round_robin_between_replicas(self, tmp_path, monkeypatch):
+        urls = [f"sqlite:///{tmp_path / f'replica{i}.db'}" for i in range(2)]
+        monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'primary.db'}")
+        monkeypatch.setenv("DB_REPLICA_URLS", ",".join(urls))
+        shop = Shop()
+        
+        picked = [shop.db.replicas.pick().url for _ in range(4)]
+        
+        assert picked == urls + urls
+        shop.close()
+    
+    def test_unavailable_replica_is_ejected(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'primary.db'}")
+        monkeypatch.setenv("DB_REPLICA_URLS", f"sqlite:///{tmp_path / 'missing' / 'replica.db'}")
+        shop = Shop()
+        item = shop.create_item(CreateItemRequest(name="Item", price=10.0))
+        
+        assert shop.get_item(item.id) == item
+        assert shop.db.replicas.healthy_count() == 0
+        shop.close()
+
+
+class TestStorageContract:
+    """Общий контракт ShopStorage для SQL и in-memory хранилищ"""
+    
+    def test_item_lifecycle(self, storage):
+        item = storage.create_item(CreateItemRequest(name="Item", price=10.0))
+        
+        assert storage.get_item(item.id) == item
+        
+        updated = storage.update_item(item.id, UpdateItemRequest(price=15.0))
+        assert updated.price == 15.0
+        assert updated.name == "Item"
+        
+        assert storage.delete_item(item.id)
+        assert storage.get_item(item.id).deleted
+        assert storage.update_item(999, UpdateItemRequest(price=1.0)) is None
+        assert not storage.delete_item(999)
+    
+    def test_items_price_filter_and_pagination(self, storage):
+        for price in [50.0, 10.0, 30.0, 20.0, 40.0]:
+            storage.create_item(CreateItemRequest(name=f"Item {price}", price=price))
+        storage.delete_item(3)
+        
+        items = storage.get_all_items(GetItemsRequest(min_price=15.0, max_price=45.0))
+        assert [item.id for item in items] == [4, 5]
+        
+        items = storage.get_all_items(GetItemsRequest(min_price=15.0, show_deleted=True, offset=1, limit=2))
+        assert [item.id for item in items] == [3, 4]
+    
+    def test_items_sorted_by_price_with_cursor(self, storage):
+        for price in [50.0, 10.0, 30.0, 20.0, 40.0, 30.0]:
+            storage.create_item(CreateItemRequest(name=f"Item {price}", price=price))
+        storage.delete_item(5)
+        
+        first = storage.get_all_items(GetItemsRequest(sort="price", min_price=15.0, limit=2))
+        assert [(item.price, item.id) for item in first] == [(20.0, 4), (30.0, 3)]
+        
+        second = storage.get_all_items(GetItemsRequest(sort="price", min_price=15.0, limit=2, cursor="30.0:3"))
+        assert [(item.price, item.id) for item in second] == [(30.0, 6), (50.0, 1)]
+    
+    def test_items_name_search(self, storage):
+        for name, price in [("Red Apple", 10.0), ("apple pie", 30.0), ("Pineapple", 20.0),
+                            ("Banana", 5.0), ("100% Apple", 40.0), ("Applesauce", 25.0)]:
+            storage.create_item(CreateItemRequest(name=name, price=price))
+        storage.delete_item(6)
+        storage.update_item(4, UpdateItemRequest(name="Green Apple"))
+
+        items = storage.get_all_items(GetItemsRequest(q="APPLE"))
+        assert [item.id for item in items] == [1, 2, 3, 4, 5]
+
+        items = storage.get_all_items(GetItemsRequest(q="apple", sort="price", min_price=15.0, limit=2))
+        assert [item.id for item in items] == [3, 2]
+        items = storage.get_all_items(GetItemsRequest(q="apple", sort="price", min_price=15.0, cursor="30.0:2"))
+        assert [item.id for item in items] == [5]
+
+        assert [item.id for item in storage.get_all_items(GetItemsRequest(q="ap", show_deleted=True))] == [1, 2, 3, 4, 5, 6]
+        assert [item.id for item in storage.get_all_items(GetItemsRequest(q="0%"))] == [5]
+        assert storage.get_all_items(GetItemsRequest(q="banana")) == []
+
+        milk = storage.create_item(CreateItemRequest(name="Молоко", price=80.0))
+        assert [item.id for item in storage.get_all_items(GetItemsRequest(q="мол"))] == [milk.id]
+        assert [item.id for item in storage.get_all_items(GetItemsRequest(q="МОЛОКО"))] == [milk.id]
+
+    def test_cart_operations(self, storage):
+        first = storage.create_item(CreateItemRequest(name="First", price=10.0))
+        second = storage.create_item(CreateItemRequest(name="Second", price=2.5))
+        cart = storage.create_cart()
+        
+        storage.add_item_to_cart(cart.id, first.id)
+        storage.add_item_to_cart(cart.id, first.id, 2)
+        cart = storage.add_item_to_cart(cart.id, second.id, 4)
+        assert cart.items == {first.id: 3, second.id: 4}
+        
+        cart = storage.update_cart_item_quantity(cart.id, second.id, 1)
+        assert cart.items == {first.id: 3, second.id: 1}
+        
+        storage.delete_item(second.id)
+        assert storage.add_item_to_cart(cart.id, second.id) is None
+        
+        cart_response, total_quantity = storage.get_cart_response(cart.id)
+        assert cart_response.price == 32.5
+        assert total_quantity == 4
+        assert [line.available for line in cart_response.items] == [True, False]
+        
+        assert storage.remove_item_from_cart(cart.id, first.id).items == {second.id: 1}
+        assert storage.clear_cart(cart.id).items == {}
+        assert storage.delete_cart(cart.id)
+        assert storage.get_cart(cart.id) is None
+        assert storage.get_cart_response(cart.id) == (None, 0)
+    
+    def test_cart_responses_filters(self, storage):
+        item = storage.create_item(CreateItemRequest(name="Item", price=100.0))
+        for quantity in [0, 1, 2, 3]:
+            cart = storage.create_cart()
+            if quantity:
+                storage.add_item_to_cart(cart.id, item.id, quantity)
+        
+        responses = storage.get_cart_responses(GetCartsRequest(min_price=150.0, max_quantity=2))
+        assert [response.id for response in responses] == [3]
+        
+        responses = storage.get_cart_responses(GetCartsRequest(offset=1, limit=2))
+        assert [response.id for response in responses] == [2, 3]
+    
+    def test_business_metrics(self, storage):
+        first = storage.create_item(CreateItemRequest(name="First", price=10.0))
+        second = storage.create_item(CreateItemRequest(name="Second", price=5.0))
+        cart = storage.create_cart()
+        storage.add_item_to_cart(cart.id, first.id, 2)
+        storage.add_item_to_cart(cart.id, second.id, 1)
+        storage.delete_item(second.id)
+        
+        assert storage.get_business_metrics() == BusinessMetrics(carts=1, items=1, cart_price_sum=20.0)
+    
+    def test_cart_totals(self, storage):
+        first = storage.create_item(CreateItemRequest(name="First", price=10.0))
+        second = storage.create_item(CreateItemRequest(name="Second", price=1.0))
+        carts = [storage.create_cart() for _ in range(3)]
+        storage.add_item_to_cart(carts[0].id, first.id)
+        storage.add_item_to_cart(carts[1].id, second.id, 2)
+        storage.add_item_to_cart(carts[2].id, first.id, 3)
+        storage.add_item_to_cart(carts[2].id, second.id)
+        
+        assert storage.get_cart_totals() == {
+            carts[0].id: (10.0, 1), carts[1].id: (2.0, 2), carts[2].id: (31.0, 4)
+        }
+        assert storage.get_cart_totals(item_id=first.id) == {carts[0].id: (10.0, 1), carts[2].id: (31.0, 4)}
+        assert storage.get_cart_totals(item_id=second.id) == {carts[1].id: (2.0, 2), carts[2].id: (31.0, 4)}
+
+
+class TestVersions:
+    """Версии записей для ETag и оптимистичной блокировки"""
+    
+    def test_item_version_increments_on_write(self, storage):
+        catalog_version = storage.get_catalog_version()
+        item = storage.create_item(CreateItemRequest(name="Item", price=10.0))
+        
+        assert storage.get_item_version(item.id) == 1
+        assert storage.update_item(item.id, UpdateItemRequest(price=11.0))._version == 2
+        storage.delete_item(item.id)
+        assert storage.get_item_version(item.id) == 3
+        assert storage.get_catalog_version() == catalog_version + 3
+        assert storage.get_item_version(999) is None
+    
+    def test_update_with_stale_version_conflicts(self, storage):
+        item = storage.create_item(CreateItemRequest(name="Item", price=10.0))
+        storage.update_item(item.id, UpdateItemRequest(price=11.0), expected_version=1)
+        
+        with pytest.raises(VersionConflict):
+            storage.update_item(item.id, UpdateItemRequest(price=12.0), expected_version=1)
+        assert storage.get_item(item.id).price == 11.0
+        assert storage.update_item(999, UpdateItemRequest(price=1.0), expected_version=1) is None
+    
+    def test_cart_version_matches_response(self, storage):
+        item = storage.create_item(CreateItemRequest(name="Item", price=10.0))
+        cart = storage.create_cart()
+        before = storage.get_cart_version(cart.id)
+        
+        storage.add_item_to_cart(cart.id, item.id)
+        after_add = storage.get_cart_version(cart.id)
+        storage.update_item(item.id, UpdateItemRequest(price=12.0))
+        after_price_change = storage.get_cart_version(cart.id)
+        
+        assert len({before, after_add, after_price_change}) == 3
+        assert storage.get_cart_response(cart.id)[0]._version == after_price_change
+        assert storage.get_cart_version(999) is None
+
+
+class TestInMemoryShop:
+    """Тесты особенностей in-memory хранилища"""
+    
+    def test_snapshot_roundtrip(self, tmp_path):
+        path = str(tmp_path / "shop.snapshot")
+        shop = InMemoryShop(snapshot_path=path)
+        item = shop.create_item(CreateItemRequest(name="Item", price=10.0))
+        cart = shop.create_cart()
+        shop.add_item_to_cart(cart.id, item.id, 2)
+        shop.close()
+        
+        restored = InMemoryShop(snapshot_path=path)
+        
+        assert restored.get_item(item.id) == item
+        assert restored.get_cart(cart.id) == shop.get_cart(cart.id)
+        assert restored.get_all_items(GetItemsRequest(min_price=5.0)) == [item]
+        assert restored.create_cart().id == cart.id + 1
+    
+    def test_hard_delete_removes_from_price_index(self):
+        shop = InMemoryShop()
+        item = shop.create_item(CreateItemRequest(name="Item", price=10.0))
+        
+        assert shop.hard_delete_item(item.id)
+        
+        assert shop.get_item(item.id) is None
+        assert shop.get_all_items(GetItemsRequest(min_price=1.0, show_deleted=True)) == []
+    
+    def test_backend_selected_by_environment(self, monkeypatch):
+        monkeypatch.setenv("SHOP_BACKEND", "memory")
+        
+        assert isinstance(create_shop(), InMemoryShop)
+        
+        monkeypatch.setenv("SHOP_BACKEND", "unknown")
+        with pytest.raises(ValueError):
+            create_shop()
+
+
+@pytest.fixture
+def write_behind(storage):
+    """Буфер без фонового сброса: тесты сбрасывают его явно"""
+    shop = WriteBehindShop(storage, CartWriteBuffer(storage, flush_interval=3600, max_pending_ops=10_000))
+    yield shop
+    shop.buffer.stop()
+
+
+class TestWriteBehind:
+    """Тесты write-behind буфера для приращений корзины"""
+    
+    def test_reads_see_buffered_increments(self, write_behind, storage):
+        first = storage.create_item(CreateItemRequest(name="First", price=10.0))
+        second = storage.create_item(CreateItemRequest(name="Second", price=2.0))
+        cart = storage.create_cart()
+        storage.add_item_to_cart(cart.id, first.id)
+        version = write_behind.get_cart_version(cart.id)
+        
+        for _ in range(3):
+            write_behind.add_item_to_cart(cart.id, first.id)
+        write_behind.add_item_to_cart(cart.id, second.id, 2)
+        
+        assert storage.get_cart(cart.id).items == {first.id: 1}
+        assert write_behind.get_cart(cart.id).items == {first.id: 4, second.id: 2}
+        cart_response, total_quantity = write_behind.get_cart_response(cart.id)
+        assert cart_response.price == 44.0
+        assert total_quantity == 6
+        assert [(line.id, line.quantity) for line in cart_response.items] == [(first.id, 4), (second.id, 2)]
+        assert write_behind.get_cart_version(cart.id) not in (version, None)
+        assert cart_response._version == write_behind.get_cart_version(cart.id)
+    
+    def test_flush_merges_into_one_batch(self, write_behind, storage):
+        item = storage.create_item(CreateItemRequest(name="Item", price=10.0))
+        cart = storage.create_cart()
+        for _ in range(5):
+            write_behind.add_item_to_cart(cart.id, item.id)
+        
+        with patch.object(storage, "apply_cart_deltas", wraps=storage.apply_cart_deltas) as apply_cart_deltas:
+            assert write_behind.buffer.flush() == 1
+        
+        apply_cart_deltas.assert_called_once_with({(cart.id, item.id): 5}, synchronous_commit=True)
+        assert storage.get_cart(cart.id).items == {item.id: 5}
+        assert REGISTRY.get_sample_value("app_cart_write_buffer_pending_ops") == 0
+    
+    def test_rejected_increments_are_not_buffered(self, write_behind, storage):
+        item = storage.create_item(CreateItemRequest(name="Item", price=10.0))
+        storage.delete_item(item.id)
+        cart = storage.create_cart()
+        
+        assert write_behind.add_item_to_cart(cart.id, item.id) is None
+        assert write_behind.add_item_to_cart(999, item.id) is None
+        assert not write_behind.buffer.has_pending()
+    
+    def test_list_reads_drain_buffer(self, write_behind, storage):
+        item = storage.create_item(CreateItemRequest(name="Item", price=10.0))
+        cart = storage.create_cart()
+        write_behind.add_item_to_cart(cart.id, item.id, 3)
+        
+        responses = write_behind.get_cart_responses(GetCartsRequest(min_quantity=3))
+        
+        assert [response.id for response in responses] == [cart.id]
+        assert not write_behind.buffer.has_pending()
+    
+    def test_metrics_and_totals_overlay_buffer(self, write_behind, storage):
+        item = storage.create_item(CreateItemRequest(name="Item", price=10.0))
+        other = storage.create_item(CreateItemRequest(name="Other", price=1.0))
+        first, second = storage.create_cart(), storage.create_cart()
+        storage.add_item_to_cart(first.id, other.id)
+        write_behind.add_item_to_cart(first.id, item.id, 2)
+        write_behind.add_item_to_cart(second.id, item.id)
+
+        assert write_behind.get_business_metrics().cart_price_sum == 31.0
+        assert write_behind.get_cart_totals() == {first.id: (21.0, 3), second.id: (10.0, 1)}
+        assert write_behind.get_cart_totals(item_id=item.id) == {first.id: (21.0, 3), second.id: (10.0, 1)}
+        assert write_behind.get_cart_totals([second.id]) == {second.id: (10.0, 1)}
+        assert write_behind.buffer.has_pending()
+
+    def test_failed_flush_is_requeued(self, write_behind, storage):
+        item = storage.create_item(CreateItemRequest(name="Item", price=10.0))
+        cart = storage.create_cart()
+        write_behind.add_item_to_cart(cart.id, item.id, 2)
+        
+        with patch.object(storage, "apply_cart_deltas", side_effect=RuntimeError("db is down")):
+            with pytest.raises(RuntimeError):
+                write_behind.buffer.flush()
+        write_behind.add_item_to_cart(cart.id, item.id)
+        
+        assert write_behind.get_cart(cart.id).items == {item.id: 3}
+        write_behind.buffer.flush()
+        assert storage.get_cart(cart.id).items == {item.id: 3}
+    
+    def test_rejected_row_is_dropped_after_repeated_failures(self, write_behind, storage, caplog):
+        item = storage.create_item(CreateItemRequest(name="Item", price=10.0))
+        good, bad = storage.create_cart(), storage.create_cart()
+        write_behind.add_item_to_cart(good.id, item.id, 2)
+        write_behind.add_item_to_cart(bad.id, item.id)
+        apply_cart_deltas = storage.apply_cart_deltas
+
+        def reject_bad_cart(deltas, synchronous_commit=True):
+            if (bad.id, item.id) in deltas:
+                raise IntegrityError("INSERT INTO cart_items", {}, Exception("foreign key"))
+            return apply_cart_deltas(deltas, synchronous_commit)
+        dropped = REGISTRY.get_sample_value("app_cart_write_buffer_dropped_ops_total") or 0
+
+        with patch.object(storage, "apply_cart_deltas", side_effect=reject_bad_cart):
+            for _ in range(write_behind.buffer.isolate_after - 1):
+                with pytest.raises(IntegrityError):
+                    write_behind.buffer.flush()
+            write_behind.buffer.flush()
+
+        assert storage.get_cart(good.id).items == {item.id: 2}
+        assert storage.get_cart(bad.id).items == {}
+        assert not write_behind.buffer.has_pending()
+        assert REGISTRY.get_sample_value("app_cart_write_buffer_dropped_ops_total") == dropped + 1
+        assert "Dropping 1 buffered increments" in caplog.text
+
+    def test_close_releases_storage_when_final_flush_fails(self, storage):
+        item = storage.create_item(CreateItemRequest(name="Item", price=10.0))
+        cart = storage.create_cart()
+        shop = WriteBehindShop(storage, CartWriteBuffer(storage, flush_interval=3600))
+        shop.add_item_to_cart(cart.id, item.id)
+
+        with patch.object(storage, "apply_cart_deltas", side_effect=RuntimeError("db is down")), \
+                patch.object(storage, "close") as close:
+            with pytest.raises(RuntimeError):
+                shop.close()
+
+        close.assert_called_once_with()
+
+    def test_close_drains_buffer(self, storage):
+        item = storage.create_item(CreateItemRequest(name="Item", price=10.0))
+        cart = storage.create_cart()
+        shop = WriteBehindShop(storage, CartWriteBuffer(storage, flush_interval=3600))
+        shop.add_item_to_cart(cart.id, item.id)
+        
+        shop.buffer.stop()
+        
+        assert storage.get_cart(cart.id).items == {item.id: 1}
+    
+    def test_enabled_by_environment(self, monkeypatch):
+        monkeypatch.setenv("SHOP_BACKEND", "memory")
+        monkeypatch.setenv("CART_WRITE_BEHIND", "1")
+        monkeypatch.setenv("CART_WRITE_BEHIND_SYNC_COMMIT", "off")
+        
+        shop = create_shop()
+        
+        assert isinstance(shop, WriteBehindShop)
+        assert not shop.buffer.synchronous_commit
+        shop.close()
+
+
+class TestScalingBenchmarks:
+    """Тесты бенчмарка масштабирования на маленьких наборах данных"""
+
+    def test_queries_per_call_do_not_grow_with_data(self, sqlite_url):
+        shop = Shop()
+        try:
+            results = run(shop, [20, 200], repeat=2)
+        finally:
+            shop.close()
+
+        for name, small in results["20"].items():
+            assert results["200"][name]["queries"] == small["queries"], name
+        sized = [queries for name, queries in
+                 ((name, row["queries"]) for name, row in results["200"].items()) if name.startswith("get_cart_response[")]
+        assert len(set(sized)) == 1
+
+    def test_compare_flags_slowdowns_and_extra_queries(self):
+        baseline = {"1000": {"get_item": {"median_ms": 1.0, "p95_ms": 1.0, "queries": 1.0}}}
+        slower = {"1000": {"get_item": {"median_ms": 3.0, "p95_ms": 3.0, "queries": 1.0}}}
+        chattier = {"1000": {"get_item": {"median_ms": 1.0, "p95_ms": 1.0, "queries": 2.0}}}
+        noise = {"1000": {"get_item": {"median_ms": 1.4, "p95_ms": 1.4, "queries": 1.0}}}
+
+        assert len(compare(slower, baseline, max_slowdown=1.5)) == 1
+        assert len(compare(chattier, baseline, max_slowdown=1.5)) == 1
+        assert compare(noise, baseline, max_slowdown=1.2) == []
+
+    def test_trusted_model_build_matches_validated(self):
+        results = model_build.run(sizes=[1, 5], repeat=1, number=10)
+
+        assert set(results) == {"cart_response[1]", "item_list[1]", "cart_response[5]", "item_list[5]"}
+        assert all(row["trusted_us"] > 0 for row in results.values())
+        assert "cart_response[5]" in model_build.format_report(results)
+
+
+class SerializationFailure(Exception):
+    pgcode = "40001"
+
+
+def serialization_failure():
+    return OperationalError("UPDATE cart_items", {}, SerializationFailure("could not serialize access"))
+
+
+class TestTransactions:
+    """Тесты уровней изоляции по операциям и повторов при конфликтах"""
+
+    def test_isolation_per_operation(self):
+        policy = TransactionPolicy(overrides=parse_isolation("cart_write=serializable,get_cart=REPEATABLE READ"))
+
+        assert policy.isolation_for("add_item_to_cart", CART_WRITE) == "SERIALIZABLE"
+        assert policy.isolation_for("get_cart", READ) == "REPEATABLE READ"
+        assert policy.isolation_for("get_item", READ) == "READ COMMITTED"
+        with pytest.raises(ValueError):
+            parse_isolation("read=SNAPSHOT")
+
+    def test_operation_sees_its_isolation_level(self):
+        policy = TransactionPolicy()
+
+        level = policy.run("add_item_to_cart", CART_WRITE, current_isolation)
+
+        assert level == "REPEATABLE READ"
+        assert current_isolation() is None
+
+    def test_serialization_failure_is_retried(self):
+        policy = TransactionPolicy(base_delay=0)
+        calls = []
+        labels = {"operation": "flaky", "reason": "serialization_failure"}
+        before = REGISTRY.get_sample_value("app_db_transaction_retries_total", labels) or 0
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise serialization_failure()
+            return "ok"
+
+        assert policy.run("flaky", CART_WRITE, flaky) == "ok"
+        assert len(calls) == 3
+        assert REGISTRY.get_sample_value("app_db_transaction_retries_total", labels) == before + 2
+
+    def test_gives_up_after_max_attempts(self):
+        policy = TransactionPolicy(max_attempts=2, base_delay=0)
+        labels = {"operation": "hopeless", "reason": "serialization_failure"}
+        before = REGISTRY.get_sample_value("app_db_transaction_aborts_total", labels) or 0
+
+        def hopeless():
+            raise serialization_failure()
+
+        with pytest.raises(OperationalError):
+            policy.run("hopeless", CART_WRITE, hopeless)
+        assert REGISTRY.get_sample_value("app_db_transaction_aborts_total", labels) == before + 1
+
+    def test_retry_budget_limits_retries(self):
+        policy = TransactionPolicy(max_attempts=100, base_delay=0, budget=RetryBudget(ratio=0, reserve=3))
+        calls = []
+
+        def hopeless():
+            calls.append(1)
+            raise serialization_failure()
+
+        with pytest.raises(OperationalError):
+            policy.run("hopeless", CART_WRITE, hopeless)
+        assert len(calls) == 4
+
+    def test_total_backoff_is_capped(self):
+        """Суммарная пауза перед повторами не больше max_total_delay"""
+        policy = TransactionPolicy(max_attempts=100, base_delay=0.1, max_delay=0.1, max_total_delay=0.25)
+        slept = []
+
+        def hopeless():
+            raise serialization_failure()
+
+        with patch("shop_api.transactions.random.uniform", side_effect=lambda low, high: high), \
+                patch("shop_api.transactions.time.sleep", side_effect=slept.append):
+            with pytest.raises(OperationalError):
+                policy.run("hopeless", CART_WRITE, hopeless)
+        assert slept == [0.1, 0.1]
+
+    def test_other_errors_are_not_retried(self, sqlite_url):
+        shop = Shop()
+        calls = []
+        original = shop.db.get_session
+
+        def broken_session(*args, **kwargs):
+            calls.append(1)
+            raise OperationalError("SELECT 1", {}, Exception("no such table: items"))
+
+        shop.db.get_session = broken_session
+        try:
+            with pytest.raises(OperationalError):
+                shop.get_item(1)
+        finally:
+            shop.db.get_session = original
+            shop.close()
+        assert len(calls) == 1
+
+
+class TestStress:
+    """Тесты стресс-режима TransactionDemo на SQLite"""
+
+    def test_stress_report(self, sqlite_url):
+        demo = TransactionDemo()
+        try:
+            report = demo.stress("READ COMMITTED", writers=2, readers=1, duration=0.3)
+        finally:
+            demo.shop.close()
+
+        assert report["isolation"] == "READ COMMITTED"
+        assert report["successful_adds"] > 0
+        assert report["committed_ops_per_sec"] > 0
+        assert report["lost_updates"] >= 0
+        assert report["write_p99_ms"] > 0
+        assert "READ COMMITTED" in format_stress_table([report])
+
+
+class TestCompaction:
+    """Тесты переноса давно удаленных товаров в архив"""
+
+    def age_deletions(self, shop, days):
+        session = shop.db.get_session()
+        try:
+            session.query(ItemDB).filter(ItemDB.deleted == True).update(
+                {ItemDB.deleted_at: datetime.now(timezone.utc) - timedelta(days=days)}
+            )
+            session.commit()
+        finally:
+            session.close()
+
+    def test_old_deleted_items_are_archived(self, sqlite_url):
+        shop = Shop()
+        try:
+            items = [shop.create_item(CreateItemRequest(name=f"Item {i}", price=float(i))) for i in range(1, 8)]
+            cart = shop.create_cart()
+            shop.add_item_to_cart(cart.id, items[1].id)
+            for item in items[:5]:
+                shop.delete_item(item.id)
+            self.age_deletions(shop, days=400)
+
+            result = compact(shop, timedelta(days=365), batch_size=2)
+
+            assert result.moved == 4
+            assert result.batches == 2
+            assert shop.get_item(items[0].id) is None
+            assert shop.get_item(items[1].id).deleted
+            listed = shop.get_all_items(GetItemsRequest(show_deleted=True, limit=100))
+            assert [item.id for item in listed] == [item.id for item in items]
+            assert all(item.deleted for item in listed[:5])
+            assert [item.id for item in shop.get_all_items(GetItemsRequest(limit=100))] == [items[5].id, items[6].id]
+            assert [item.id for item in shop.get_all_items(GetItemsRequest(show_deleted=True, min_price=3, max_price=4))] == [3, 4]
+        finally:
+            shop.close()
+
+    def test_recent_deletions_are_kept(self, sqlite_url):
+        shop = Shop()
+        try:
+            item = shop.create_item(CreateItemRequest(name="Item", price=1.0))
+            shop.delete_item(item.id)
+
+            assert compact(shop, timedelta(days=365)).moved == 0
+            assert shop.get_item(item.id).deleted
+        finally:
+            shop.close()
+
+    def test_cli_publishes_archived_ids(self, sqlite_url, monkeypatch):
+        """Кеши воркеров узнают об архивных товарах через шину инвалидации"""
+        monkeypatch.setenv("INVALIDATION_BUS", "local")
+        shop = Shop()
+        try:
+            items = [shop.create_item(CreateItemRequest(name=f"Item {i}", price=1.0)) for i in range(3)]
+            for item in items[:2]:
+                shop.delete_item(item.id)
+            self.age_deletions(shop, days=400)
+
+            with patch.object(LocalInvalidationBus, "publish", autospec=True) as publish:
+                compaction_main(["--retention-days", "365", "--pause", "0"])
+
+            assert [list(call.args[2]) for call in publish.call_args_list] == [[items[0].id, items[1].id]]
+        finally:
+            shop.close()
+
+    def test_cli_uses_event_sourced_carts(self, sqlite_url, monkeypatch):
+        """С CART_STORAGE=events задача видит корзины в журнале, а не в пустой cart_items"""
+        monkeypatch.setenv("CART_STORAGE", "events")
+        shop = EventSourcedShop()
+        try:
+            kept, archived = [shop.create_item(CreateItemRequest(name=f"Item {i}", price=1.0)) for i in range(2)]
+            cart = shop.create_cart()
+            shop.add_item_to_cart(cart.id, kept.id)
+            shop.delete_item(kept.id)
+            shop.delete_item(archived.id)
+            self.age_deletions(shop, days=400)
+
+            result = compaction_main(["--retention-days", "365", "--pause", "0"])
+
+            assert result.moved == 1
+            assert shop.get_item(archived.id) is None
+            assert shop.get_item(kept.id).deleted
+            assert shop.get_cart_response(cart.id)[0].items[0].available is False
+        finally:
+            shop.close()
+
+
+@pytest.fixture
+def events_shop(sqlite_url):
+    shop = EventSourcedShop()
+    yield shop
+    shop.close()
+
+
+class TestCartEvents:
+    """Тесты корзин в виде журнала событий со снапшотами"""
+
+    def fill_cart(self, shop):
+        first = shop.create_item(CreateItemRequest(name="First", price=10.0))
+        second = shop.create_item(CreateItemRequest(name="Second", price=2.5))
+        cart = shop.create_cart()
+        for _ in range(3):
+            shop.add_item_to_cart(cart.id, first.id)
+        shop.add_item_to_cart(cart.id, second.id, 4)
+        shop.update_cart_item_quantity(cart.id, first.id, 5)
+        shop.remove_item_from_cart(cart.id, second.id)
+        shop.add_item_to_cart(cart.id, second.id)
+        return cart.id, first.id, second.id
+
+    def test_snapshot_bounds_replay_and_keeps_history(self, events_shop):
+        cart_id, first_id, second_id = self.fill_cart(events_shop)
+        before = events_shop.get_cart_response(cart_id)[0]
+
+        result = snapshot_carts(events_shop, max_replay=3, settle=0)
+        events_shop.add_item_to_cart(cart_id, first_id)
+
+        session = events_shop.db.get_session()
+        try:
+            assert events_shop._load_state(session, cart_id).replayed == 1
+        finally:
+            session.close()
+        assert result.carts == 1
+        assert events_shop.get_cart(cart_id).items == {first_id: 6, second_id: 1}
+        assert events_shop.get_cart_response(cart_id)[0].items[1:] == before.items[1:]
+        assert [event["kind"] for event in events_shop.get_cart_events(cart_id)] == \
+            ["add", "add", "add", "add", "set", "remove", "add", "add"]
+
+    def test_prune_and_unsettled_events(self, events_shop):
+        cart_id, first_id, second_id = self.fill_cart(events_shop)
+
+        assert snapshot_carts(events_shop, max_replay=3, settle=60).carts == 0
+        assert snapshot_carts(events_shop, max_replay=3, settle=0, prune=True).carts == 1
+        assert events_shop.get_cart_events(cart_id) == []
+        assert events_shop.get_cart(cart_id).items == {first_id: 5, second_id: 1}
+        assert events_shop.get_cart_totals([cart_id]) == {cart_id: (52.5, 6)}
+
+    def test_aggregates_match_fold_without_loading_all_carts(self, events_shop):
+        """Итоги, метрики и фильтры считаются в SQL и совпадают со сверткой журнала"""
+        rng = random.Random(7)
+        items = [events_shop.create_item(CreateItemRequest(name=f"Item {i}", price=float(i + 1))) for i in range(4)]
+        carts = [events_shop.create_cart().id for _ in range(6)]
+        for step in range(150):
+            cart_id, item = rng.choice(carts), rng.choice(items)
+            action = rng.random()
+            if action < 0.5:
+                events_shop.add_item_to_cart(cart_id, item.id, rng.randint(1, 3))
+            elif action < 0.7:
+                events_shop.update_cart_item_quantity(cart_id, item.id, rng.randint(0, 4))
+            elif action < 0.85:
+                events_shop.remove_item_from_cart(cart_id, item.id)
+            elif action < 0.9:
+                events_shop.clear_cart(cart_id)
+            if step == 75:
+                snapshot_carts(events_shop, max_replay=2, settle=0)
+        events_shop.delete_item(items[0].id)
+
+        carts_now = {cart_id: events_shop.get_cart(cart_id).items for cart_id in carts}
+        prices = {item.id: item.price for item in items}
+        expected = {cart_id: (sum(prices[item_id] * quantity for item_id, quantity in lines.items()
+                                  if item_id != items[0].id), sum(lines.values()))
+                    for cart_id, lines in carts_now.items()}
+        with_item = {cart_id for cart_id, lines in carts_now.items() if items[1].id in lines}
+        all_prices = {cart_id: sum(prices[item_id] * quantity for item_id, quantity in lines.items())
+                      for cart_id, lines in carts_now.items()}
+
+        with patch.object(EventSourcedShop, "_load_states", autospec=True,
+                          side_effect=EventSourcedShop._load_states) as load:
+            assert events_shop.get_cart_totals() == pytest.approx(expected)
+            assert events_shop.get_cart_totals(carts[:2]) == pytest.approx({cart_id: expected[cart_id] for cart_id in carts[:2]})
+            assert set(events_shop.get_cart_totals(item_id=items[1].id)) == with_item
+            metrics = events_shop.get_business_metrics()
+            page = events_shop.get_cart_responses(GetCartsRequest(min_price=5.0, limit=100))
+            # Сворачиваются только корзины страницы, а не весь журнал
+            assert all(len(call.args) > 2 and call.args[2] is not None for call in load.call_args_list)
+        assert metrics.carts == len(carts)
+        assert metrics.cart_price_sum == pytest.approx(sum(price for price, _ in expected.values()))
+        assert [cart.id for cart in page] == sorted(cart_id for cart_id, price in all_prices.items() if price >= 5.0)
+
+    def test_set_after_remove_is_ignored_by_aggregates(self, events_shop):
+        """SET без строки в корзине (гонка remove и set) ничего не меняет ни в свертке, ни в SQL"""
+        item = events_shop.create_item(CreateItemRequest(name="Milk", price=10.0))
+        cart = events_shop.create_cart()
+        snapshotted = events_shop.create_cart()
+        events_shop.add_item_to_cart(snapshotted.id, item.id, 2)
+        snapshot_carts(events_shop, max_replay=0, settle=0)
+        session = events_shop.db.get_session()
+        try:
+            for kind, quantity in [("add", 1), ("remove", None), ("set", 5)]:
+                events_shop._append(session, cart.id, kind, item.id, quantity)
+            for kind, quantity in [("clear", None), ("set", 7), ("add", 3), ("set", 4)]:
+                events_shop._append(session, snapshotted.id, kind, None if kind == "clear" else item.id, quantity)
+            session.commit()
+        finally:
+            session.close()
+
+        assert events_shop.get_cart(cart.id).items == {}
+        assert events_shop.get_cart(snapshotted.id).items == {item.id: 4}
+        assert events_shop.get_cart_totals() == {cart.id: (0.0, 0), snapshotted.id: (40.0, 4)}
+        assert events_shop.get_business_metrics().cart_price_sum == 40.0
+        assert events_shop.get_cart_responses(GetCartsRequest(min_price=1.0)) == \
+            [events_shop.get_cart_response(snapshotted.id)[0]]
+
+    def test_cart_items_are_not_archived(self, events_shop):
+        cart_id, first_id, second_id = self.fill_cart(events_shop)
+        snapshot_carts(events_shop, max_replay=3, settle=0, prune=True)
+        events_shop.delete_item(first_id)
+        TestCompaction().age_deletions(events_shop, days=400)
+
+        assert compact(events_shop, timedelta(days=365)).moved == 0
+        assert events_shop.get_cart_response(cart_id)[0].items[0].available is False
+
+
+def shard_urls(tmp_path, count):
+    return [f"sqlite:///{tmp_path / f'shard{index}.db'}" for index in range(count)]
+
+
+@pytest.fixture
+def sharded_shop(sqlite_url, tmp_path):
+    shop = ShardedShop(Shop(), [Shop(url, replica_urls=[]) for url in shard_urls(tmp_path, 2)],
+                       id_block=3, refresh_interval=0)
+    yield shop
+    shop.close()
+
+
+class TestSharding:
+    """Тесты корзин, разнесенных по нескольким SQLite-базам"""
+
+    def test_carts_are_routed_by_id(self, sharded_shop):
+        item = sharded_shop.create_item(CreateItemRequest(name="Milk", price=50.0))
+        carts = [sharded_shop.create_cart() for _ in range(5)]
+        for cart in carts:
+            sharded_shop.add_item_to_cart(cart.id, item.id, cart.id)
+
+        assert [cart.id for cart in carts] == [1, 2, 3, 4, 5]
+        for cart in carts:
+            owner = sharded_shop.map.shard_of(cart.id)
+            assert sharded_shop.shards[owner].get_cart(cart.id).items == {item.id: cart.id}
+            assert sharded_shop.shards[1 - owner].get_cart(cart.id) is None
+        assert all(shard.get_item(item.id) == item for shard in sharded_shop.shards)
+
+    def test_compaction_checks_shard_carts(self, sharded_shop):
+        kept, archived = [sharded_shop.create_item(CreateItemRequest(name=f"Item {i}", price=1.0)) for i in range(2)]
+        cart = sharded_shop.create_cart()
+        sharded_shop.add_item_to_cart(cart.id, kept.id)
+        sharded_shop.delete_item(kept.id)
+        sharded_shop.delete_item(archived.id)
+        TestCompaction().age_deletions(sharded_shop.shop, days=400)
+
+        assert compact(sharded_shop, timedelta(days=365)).moved == 1
+        assert sharded_shop.get_item(kept.id).deleted
+        assert sharded_shop.get_cart_response(cart.id)[0].items[0].available is False
+        assert sharded_shop.get_item(archived.id) is None
+        assert all(shard.get_item(archived.id) is None for shard in sharded_shop.shards)
+        assert all(shard.get_item(kept.id).deleted for shard in sharded_shop.shards)
+
+    def test_fan_out_merges_shards(self, sharded_shop):
+        item = sharded_shop.create_item(CreateItemRequest(name="Milk", price=10.0))
+        carts = [sharded_shop.create_cart() for _ in range(5)]
+        sharded_shop.apply_cart_deltas({(cart.id, item.id): 1 for cart in carts})
+        sharded_shop.update_item(item.id, UpdateItemRequest(price=20.0))
+
+        page = sharded_shop.get_all_carts(GetCartsRequest(offset=1, limit=3))
+        responses = sharded_shop.get_cart_responses(GetCartsRequest(min_price=15.0, limit=10))
+        metrics = sharded_shop.get_business_metrics()
+
+        assert [cart.id for cart in page] == [2, 3, 4]
+        assert [response.price for response in responses] == [20.0] * 5
+        assert metrics == BusinessMetrics(carts=5, items=1, cart_price_sum=100.0)
+        assert sharded_shop.get_cart_totals([2, 3]) == {2: (20.0, 1), 3: (20.0, 1)}
+
+    def test_balanced_map_moves_minimum(self):
+        current = ShardMap.default(2)
+        target = current.balanced(3)
+
+        moved = [bucket for bucket in range(BUCKETS) if current.owners[bucket] != target.owners[bucket]]
+        assert sorted(target.counts().values()) == [85, 85, 86]
+        assert len(moved) == 85
+        assert all(target.owners[bucket] == 2 for bucket in moved)
+
+    def test_rebalance_onto_new_shard(self, sharded_shop, tmp_path):
+        item = sharded_shop.create_item(CreateItemRequest(name="Milk", price=10.0))
+        carts = [sharded_shop.create_cart() for _ in range(175)]
+        sharded_shop.apply_cart_deltas({(cart.id, item.id): cart.id for cart in carts})
+        sharded_shop.close()
+
+        grown = ShardedShop(Shop(), [Shop(url, replica_urls=[]) for url in shard_urls(tmp_path, 3)], refresh_interval=0)
+        try:
+            result = rebalance(grown, wait=0)
+
+            moved = [cart.id for cart in carts if grown.map.shard_of(cart.id) == 2]
+            assert result.buckets == 85
+            assert moved == [171, 172, 173, 174, 175]
+            assert all(grown.shards[2].get_cart(cart_id).items == {item.id: cart_id} for cart_id in moved)
+            assert all(grown.shards[cart_id % 2].get_cart(cart_id) is None for cart_id in moved)
+            assert [grown.get_cart(cart.id).items for cart in carts] == [{item.id: cart.id} for cart in carts]
+            assert grown.get_business_metrics().carts == 175
+            assert grown.shards[2].get_item(item.id) == item
+            assert grown.create_cart().id > 175
+            assert grown.map.moving == frozenset()
+            assert load_shard_map(grown.shop, 3).moving == frozenset()
+        finally:
+            grown.close()
+
+    def test_rebalance_waits_for_workers_map_age(self, sharded_shop, tmp_path):
+        """rebalance ждет не меньше max_map_age, который воркеры записали в общую базу"""
+        worker = ShardedShop(Shop(), [Shop(url, replica_urls=[]) for url in shard_urls(tmp_path, 2)],
+                             refresh_interval=30)
+        worker.warm_up(1)
+        worker.close()
+        grown = ShardedShop(Shop(), [Shop(url, replica_urls=[]) for url in shard_urls(tmp_path, 3)], refresh_interval=0)
+        try:
+            with pytest.raises(ValueError):
+                rebalance(grown, wait=5)
+            assert load_shard_map(grown.shop, 3).moving == frozenset()
+
+            with patch("shop_api.sharding.time.sleep") as sleep:
+                rebalance(grown)
+            sleep.assert_called_once_with(60.0)
+        finally:
+            grown.close()
+
+    def test_moving_buckets_are_not_routed(self, sharded_shop):
+        item = sharded_shop.create_item(CreateItemRequest(name="Milk", price=10.0))
+        cart = sharded_shop.create_cart()
+        sharded_shop.map = sharded_shop.map.with_moving([cart.id % BUCKETS, (cart.id + 1) % BUCKETS])
+
+        with pytest.raises(ShardUnavailable):
+            sharded_shop.add_item_to_cart(cart.id, item.id)
+        with pytest.raises(ShardUnavailable):
+            sharded_shop.apply_cart_deltas({(cart.id, item.id): 1})
+        assert sharded_shop.create_cart().id == cart.id + 2
+        assert sharded_shop.get_cart_totals() == {cart.id: (0.0, 0), cart.id + 2: (0.0, 0)}
+
+    def test_stale_map_stops_routing(self, sharded_shop):
+        cart = sharded_shop.create_cart()
+        sharded_shop.refresh_interval = sharded_shop.max_map_age = 1.0
+        before = REGISTRY.get_sample_value("app_shard_map_refresh_errors_total") or 0
+
+        with patch("shop_api.sharding.load_shard_map", side_effect=OSError("shared database is down")), \
+                patch.object(sharded_shop._stopped, "wait", side_effect=[False, True]):
+            sharded_shop._run()
+        sharded_shop.map_loaded_at -= 2.0
+
+        assert REGISTRY.get_sample_value("app_shard_map_refresh_errors_total") == before + 1
+        assert sharded_shop.map_is_stale()
+        with pytest.raises(ShardUnavailable):
+            sharded_shop.get_cart(cart.id)
+
+
+@pytest.fixture
+def indexed_shop(sqlite_url):
+    shop = IndexedCatalogShop(Shop(), refresh_interval=0)
+    for price in [50.0, 10.0, 30.0, 20.0, 40.0]:
+        shop.create_item(CreateItemRequest(name=f"Item {price}", price=price))
+    shop.warm_up(1)
+    yield shop
+    shop.close()
+
+
+class TestCatalogIndex:
+    """Тесты индекса цен в памяти процесса"""
+
+    def test_price_index_page(self):
+        index = PriceIndex([(30.0, 3), (10.0, 1), (20.0, 2), (20.0, 4)])
+
+        assert index.page(min_price=15.0, limit=2) == [2, 4]
+        assert index.page(min_price=15.0, after=(20.0, 4), limit=2) == [3]
+        assert index.page(max_price=20.0, offset=1, limit=5) == [2, 4]
+
+    def test_pages_are_served_without_queries(self, indexed_shop):
+        expected = indexed_shop.shop.get_all_items(GetItemsRequest(sort="price", min_price=15.0, limit=3))
+
+        with track_queries("test") as stats:
+            items = indexed_shop.get_all_items(GetItemsRequest(sort="price", min_price=15.0, limit=3))
+
+        assert items == expected
+        assert stats.count == 0
+
+    def test_own_writes_update_index(self, indexed_shop):
+        indexed_shop.update_item(1, UpdateItemRequest(price=5.0))
+        indexed_shop.delete_item(2)
+        created = indexed_shop.create_item(CreateItemRequest(name="New", price=25.0))
+
+        items = indexed_shop.get_all_items(GetItemsRequest(sort="price", limit=10))
+
+        assert [item.id for item in items] == [1, 4, created.id, 3, 5]
+        assert items == indexed_shop.shop.get_all_items(GetItemsRequest(sort="price", limit=10))
+
+    def test_own_writes_do_not_trigger_reload(self, indexed_shop):
+        indexed_shop.update_item(1, UpdateItemRequest(price=5.0))
+        indexed_shop.create_item(CreateItemRequest(name="New", price=25.0))
+
+        assert indexed_shop.poll() is False
+
+        indexed_shop.shop.update_item(2, UpdateItemRequest(price=1.0))
+        assert indexed_shop.poll() is True
+        assert indexed_shop.get_all_items(GetItemsRequest(sort="price", limit=1))[0].id == 2
+
+    def test_refresh_errors_are_counted(self, indexed_shop):
+        errors = REGISTRY.get_sample_value("app_catalog_index_refresh_errors_total") or 0
+
+        with patch.object(indexed_shop.shop, "get_catalog_version", side_effect=OperationalError("", {}, None)):
+            assert indexed_shop.poll() is False
+
+        assert REGISTRY.get_sample_value("app_catalog_index_refresh_errors_total") == errors + 1
+
+    def test_ngram_index_candidates(self):
+        index = NgramIndex([(1, "Red Apple"), (2, "Pineapple"), (3, "Banana")])
+        index.add(3, "Apple Banana")
+
+        assert list(index.candidates("apple")) == [1, 2, 3]
+        assert list(index.candidates("ple b")) == [3]
+        assert list(index.candidates("cherry")) == []
+        assert index.candidates("ap") is None
+
+    def test_name_search_is_served_without_queries(self, indexed_shop):
+        indexed_shop.update_item(3, UpdateItemRequest(name="Special 30"))
+        indexed_shop.delete_item(2)
+        expected = indexed_shop.shop.get_all_items(GetItemsRequest(q="item", sort="price", limit=10))
+
+        with track_queries("test") as stats:
+            items = indexed_shop.get_all_items(GetItemsRequest(q="item", sort="price", limit=10))
+            by_id = indexed_shop.get_all_items(GetItemsRequest(q="ITEM 4", limit=10))
+
+        assert items == expected
+        assert [item.id for item in items] == [4, 5, 1]
+        assert [item.id for item in by_id] == [5]
+        assert stats.count == 0
+
+    def test_reload_picks_up_other_writers(self, indexed_shop):
+        indexed_shop.shop.create_item(CreateItemRequest(name="Elsewhere", price=1.0))
+        assert indexed_shop.shop.get_catalog_version() != indexed_shop.loaded_version
+
+        indexed_shop.reload()
+
+        assert indexed_shop.get_all_items(GetItemsRequest(sort="price", limit=1))[0].name == "Elsewhere"
+
+
+@pytest.fixture
+def snapshot_shop(storage, tmp_path):
+    for price in [50.0, 10.0, 30.0, 20.0, 40.0]:
+        storage.create_item(CreateItemRequest(name=f"Товар {price}", price=price))
+    storage.delete_item(4)
+    shop = SnapshotCatalogShop(storage, str(tmp_path / "catalog.snapshot"), refresh_interval=0)
+    shop.warm_up(1)
+    yield shop
+    shop.snapshot.close()
+
+
+class TestCatalogSnapshot:
+    """Тесты снапшота каталога, отображенного в память"""
+
+    def test_snapshot_round_trip(self, tmp_path):
+        item = Item(id=7, name="Кефир", price=70.0, deleted=True)
+        item._version = 3
+        path = str(tmp_path / "catalog.snapshot")
+        write_snapshot(path, [item, Item(id=2, name="Milk", price=59.5, deleted=False)], catalog_version=9)
+
+        snapshot = CatalogSnapshot(path)
+
+        assert (len(snapshot), snapshot.catalog_version) == (2, 9)
+        assert snapshot.get(7) == item and snapshot.get(7)._version == 3
+        assert snapshot.get(3) is None
+        snapshot.close()
+
+    @pytest.mark.parametrize("filters", [
+        GetItemsRequest(),
+        GetItemsRequest(show_deleted=True, offset=1, limit=3),
+        GetItemsRequest(sort="price", min_price=15.0, limit=2),
+        GetItemsRequest(sort="price", max_price=40.0, cursor="20.0:4", show_deleted=True),
+    ])
+    def test_pages_match_storage(self, snapshot_shop, filters):
+        items = snapshot_shop.get_all_items(filters)
+
+        assert items == snapshot_shop.shop.get_all_items(filters)
+        assert [item._version for item in items] == [item._version for item in snapshot_shop.shop.get_all_items(filters)]
+
+    def test_second_worker_maps_existing_file(self, snapshot_shop):
+        other = SnapshotCatalogShop(snapshot_shop.shop, snapshot_shop.path, refresh_interval=0)
+        with patch("shop_api.catalog_snapshot.build_snapshot") as build:
+            other.refresh()
+
+        build.assert_not_called()
+        assert other.get_item(1) == snapshot_shop.shop.get_item(1)
+        other.snapshot.close()
+
+    def test_own_writes_and_other_writers(self, snapshot_shop):
+        snapshot_shop.update_item(1, UpdateItemRequest(price=5.0))
+        created = snapshot_shop.create_item(CreateItemRequest(name="Новый", price=1.0))
+        assert snapshot_shop.get_item(1).price == 5.0
+        assert snapshot_shop.get_item(created.id) == created
+
+        snapshot_shop.shop.update_item(2, UpdateItemRequest(name="Чужой"))
+        snapshot_shop.refresh()
+
+        assert snapshot_shop.overlay == {}
+        assert snapshot_shop.get_item(2).name == "Чужой"
+        assert snapshot_shop.get_all_items(GetItemsRequest(sort="price", limit=2)) == \
+            snapshot_shop.shop.get_all_items(GetItemsRequest(sort="price", limit=2))
+
+    def test_refresh_errors_are_counted(self, snapshot_shop, caplog):
+        before = REGISTRY.get_sample_value("app_catalog_snapshot_refresh_errors_total") or 0
+
+        with patch.object(snapshot_shop.shop, "get_catalog_version", side_effect=OSError("db is down")), \
+                patch.object(snapshot_shop._stopped, "wait", side_effect=[False, True]):
+            snapshot_shop._run()
+
+        assert REGISTRY.get_sample_value("app_catalog_snapshot_refresh_errors_total") == before + 1
+        assert "Catalog snapshot refresh failed" in caplog.text
+        assert snapshot_shop.get_item(1) is not None
+
+
+@pytest.fixture
+def stats_shop(storage):
+    """Статистика корзин без фоновой пересборки: тесты пересобирают ее явно"""
+    shop = CartStatsShop(storage, rebuild_interval=0)
+    shop.warm_up(1)
+    return shop
+
+
+class TestCartStats:
+    """Тесты статистики корзин на скетчах"""
+
+    def test_sketch_quantiles_within_accuracy(self):
+        sketch = DDSketch(relative_accuracy=0.01)
+        for value in range(1, 1001):
+            sketch.add(float(value))
+
+        for q, exact in [(0.5, 500.5), (0.9, 900.1), (0.99, 990.01)]:
+            assert sketch.quantile(q) == pytest.approx(exact, rel=0.02)
+        assert sketch.sum == sum(range(1, 1001))
+
+    def test_sketch_remove_and_merge(self):
+        left, right = DDSketch(), DDSketch()
+        for value in [0.0, 10.0, 20.0]:
+            left.add(value)
+        right.add(30.0)
+        left.merge(right)
+        left.remove(10.0)
+
+        assert left.count == 3
+        assert left.quantile(0.0) == 0.0
+        assert left.quantile(1.0) == pytest.approx(30.0, rel=0.01)
+        with pytest.raises(ValueError):
+            left.merge(DDSketch(relative_accuracy=0.05))
+
+    def test_incremental_matches_rebuild(self, stats_shop):
+        first = stats_shop.create_item(CreateItemRequest(name="First", price=10.0))
+        second = stats_shop.create_item(CreateItemRequest(name="Second", price=5.0))
+        carts = [stats_shop.create_cart() for _ in range(3)]
+        stats_shop.add_item_to_cart(carts[0].id, first.id, 2)
+        stats_shop.add_item_to_cart(carts[1].id, second.id, 4)
+        stats_shop.add_item_to_cart(carts[1].id, first.id)
+        stats_shop.update_item(second.id, UpdateItemRequest(price=7.0))
+        stats_shop.delete_item(first.id)
+        stats_shop.delete_cart(carts[2].id)
+        incremental = stats_shop.get_cart_stats().summary()
+
+        stats_shop.rebuild()
+
+        assert incremental == stats_shop.get_cart_stats().summary()
+        assert incremental["count"] == 2
+        assert incremental["price"]["sum"] == 28.0
+        assert stats_shop.get_business_metrics() == stats_shop.shop.get_business_metrics()
+
+    def test_cart_writes_do_not_read_totals(self, stats_shop):
+        first = stats_shop.create_item(CreateItemRequest(name="First", price=10.0))
+        second = stats_shop.create_item(CreateItemRequest(name="Second", price=5.0))
+        carts = [stats_shop.create_cart() for _ in range(3)]
+
+        with patch.object(stats_shop.shop, "get_cart_totals", side_effect=AssertionError("totals read")):
+            stats_shop.add_item_to_cart(carts[0].id, first.id, 2)
+            stats_shop.add_item_to_cart(carts[0].id, second.id, 3)
+            stats_shop.apply_cart_deltas({(carts[1].id, second.id): 4, (carts[2].id, first.id): 1})
+            stats_shop.update_cart_item_quantity(carts[0].id, first.id, 1)
+            stats_shop.remove_item_from_cart(carts[0].id, second.id)
+            stats_shop.clear_cart(carts[2].id)
+            incremental = stats_shop.get_cart_stats().summary()
+
+        stats_shop.rebuild()
+
+        assert incremental == stats_shop.get_cart_stats().summary()
+
+    def test_rebuild_errors_are_counted(self, storage):
+        shop = CartStatsShop(storage, rebuild_interval=0.01)
+        shop.warm_up(1)
+        errors = REGISTRY.get_sample_value("app_cart_stats_rebuild_errors_total") or 0
+        try:
+            with patch.object(storage, "get_cart_totals", side_effect=RuntimeError("db is down")):
+                deadline = time.monotonic() + 5
+                while REGISTRY.get_sample_value("app_cart_stats_rebuild_errors_total") == errors:
+                    assert time.monotonic() < deadline
+                    time.sleep(0.01)
+        finally:
+            shop._stopped.set()
+            shop._thread.join()
+
+    def test_rebuild_picks_up_other_writers(self, stats_shop):
+        cart = stats_shop.shop.create_cart()
+        item = stats_shop.shop.create_item(CreateItemRequest(name="Elsewhere", price=3.0))
+        stats_shop.shop.add_item_to_cart(cart.id, item.id, 5)
+        assert stats_shop.get_cart_stats().summary()["count"] == 0
+
+        stats_shop.rebuild()
+
+        summary = stats_shop.get_cart_stats().summary()
+        assert summary["quantity"]["sum"] == 5
+        assert summary["quantity_histogram"]["3-5"] == 1
+
+
+
+class SlowShop:
+    """Хранилище, которое отвечает только после release и считает обращения"""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+
+    def get_item(self, item_id):
+        self.calls += 1
+        self.release.wait(5)
+        if item_id < 0:
+            raise ValueError("bad id")
+        return Item(id=item_id, name="Item", price=1.0)
+
+
+class TestSingleFlight:
+    """Тесты склейки одинаковых одновременных чтений"""
+
+    def run_concurrently(self, call, count):
+        results = []
+        errors = []
+
+        def target():
+            try:
+                results.append(call())
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def test_concurrent_lookups_share_one_fetch(self):
+        slow = SlowShop()
+        flights = SingleFlight()
+        before = REGISTRY.get_sample_value("app_singleflight_coalesced_total", {"method": "get_item"}) or 0
+
+        threads, results, errors = self.run_concurrently(lambda: flights.do(("get_item", 1), lambda: slow.get_item(1)), 8)
+        time.sleep(0.1)
+        slow.release.set()
+        for thread in threads:
+            thread.join()
+
+        assert slow.calls == 1
+        assert not errors
+        assert all(result is results[0] for result in results)
+        assert REGISTRY.get_sample_value("app_singleflight_coalesced_total", {"method": "get_item"}) == before + 7
+
+    def test_errors_reach_every_caller(self):
+        slow = SlowShop()
+        flights = SingleFlight()
+
+        threads, results, errors = self.run_concurrently(lambda: flights.do(("get_item", -1), lambda: slow.get_item(-1)), 4)
+        time.sleep(0.1)
+        slow.release.set()
+        for thread in threads:
+            thread.join()
+
+        assert slow.calls == 1
+        assert len(errors) == 4 and all(isinstance(error, ValueError) for error in errors)
+        assert not flights.flights
+
+    def test_waiter_falls_back_after_timeout(self):
+        slow = SlowShop()
+        flights = SingleFlight()
+        leader = threading.Thread(target=lambda: flights.do(("get_item", 1), lambda: slow.get_item(1)))
+        leader.start()
+        time.sleep(0.05)
+
+        started = time.perf_counter()
+        threading.Timer(0.2, slow.release.set).start()
+        item = flights.do(("get_item", 1), lambda: slow.get_item(1), timeout=0.05)
+        leader.join()
+
+        assert item.id == 1
+        assert slow.calls == 2
+        assert time.perf_counter() - started < 1
+
+    def test_writes_are_not_coalesced_with_older_reads(self, storage):
+        shop = CoalescingShop(storage)
+        item = shop.create_item(CreateItemRequest(name="Milk", price=10.0))
+        cart = shop.create_cart()
+        stale = Flight()
+        shop.flights.flights[("get_cart_response", cart.id, False)] = stale
+
+        shop.add_item_to_cart(cart.id, item.id)
+
+        assert shop.get_cart_response(cart.id)[0].price == 10.0
+        assert not shop.flights.flights
+
+
+@pytest.fixture
+def bus_workers(sqlite_url, tmp_path):
+    """Два воркера над одной базой: у каждого свой Shop и индекс, шина общая"""
+    bus = LocalInvalidationBus()
+    workers = []
+    for _ in range(2):
+        shop = Shop()
+        shop.bus = bus
+        workers.append(IndexedCatalogShop(shop, refresh_interval=0))
+    for price in [30.0, 10.0, 20.0]:
+        workers[0].create_item(CreateItemRequest(name=f"Item {price}", price=price))
+    for worker in workers:
+        worker.warm_up(1)
+        bus.subscribe(worker.invalidate)
+    yield bus, workers
+    for worker in workers:
+        worker.close()
+
+
+class TestInvalidationBus:
+    """Тесты инвалидации кешей каталога между воркерами"""
+
+    def test_message_round_trip(self):
+        message = decode_message(encode_message([3, 1], 1700000000.5))
+
+        assert message.item_ids == (3, 1)
+        assert message.sent_at == 1700000000.5
+
+    def test_subscriber_errors_are_counted(self, caplog):
+        bus = LocalInvalidationBus()
+        received = []
+        bus.subscribe(lambda item_ids: 1 / 0)
+        bus.subscribe(received.append)
+        labels = {"stage": "subscriber"}
+        before = REGISTRY.get_sample_value("app_invalidation_errors_total", labels) or 0
+
+        bus.publish(None, [1, 2])
+
+        assert received == [[1, 2]]
+        assert REGISTRY.get_sample_value("app_invalidation_errors_total", labels) == before + 1
+        assert "Cache invalidation" in caplog.text
+
+    def test_listener_reconnects_after_error(self, tmp_path):
+        bus = PostgresInvalidationBus(f"sqlite:///{tmp_path / 'bus.db'}", reconnect_delay=0)
+        calls = []
+
+        def listen(connection):
+            calls.append(connection)
+            if len(calls) == 1:
+                raise OSError("connection lost")
+            bus._stopped.set()
+        labels = {"stage": "listener"}
+        before = REGISTRY.get_sample_value("app_invalidation_errors_total", labels) or 0
+
+        with patch.object(bus, "_listen", side_effect=listen):
+            bus._run()
+
+        assert len(calls) == 2
+        assert REGISTRY.get_sample_value("app_invalidation_errors_total", labels) == before + 1
+        bus.close()
+
+    def test_other_worker_sees_writes(self, bus_workers):
+        bus, (writer, reader) = bus_workers
+        prices = lambda: [(item.id, item.price) for item in reader.get_all_items(GetItemsRequest(sort="price"))]
+
+        writer.update_item(1, UpdateItemRequest(price=5.0))
+        assert prices() == [(1, 5.0), (2, 10.0), (3, 20.0)]
+
+        writer.delete_item(2)
+        created = writer.create_item(CreateItemRequest(name="New", price=15.0))
+        with track_queries("test") as stats:
+            assert prices() == [(1, 5.0), (created.id, 15.0), (3, 20.0)]
+        assert stats.count == 0
+
+    def test_rolled_back_write_is_not_published(self, bus_workers):
+        bus, (writer, reader) = bus_workers
+        received = []
+        bus.subscribe(received.append)
+
+        with pytest.raises(VersionConflict):
+            writer.update_item(1, UpdateItemRequest(price=5.0), expected_version=7)
+        session = writer.shop.db.get_session()
+        try:
+            bus.publish(session, [1])
+            session.rollback()
+        finally:
+            session.close()
+
+        assert received == []
+
+    def test_flush_reloads_missed_writes(self, bus_workers):
+        bus, (writer, reader) = bus_workers
+        # Запись мимо шины - как уведомление, потерянное, пока слушатель был отключен
+        writer.shop.bus = None
+        writer.update_item(3, UpdateItemRequest(price=1.0))
+        assert reader.get_all_items(GetItemsRequest(sort="price"))[0].id == 2
+
+        bus.flush()
+
+        assert reader.get_all_items(GetItemsRequest(sort="price"))[0].id == 3
+
+    def test_snapshot_overlay_and_lag_metric(self, bus_workers, tmp_path):
+        bus, (writer, reader) = bus_workers
+        snapshot = SnapshotCatalogShop(reader.shop, str(tmp_path / "catalog.snapshot"), refresh_interval=0)
+        snapshot.warm_up(1)
+        bus.subscribe(snapshot.invalidate)
+        lag_count = REGISTRY.get_sample_value("app_invalidation_lag_seconds_count") or 0
+
+        writer.update_item(2, UpdateItemRequest(name="Renamed"))
+        writer.hard_delete_item(3)
+
+        assert snapshot.get_item(2).name == "Renamed"
+        assert snapshot.get_item(3) is None
+        assert REGISTRY.get_sample_value("app_invalidation_lag_seconds_count") == lag_count + 2
+        snapshot.snapshot.close()
@@ -0,0 +1,205 @@
+import os
+import subprocess
+import sys
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from shop_api.database import Shop
+from shop_api.main import app
+from shop_api.metrics import cleanup_dead_workers, reset_multiprocess_dir
+from shop_api.query_metrics import BACKGROUND, QueryStats, finish_request, fingerprint, normalize, track_queries
+from shop_api.serve import worker_count
+from shop_api.timing import RequestTimer
+import shop_api.timing as timing_module
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY, CollectorRegistry, multiprocess
+
+
+HW_DIR = os.path.join(os.path.dirname(__file__), '..')
+
+WORKER_SCRIPT = """
+from prometheus_client import Counter, Gauge
+Gauge('test_pending', 'pending', multiprocess_mode='livesum').set({value})
+Counter('test_requests', 'requests').inc({value})
+"""
+
+
+def run_worker(path, value):
+    """Воркер пишет свои метрики в общий каталог и завершается"""
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(path))
+    subprocess.run([sys.executable, '-c', WORKER_SCRIPT.format(value=value)], env=env, cwd=HW_DIR, check=True)
+
+
+def collect(path):
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=str(path))
+    return {
+        sample.name: sample.value
+        for metric in registry.collect()
+        for sample in metric.samples
+    }
+
+
+class TestMultiprocessMetrics:
+    """Тесты метрик при запуске в нескольких воркерах"""
+
+    def test_worker_count_from_env(self, monkeypatch):
+        monkeypatch.setenv("WEB_CONCURRENCY", "3")
+        assert worker_count() == 3
+
+    def test_worker_count_defaults_to_cpus(self, monkeypatch):
+        monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+        assert worker_count() >= 1
+
+    def test_samples_are_aggregated_across_workers(self, tmp_path):
+        run_worker(tmp_path, 2)
+        run_worker(tmp_path, 3)
+
+        samples = collect(tmp_path)
+
+        assert samples['test_requests_total'] == 5
+        assert samples['test_pending'] == 5
+
+    def test_cleanup_drops_live_gauges_of_dead_workers(self, tmp_path):
+        run_worker(tmp_path, 2)
+
+        dead = cleanup_dead_workers(str(tmp_path))
+        samples = collect(tmp_path)
+
+        assert len(dead) == 1
+        assert 'test_pending' not in samples
+        assert samples['test_requests_total'] == 2
+
+    def test_cleanup_without_multiprocess_dir(self, monkeypatch):
+        monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+        assert cleanup_dead_workers() == []
+
+    def test_reset_removes_previous_run(self, tmp_path):
+        run_worker(tmp_path, 1)
+
+        reset_multiprocess_dir(str(tmp_path))
+
+        assert collect(tmp_path) == {}
+
+
+@pytest.fixture
+def sqlite_client(sqlite_url, monkeypatch):
+    monkeypatch.setenv("SHOP_BACKEND", "sql")
+    with TestClient(app) as client:
+        yield client
+
+
+class TestQueryMetrics:
+    """Тесты метрик по SQL-запросам и бюджета запросов"""
+
+    def test_normalize_strips_literals_and_params(self):
+        assert normalize("SELECT * FROM items\n WHERE id = 5 AND name = 'x'") == "SELECT * FROM items WHERE id = ? AND name = ?"
+        assert normalize("SELECT * FROM items WHERE id IN (?, ?, ?)") == "SELECT * FROM items WHERE id IN (?)"
+        assert normalize("UPDATE carts SET version=%(version)s") == "UPDATE carts SET version=?"
+
+    def test_fingerprint_ignores_values(self):
+        first = fingerprint("SELECT items.id FROM items WHERE items.id = 1")
+        second = fingerprint("SELECT items.id FROM items WHERE items.id = 42")
+
+        assert first == second
+        assert first[:2] == ("SELECT", "items")
+        assert fingerprint("INSERT INTO carts DEFAULT VALUES")[:2] == ("INSERT", "carts")
+
+    def test_queries_are_attributed_to_endpoint(self, sqlite_client):
+        cart_id = sqlite_client.post("/cart").json()["id"]
+
+        response = sqlite_client.get(f"/cart/{cart_id}")
+
+        assert int(response.headers["X-DB-Queries"]) > 0
+        assert REGISTRY.get_sample_value(
+            'app_db_queries_total', {'endpoint': '/cart/{cart_id}', 'operation': 'SELECT', 'table': 'carts'}
+        ) > 0
+
+    def test_metrics_refresh_is_not_counted_against_endpoint(self, sqlite_client):
+        sqlite_client.post("/item", json={"name": "Milk", "price": 10.0})
+
+        assert sqlite_client.get("/healthz").headers["X-DB-Queries"] == "0"
+        assert sqlite_client.get("/item/1").headers["X-DB-Queries"] == "1"
+
+    def test_queries_outside_request_are_background(self, sqlite_url):
+        shop = Shop()
+        labels = {'endpoint': BACKGROUND, 'operation': 'INSERT', 'table': 'carts'}
+        before = REGISTRY.get_sample_value('app_db_queries_total', labels) or 0
+        try:
+            shop.create_cart()
+            with track_queries('/cart') as stats:
+                shop.create_cart()
+        finally:
+            shop.close()
+
+        assert REGISTRY.get_sample_value('app_db_queries_total', labels) == before + 1
+        assert stats.count >= 1
+
+    def test_index_pages_need_no_queries(self, sqlite_url, monkeypatch):
+        monkeypatch.setenv("SHOP_BACKEND", "sql")
+        monkeypatch.setenv("CATALOG_INDEX", "1")
+        with TestClient(app) as client:
+            for price in [30.0, 10.0, 20.0]:
+                client.post("/item", json={"name": f"Item {price}", "price": price})
+
+            response = client.get("/item", params={"sort": "price", "limit": 2})
+
+            assert [item["price"] for item in response.json()] == [10.0, 20.0]
+            assert response.headers["X-DB-Queries"] == "0"
+            assert client.get("/item", params={"sort": "price", "limit": 2},
+                              headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+    def test_budget_exceeded(self, caplog):
+        stats = QueryStats('/cart')
+        stats.count = 12
+        stats.fingerprints = {'0000abcd': 10, '0000beef': 2}
+        before = REGISTRY.get_sample_value('app_db_query_budget_exceeded_total', {'endpoint': '/cart'}) or 0
+
+        assert finish_request(stats, budget=5)
+        assert not finish_request(stats, budget=20)
+        assert REGISTRY.get_sample_value('app_db_query_budget_exceeded_total', {'endpoint': '/cart'}) == before + 1
+        assert '0000abcd' in caplog.text
+
+    def test_budget_header(self, sqlite_client, monkeypatch):
+        monkeypatch.setattr("shop_api.query_metrics.QUERY_BUDGET", 1)
+
+        response = sqlite_client.get("/item")
+
+        assert response.headers["X-DB-Query-Budget-Exceeded"] == "1"
+
+
+class TestRequestTiming:
+    """Тесты фаз обработки запроса"""
+
+    def test_phases_from_marks(self):
+        timer = RequestTimer()
+        timer.handler_started, timer.endpoint_started = 1.0, 1.5
+        timer.endpoint_finished, timer.handler_finished = 4.0, 4.5
+        timer.db = timer.db_at_endpoint_finish = 2.0
+        timer.rendered = 0.25
+
+        assert timer.phases() == {'validation': 0.5, 'db': 2.0, 'model': 0.25, 'serialize': 0.75}
+
+    def test_server_timing_header_and_histograms(self, sqlite_client, monkeypatch):
+        cart_id = sqlite_client.post("/cart").json()["id"]
+        labels = {'route': '/cart/{cart_id}', 'phase': 'db'}
+        before = REGISTRY.get_sample_value('app_request_phase_seconds_count', labels) or 0
+
+        assert "server-timing" not in sqlite_client.get(f"/cart/{cart_id}").headers
+        monkeypatch.setattr(timing_module, "SERVER_TIMING_HEADER", True)
+        response = sqlite_client.get(f"/cart/{cart_id}")
+
+        phases = dict(part.split(";dur=") for part in response.headers["server-timing"].split(", "))
+        assert set(phases) == {"validation", "db", "model", "serialize", "total"}
+        assert float(phases["db"]) > 0
+        assert float(phases["total"]) >= float(phases["db"])
+        assert REGISTRY.get_sample_value('app_request_phase_seconds_count', labels) == before + 2
+
+    def test_metrics_refresh_is_not_in_db_phase(self, sqlite_client, monkeypatch):
+        sqlite_client.post("/cart")
+        monkeypatch.setattr(timing_module, "SERVER_TIMING_HEADER", True)
+
+        response = sqlite_client.get("/healthz")
+
+        phases = dict(part.split(";dur=") for part in response.headers["server-timing"].split(", "))
+        assert float(phases["db"]) == 0